@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+batch_plan_generator.py - Generate plans for many organizations from a file
+
+Reads organization records from a CSV or JSONL file and generates a plan for
+each one with a single generator, so the organized corpus and its indexes
+are loaded once for the whole batch. Prompts are built one at a time (they
+take milliseconds) and the model calls run concurrently, at most
+--concurrency at once, which should match what the model server can serve
+in parallel (OLLAMA_NUM_PARALLEL for Ollama).
+
+Every finished record is appended to checkpoint.jsonl in the output
+directory as soon as its plan is written. Running the same command again
+skips the records that already completed, so a crashed or interrupted batch
+resumes where it stopped. Plans go to plans/ and a summary of the whole
+batch to manifest.json.
+
+CSV columns use the questionnaire field names (organization_name,
+organization_type, location, primary_hazards, ...). List fields hold values
+separated by semicolons, e.g. "Fire;Flood". An optional record_id column
+names each record; otherwise a record is named by a hash of its answers, so
+editing the file between runs does not match a resumed record with another
+record's checkpoint.
+
+Usage:
+    python batch_plan_generator.py sites.csv --output-dir batch_output --concurrency 4
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from context_assembler import DEFAULT_PROMPT_TOKEN_BUDGET
+from emergency_plan_generator import EmergencyPlanGenerator
+from enhanced_emergency_plan_generator import EnhancedEmergencyPlanGenerator
+from enhanced_emergency_plan_generator_v2 import EnhancedEmergencyPlanGeneratorV2
+from llm_backends import add_backend_arguments, configure_backend
+from plan_cache import PlanCache
+from plan_generator_base import PlanGeneratorBase, add_keep_alive_argument, get_shared_engine
+from plan_telemetry import TELEMETRY, add_telemetry_arguments, configure_telemetry
+
+GENERATORS = {
+    'basic': EmergencyPlanGenerator,
+    'enhanced': EnhancedEmergencyPlanGenerator,
+    'v2': EnhancedEmergencyPlanGeneratorV2
+}
+
+CHECKPOINT_FILENAME = "checkpoint.jsonl"
+MANIFEST_FILENAME = "manifest.json"
+PLANS_DIRNAME = "plans"
+
+REQUIRED_FIELDS = ['organization_name', 'organization_type', 'location', 'primary_hazards']
+LIST_FIELDS = ['primary_hazards', 'special_considerations', 'emergency_equipment', 'communication_methods']
+BOOLEAN_FIELDS = ['has_security', 'has_medical_staff', 'force_regenerate']
+LIST_SEPARATOR = ";"
+
+# Answers used when a record leaves a field out, as in the web form
+DEFAULT_RECORD = {
+    'building_size': 'Medium (50-200 people)',
+    'special_considerations': [],
+    'has_security': True,
+    'has_medical_staff': False,
+    'emergency_equipment': ['Fire Extinguishers', 'First Aid Kits', 'Emergency Lighting'],
+    'communication_methods': ['PA System', 'Email Alerts', 'Text/SMS'],
+    'plan_scope': 'Comprehensive (All Hazards)',
+    'additional_requirements': ''
+}
+
+
+def parse_boolean(value) -> bool:
+    """Read a CSV cell such as yes/no, true/false or 1/0 as a boolean."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def content_record_id(answers: Dict) -> str:
+    """Record id derived from a record's answers."""
+    payload = json.dumps(answers, sort_keys=True, ensure_ascii=False)
+    return "rec-" + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+
+
+def normalize_record(record: Dict) -> Dict:
+    """Fill in defaults and convert CSV text to the questionnaire's lists and booleans."""
+    answers = {key: value for key, value in record.items() if value not in (None, '')}
+    inputs = dict(DEFAULT_RECORD)
+    inputs.update(answers)
+    for field in LIST_FIELDS:
+        if isinstance(inputs.get(field), str):
+            inputs[field] = [item.strip() for item in inputs[field].split(LIST_SEPARATOR) if item.strip()]
+    for field in BOOLEAN_FIELDS:
+        if field in inputs:
+            inputs[field] = parse_boolean(inputs[field])
+    inputs['record_id'] = str(inputs.get('record_id') or content_record_id(answers))
+    return inputs
+
+
+def read_records(input_path: str) -> List[Dict]:
+    """Read organization records from a .csv or .jsonl file."""
+    path = Path(input_path)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.suffix.lower() == '.csv':
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    records = []
+    seen = set()
+    for row in rows:
+        record = normalize_record(row)
+        if record['record_id'] in seen:
+            if row.get('record_id'):
+                raise ValueError(f"Duplicate record_id in {input_path}: {record['record_id']}")
+            # Identical rows are numbered by their occurrence
+            base_id = record['record_id']
+            copy_number = 2
+            while f"{base_id}-{copy_number}" in seen:
+                copy_number += 1
+            record['record_id'] = f"{base_id}-{copy_number}"
+        seen.add(record['record_id'])
+        records.append(record)
+    return records
+
+
+def missing_fields(record: Dict) -> List[str]:
+    """Required questionnaire fields a record does not answer."""
+    return [field for field in REQUIRED_FIELDS if not record.get(field)]
+
+
+class BatchPlanGenerator:
+    def __init__(self, generator: PlanGeneratorBase, output_dir: str, concurrency: int = 1,
+                 plan_cache: PlanCache = None, force_regenerate: bool = False):
+        """Initialize a batch run writing into output_dir with one shared generator."""
+        self.generator = generator
+        self.output_dir = Path(output_dir)
+        self.plans_dir = self.output_dir / PLANS_DIRNAME
+        self.checkpoint_path = self.output_dir / CHECKPOINT_FILENAME
+        self.manifest_path = self.output_dir / MANIFEST_FILENAME
+        self.concurrency = max(1, concurrency)
+        self.plan_cache = plan_cache
+        self.force_regenerate = force_regenerate
+        # Prompts are built one at a time; the checkpoint is appended by every worker
+        self._prompt_lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+
+    def load_checkpoint(self) -> Dict[str, Dict]:
+        """Latest checkpoint entry of every record, by record id."""
+        entries = {}
+        if self.checkpoint_path.exists():
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash; its record runs again
+                        continue
+                    entries[entry['record_id']] = entry
+        return entries
+
+    def rewrite_checkpoint(self, entries: Dict[str, Dict]) -> None:
+        """Replace the checkpoint with one entry per record, dropping a line cut short by a crash."""
+        temp_path = self.checkpoint_path.with_name(CHECKPOINT_FILENAME + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        temp_path.replace(self.checkpoint_path)
+
+    def record_checkpoint(self, entry: Dict) -> None:
+        """Append a finished record to the checkpoint, durably."""
+        with self._checkpoint_lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def plan_path(self, record: Dict) -> Path:
+        """Where a record's plan is written; stable, so a resumed run overwrites a partial file.
+
+        Names are made filesystem safe, so a hash of the record id keeps ids
+        that sanitize alike ("a b" and "a_b") from sharing a file.
+        """
+        org_name = re.sub(r'[^A-Za-z0-9._-]+', '_', record['organization_name']).strip('_')
+        record_id = re.sub(r'[^A-Za-z0-9._-]+', '_', record['record_id'])
+        digest = hashlib.sha256(record['record_id'].encode('utf-8')).hexdigest()[:8]
+        return self.plans_dir / f"{record_id}_{org_name}_{digest}.md"
+
+    def generate_record(self, record: Dict) -> Dict:
+        """Generate and write one record's plan, returning its checkpoint entry."""
+        with TELEMETRY.trace(record['record_id']):
+            return self._generate_record(record)
+
+    def _generate_record(self, record: Dict) -> Dict:
+        started = time.time()
+        inputs = {key: value for key, value in record.items() if key != 'record_id'}
+        with self._prompt_lock:
+            cache_key = self.generator.plan_cache_key(inputs)
+        plan_content = None
+        if self.plan_cache and not (self.force_regenerate or inputs.get('force_regenerate')):
+            plan_content = self.plan_cache.get(cache_key)
+        cache_hit = plan_content is not None
+
+        if not cache_hit:
+            with self._prompt_lock:
+                messages = self.generator.build_messages(inputs)
+            plan_content = self.generator.call_model(messages)
+            if self.plan_cache:
+                self.plan_cache.put(cache_key, plan_content)
+
+        path = self.plan_path(record)
+        temp_path = path.with_name(path.name + ".tmp")
+        with TELEMETRY.span('save', characters=len(plan_content)):
+            temp_path.write_text(self.generator.plan_header(inputs) + plan_content + self.generator.plan_footer(),
+                                 encoding='utf-8')
+            temp_path.replace(path)
+        return {
+            'record_id': record['record_id'],
+            'organization_name': record['organization_name'],
+            'status': 'completed',
+            'plan_path': str(path),
+            'cache_hit': cache_hit,
+            'characters': len(plan_content),
+            'seconds': round(time.time() - started, 3),
+            'completed_at': datetime.now().isoformat()
+        }
+
+    def run(self, records: List[Dict]) -> Dict:
+        """Generate every record that has not completed yet and write the manifest."""
+        self.plans_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint = self.load_checkpoint()
+        self.rewrite_checkpoint(checkpoint)
+        done = {record_id for record_id, entry in checkpoint.items() if entry['status'] == 'completed'}
+        pending = [record for record in records if record['record_id'] not in done]
+        print(f"📋 {len(records)} records: {len(records) - len(pending)} already completed, "
+              f"{len(pending)} to generate ({self.concurrency} at a time)")
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            for record in pending:
+                missing = missing_fields(record)
+                if missing:
+                    entry = {'record_id': record['record_id'],
+                             'organization_name': record.get('organization_name', ''),
+                             'status': 'failed', 'error': f"Missing required field(s): {', '.join(missing)}"}
+                    print(f"❌ {record['record_id']}: {entry['error']}")
+                    self.record_checkpoint(entry)
+                    checkpoint[record['record_id']] = entry
+                    continue
+                futures[executor.submit(self.generate_record, record)] = record
+
+            for number, future in enumerate(as_completed(futures), 1):
+                record = futures[future]
+                try:
+                    entry = future.result()
+                    print(f"✅ [{number}/{len(futures)}] {record['record_id']} {record['organization_name']} "
+                          f"({entry['seconds']:.1f}s{', cached' if entry['cache_hit'] else ''})")
+                except Exception as e:
+                    entry = {'record_id': record['record_id'], 'organization_name': record['organization_name'],
+                             'status': 'failed', 'error': str(e)}
+                    print(f"❌ [{number}/{len(futures)}] {record['record_id']} {record['organization_name']}: {e}")
+                self.record_checkpoint(entry)
+                checkpoint[record['record_id']] = entry
+
+        manifest = self.write_manifest(records, checkpoint, time.time() - started)
+        return manifest
+
+    def write_manifest(self, records: List[Dict], checkpoint: Dict[str, Dict], wall_time: float) -> Dict:
+        """Summarize the batch, in input order, to manifest.json."""
+        entries = [checkpoint.get(record['record_id'], {'record_id': record['record_id'], 'status': 'pending'})
+                   for record in records]
+        statuses = [entry['status'] for entry in entries]
+        manifest = {
+            'generated_at': datetime.now().isoformat(),
+            'model': self.generator.model_name,
+            'generator': type(self.generator).__name__,
+            'total': len(entries),
+            'completed': statuses.count('completed'),
+            'failed': statuses.count('failed'),
+            'pending': statuses.count('pending'),
+            'cache_hits': sum(1 for entry in entries if entry.get('cache_hit')),
+            'last_run_seconds': round(wall_time, 3),
+            'records': entries
+        }
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate emergency plans for many organizations from a CSV or JSONL file")
+    parser.add_argument("input", help="CSV or JSONL file of organization records")
+    parser.add_argument("--output-dir", default="batch_output",
+                        help="Directory for the plans, checkpoint and manifest (reuse it to resume)")
+    parser.add_argument("--generator", choices=list(GENERATORS), default="enhanced", help="Plan generator to use")
+    parser.add_argument("--model", default="llama3.2:1b", help="Ollama model name to use")
+    parser.add_argument("--organized-data-dir", help="Directory containing organized emergency management documents")
+    parser.add_argument("--prompt-token-budget", type=int, default=DEFAULT_PROMPT_TOKEN_BUDGET,
+                        help="Approximate token budget for the whole prompt, including retrieved context")
+    parser.add_argument("--embedding-model",
+                        help="Ollama embedding model for semantic retrieval (e.g. nomic-embed-text)")
+    parser.add_argument("--concurrency", type=int,
+                        help="Plans generated at once (default: the backend's --max-concurrency)")
+    add_keep_alive_argument(parser)
+    parser.add_argument("--no-cache", action="store_true", help="Neither read nor store plans in the plan cache")
+    parser.add_argument("--force-regenerate", action="store_true",
+                        help="Generate every plan again instead of reusing cached plans")
+
+    add_backend_arguments(parser)
+    add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+    configure_telemetry(args)
+
+    records = read_records(args.input)
+
+    # Check that the model server is running
+    backend = configure_backend(args)
+    try:
+        backend.check_connection()
+    except Exception:
+        print(f"Error: Cannot connect to the {backend.name} server. Is it running?")
+        return
+
+    # One retrieval engine and generator serve the whole batch
+    engine = get_shared_engine(args.organized_data_dir, args.embedding_model)
+    generator_options = {'model_name': args.model, 'engine': engine, 'keep_alive': args.keep_alive}
+    if args.generator != 'basic':
+        # The basic generator packs its prompt with the default budget
+        generator_options['prompt_token_budget'] = args.prompt_token_budget
+    generator = GENERATORS[args.generator](**generator_options)
+    batch = BatchPlanGenerator(generator, args.output_dir, args.concurrency or backend.max_concurrency,
+                               plan_cache=None if args.no_cache else PlanCache(),
+                               force_regenerate=args.force_regenerate)
+    manifest = batch.run(records)
+
+    print(f"\n📊 {manifest['completed']}/{manifest['total']} plans completed, {manifest['failed']} failed "
+          f"({manifest['cache_hits']} from the cache)")
+    print(f"💾 Manifest saved to: {batch.manifest_path}")
+    TELEMETRY.print_summary()
+
+
+if __name__ == "__main__":
+    main()
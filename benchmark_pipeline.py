@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+benchmark_pipeline.py - End-to-end throughput benchmark of the plan pipeline
+
+Runs the plan generation pipeline against the offline fake model backend,
+which streams a canned plan at a configurable token rate, so the cost of our
+own code can be measured without Ollama or a GPU. Each plan goes through:
+
+- input structuring (InputStructuringSystem)
+- retrieval (the shared retrieval engine and query cache)
+- prompt assembly (prompt components, context packing, chat messages)
+- generation (streamed from the fake model)
+- markdown -> PDF (skipped if the PDF libraries are not installed)
+- queue persistence (the task store's SQLite writes and reads)
+
+Loading the organized store is measured separately. The report gives
+latency percentiles per stage and plans per minute, with and without the
+model's time.
+
+Usage:
+    python benchmark_pipeline.py --plans 50 --tokens-per-second 0
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from emergency_plan_generator import EmergencyPlanGenerator
+from enhanced_emergency_plan_generator import EnhancedEmergencyPlanGenerator
+from enhanced_emergency_plan_generator_v2 import EnhancedEmergencyPlanGeneratorV2
+from document_organizer import QUERY_CACHE
+from input_structuring_system import InputStructuringSystem
+from llm_backends import FakeBackend
+from plan_generator_base import HAZARD_CATEGORIES, ORGANIZATION_TYPE_CATEGORIES, RetrievalEngine
+from plan_sections import PLAN_SECTIONS
+
+# The web app's queue and PDF modules live next to the Flask API
+sys.path.append(str(Path(__file__).parent / "emplan-web-vite"))
+
+GENERATORS = {
+    'basic': EmergencyPlanGenerator,
+    'enhanced': EnhancedEmergencyPlanGenerator,
+    'v2': EnhancedEmergencyPlanGeneratorV2
+}
+
+STAGES = ['input_structuring', 'retrieval', 'prompt_assembly', 'first_token', 'generation',
+          'markdown_to_pdf', 'queue_persistence', 'total']
+PERCENTILES = (50, 90, 99)
+
+# Roughly the length of a full plan from the default 4000-token completion
+DEFAULT_PLAN_TOKENS = 2500
+
+SAMPLE_LOCATIONS = ["Toronto, ON", "Vancouver, BC", "Calgary, AB", "Halifax, NS", "Ottawa, ON"]
+SAMPLE_BUILDING_SIZES = ["Small (< 50 people)", "Medium (50-200 people)",
+                         "Large (200-500 people)", "Very Large (500+ people)"]
+SAMPLE_CONSIDERATIONS = ["Persons with Disabilities", "Multi-story Building", "Hazardous Materials On-site",
+                         "Public Access Areas", "24/7 Operations"]
+SAMPLE_EQUIPMENT = ["Fire Extinguishers", "First Aid Kits", "AED/Defibrillator", "Emergency Lighting",
+                    "Backup Power"]
+SAMPLE_COMMUNICATION = ["PA System", "Email Alerts", "Text/SMS", "Phone Tree", "Radio System"]
+
+
+def sample_inputs(count: int, seed: int = 0) -> List[Dict]:
+    """Questionnaire answers for count varied organizations, the same for the same seed."""
+    rng = random.Random(seed)
+    samples = []
+    for number in range(count):
+        samples.append({
+            'organization_name': f"Benchmark Organization {number}",
+            'organization_type': rng.choice(list(ORGANIZATION_TYPE_CATEGORIES)),
+            'location': rng.choice(SAMPLE_LOCATIONS),
+            'building_size': rng.choice(SAMPLE_BUILDING_SIZES),
+            'primary_hazards': rng.sample(list(HAZARD_CATEGORIES), rng.randint(1, 4)),
+            'special_considerations': rng.sample(SAMPLE_CONSIDERATIONS, rng.randint(0, 2)),
+            'has_security': rng.random() < 0.5,
+            'has_medical_staff': rng.random() < 0.3,
+            'emergency_equipment': rng.sample(SAMPLE_EQUIPMENT, rng.randint(1, 3)),
+            'communication_methods': rng.sample(SAMPLE_COMMUNICATION, rng.randint(1, 3)),
+            'plan_scope': "Standard (Common Hazards)",
+            'additional_requirements': "None",
+            'pdf_password': "Benchmark-Password-1"
+        })
+    return samples
+
+
+def canned_plan(tokens: int) -> str:
+    """A markdown plan of about tokens words, with the ten plan sections."""
+    words_per_section = max(1, tokens // len(PLAN_SECTIONS))
+    filler = "Review the procedure with the emergency coordinator and record the outcome".split()
+    sections = []
+    for section in PLAN_SECTIONS:
+        lines = [f"## {section['number']}. {section['title']}", ""]
+        words = [filler[i % len(filler)] for i in range(words_per_section)]
+        for start in range(0, len(words), len(filler)):
+            lines.append("- " + " ".join(words[start:start + len(filler)]))
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections) + "\n"
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """The p-th percentile of samples, interpolating between the closest ranks."""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples: List[float]) -> Dict:
+    """Latency statistics in milliseconds for samples in seconds."""
+    summary = {f"p{p}": percentile(samples, p) * 1000 for p in PERCENTILES}
+    summary['mean'] = sum(samples) / len(samples) * 1000
+    summary['max'] = max(samples) * 1000
+    summary['count'] = len(samples)
+    return summary
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the progress printing of the code being measured."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+class PipelineBenchmark:
+    def __init__(self, generator_name: str = 'enhanced', organized_data_dir: str = None,
+                 tokens_per_second: float = None, plan_tokens: int = DEFAULT_PLAN_TOKENS,
+                 cold_cache: bool = False):
+        """Set up a generator on the fake model backend."""
+        self.cold_cache = cold_cache
+        self.plan_tokens = plan_tokens
+        self.backend = FakeBackend(reply=canned_plan(plan_tokens), tokens_per_second=tokens_per_second)
+        with quiet():
+            # Without a store given, each generator uses its own (the basic
+            # generator's is organized from the anonymized documents)
+            self.generator = GENERATORS[generator_name](organized_data_dir=organized_data_dir,
+                                                        backend=self.backend)
+        self.organized_data_dir = str(self.generator.organized_data_path)
+        self.input_structuring_system = InputStructuringSystem()
+
+        try:
+            from plan_pdf import create_pdf_from_markdown
+        except ImportError as e:
+            print(f"⚠️ Skipping markdown -> PDF: {e}")
+            create_pdf_from_markdown = None
+        self.create_pdf_from_markdown = create_pdf_from_markdown
+
+        from plan_task_store import PlanTaskStore, TaskStatus
+        self.task_status = TaskStatus
+        self.work_dir = tempfile.TemporaryDirectory(prefix="epos_benchmark_")
+        self.task_store = PlanTaskStore(os.path.join(self.work_dir.name, "plan_queue.db"))
+
+    def measure_loading(self, runs: int) -> List[float]:
+        """Time loading the organized store into a new retrieval engine."""
+        durations = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            with quiet():
+                RetrievalEngine(self.organized_data_dir, data_dir=str(self.generator.document_organizer.data_dir))
+            durations.append(time.perf_counter() - started)
+        return durations
+
+    def run_plan(self, inputs: Dict) -> Dict[str, float]:
+        """Run one plan through every stage, returning each stage's duration in seconds."""
+        timings = {}
+        plan_started = time.perf_counter()
+
+        started = time.perf_counter()
+        structured_inputs = self.input_structuring_system.structure_user_inputs(inputs)
+        timings['input_structuring'] = time.perf_counter() - started
+
+        if self.cold_cache:
+            QUERY_CACHE.clear()
+        with quiet():
+            # Prompt assembly is building the components and packing the context
+            started = time.perf_counter()
+            if isinstance(self.generator, EnhancedEmergencyPlanGeneratorV2):
+                # The v2 prompt is built from the inputs structured above, so
+                # structuring is not timed again here
+                components = self.generator.structured_prompt_components(structured_inputs)
+            else:
+                components = self.generator.prompt_components(inputs)
+            components_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            chunks = self.generator.retrieve_chunks(components)
+            timings['retrieval'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            messages, _ = self.generator.messages_for_chunks(components, components['plan_instructions'], chunks)
+            timings['prompt_assembly'] = components_time + time.perf_counter() - started
+
+        started = time.perf_counter()
+        pieces = []
+        for piece in self.generator.stream_model(messages):
+            if not pieces:
+                timings['first_token'] = time.perf_counter() - started
+            pieces.append(piece)
+        plan_content = "".join(pieces)
+        timings['generation'] = time.perf_counter() - started
+        document = self.generator.plan_header(inputs) + plan_content + self.generator.plan_footer()
+
+        if self.create_pdf_from_markdown:
+            started = time.perf_counter()
+            with quiet():
+                pdf_path = self.create_pdf_from_markdown(document, inputs['pdf_password'],
+                                                         inputs['organization_name'])
+            timings['markdown_to_pdf'] = time.perf_counter() - started
+            if pdf_path:
+                os.remove(pdf_path)
+
+        started = time.perf_counter()
+        task_id = str(uuid.uuid4())
+        self.task_store.insert_task(task_id, "benchmark@example.com", inputs['organization_name'], inputs)
+        self.task_store.update_task_status(task_id, self.task_status.PROCESSING, started_at=datetime.now())
+        self.task_store.update_task_status(task_id, self.task_status.COMPLETED, completed_at=datetime.now(),
+                                           plan_content=document)
+        self.task_store.get_task_status(task_id)
+        self.task_store.get_plan_content(task_id)
+        timings['queue_persistence'] = time.perf_counter() - started
+
+        timings['total'] = time.perf_counter() - plan_started
+        return timings
+
+    def run(self, plans: int, load_runs: int = 3, seed: int = 0) -> Dict:
+        """Run the benchmark and return its report."""
+        print(f"📚 Measuring organizer loading ({load_runs} runs)...")
+        loading = self.measure_loading(load_runs)
+
+        print(f"🚀 Running {plans} plans through the pipeline...")
+        samples = {stage: [] for stage in STAGES}
+        started = time.perf_counter()
+        for number, inputs in enumerate(sample_inputs(plans, seed), 1):
+            for stage, duration in self.run_plan(inputs).items():
+                samples[stage].append(duration)
+            if number % 10 == 0:
+                print(f"  ✓ {number}/{plans} plans")
+        wall_time = time.perf_counter() - started
+
+        model_time = sum(samples['generation'])
+        return {
+            'plans': plans,
+            'wall_time_seconds': wall_time,
+            'plans_per_minute': plans * 60 / wall_time,
+            'pipeline_plans_per_minute': plans * 60 / max(wall_time - model_time, 1e-9),
+            'organizer_loading': summarize(loading),
+            'stages': {stage: summarize(durations) for stage, durations in samples.items() if durations},
+            'query_cache': QUERY_CACHE.stats(),
+            'backend': {
+                'tokens_per_second': self.backend.tokens_per_second,
+                'plan_tokens': self.plan_tokens
+            }
+        }
+
+
+def print_report(report: Dict) -> None:
+    """Print a benchmark report as a table."""
+    print("\n📊 PIPELINE BENCHMARK RESULTS")
+    print("=" * 78)
+    columns = [f"p{p}" for p in PERCENTILES] + ['mean', 'max']
+    print(f"{'Stage':<22}" + "".join(f"{column + ' ms':>11}" for column in columns))
+    print("-" * 78)
+    rows = [('organizer_loading', report['organizer_loading'])] + list(report['stages'].items())
+    for stage, summary in rows:
+        print(f"{stage:<22}" + "".join(f"{summary[column]:>11.2f}" for column in columns))
+    print("-" * 78)
+    print(f"Plans: {report['plans']} in {report['wall_time_seconds']:.2f}s")
+    print(f"Throughput: {report['plans_per_minute']:.1f} plans/min "
+          f"({report['pipeline_plans_per_minute']:.1f} plans/min excluding model time)")
+    cache = report['query_cache']
+    print(f"Query cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plan pipeline with an offline fake model")
+    parser.add_argument("--plans", type=int, default=50, help="Number of plans to run through the pipeline")
+    parser.add_argument("--generator", choices=list(GENERATORS), default="enhanced",
+                        help="Plan generator to benchmark")
+    parser.add_argument("--organized-data-dir", help="Directory containing organized emergency management documents")
+    parser.add_argument("--tokens-per-second", type=float, default=0,
+                        help="Fake model generation rate (0 streams instantly)")
+    parser.add_argument("--plan-tokens", type=int, default=DEFAULT_PLAN_TOKENS,
+                        help="Length of the fake model's canned plan, in tokens")
+    parser.add_argument("--load-runs", type=int, default=3, help="Times to measure loading the organized store")
+    parser.add_argument("--cold-cache", action="store_true",
+                        help="Clear the retrieval cache before every plan")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the sample organizations")
+    parser.add_argument("--output", help="Also write the report as JSON to this file")
+
+    args = parser.parse_args()
+
+    benchmark = PipelineBenchmark(args.generator, args.organized_data_dir, args.tokens_per_second or None,
+                                  args.plan_tokens, args.cold_cache)
+    report = benchmark.run(args.plans, args.load_runs, args.seed)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Report saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
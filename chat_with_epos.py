@@ -12,15 +12,17 @@ Usage:
 import os
 import sys
 from pathlib import Path
-import ollama
 from typing import List, Optional
 import argparse
 
+from llm_backends import LLMBackend, add_backend_arguments, configure_backend, get_default_backend
+
 
 class EPOSChat:
-    def __init__(self, model_name: str = "llama3.2:1b", data_dir: str = None):
+    def __init__(self, model_name: str = "llama3.2:1b", data_dir: str = None, backend: LLMBackend = None):
         """Initialize the EPOS chat system."""
         self.model_name = model_name
+        self.backend = backend or get_default_backend()
         self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "training_materials/processed/all_text/anonymized"
         self.context_documents = []
         self.load_context()
@@ -79,8 +81,8 @@ Please provide a detailed, practical answer based on the emergency management kn
         try:
             prompt = self.create_context_prompt(message)
             
-            response = ollama.chat(
-                model=self.model_name,
+            response = self.backend.chat(
+                self.model_name,
                 messages=[
                     {
                         'role': 'user',
@@ -89,7 +91,7 @@ Please provide a detailed, practical answer based on the emergency management kn
                 ]
             )
             
-            return response['message']['content']
+            return response['content']
             
         except Exception as e:
             return f"Error: {str(e)}"
@@ -146,26 +148,28 @@ def main():
     parser.add_argument("--model", default="llama3.2:1b", help="Ollama model name to use")
     parser.add_argument("--data-dir", help="Directory containing anonymized training data")
     parser.add_argument("--question", help="Ask a single question instead of interactive mode")
+    add_backend_arguments(parser)
     
     args = parser.parse_args()
     
-    # Check if Ollama is running
+    # Check that the model server is running
+    backend = configure_backend(args)
     try:
-        ollama.list()
+        backend.check_connection()
     except Exception as e:
-        print(f"Error: Cannot connect to Ollama. Is it running?")
-        print("Start it with: brew services start ollama")
+        print(f"Error: Cannot connect to the {backend.name} server. Is it running?")
+        print("Start Ollama with: brew services start ollama")
         sys.exit(1)
     
-    # Check if model exists
+    # Check if model exists, when the server can list its models
     try:
-        model_list = ollama.list()
-        if 'models' in model_list:
-            models = [model['name'] for model in model_list['models']]
+        models = backend.list_models()
+        if models is not None:
             if args.model not in models:
                 print(f"Error: Model '{args.model}' not found.")
                 print(f"Available models: {', '.join(models)}")
-                print(f"Download it with: ollama pull {args.model}")
+                if backend.name == 'ollama':
+                    print(f"Download it with: ollama pull {args.model}")
                 sys.exit(1)
         else:
             print(f"Warning: Could not verify model existence. Proceeding with {args.model}")
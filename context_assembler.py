@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+context_assembler.py - Token-budgeted prompt context assembly
+
+Plan prompts are made of fixed sections (system instructions, organization
+guidelines, user inputs) plus retrieved reference passages. The assembler
+charges the fixed sections against a token budget first, then greedily packs
+the highest-scoring passages into whatever is left, skipping passages that
+are near-duplicates of one already selected. Generation time on small local
+models grows with prompt length, so this keeps it bounded.
+"""
+
+import math
+import re
+from typing import Dict, List, Set
+
+from document_chunker import passage_title
+
+# Rough characters-per-token ratio for English text with Llama tokenizers
+CHARS_PER_TOKEN = 4
+
+DEFAULT_PROMPT_TOKEN_BUDGET = 8000
+
+# Word shingles used for near-duplicate detection
+SHINGLE_SIZE = 5
+DUPLICATE_SIMILARITY = 0.8
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of model tokens in text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[int]:
+    """Hashed word n-grams of text, used to compare passages."""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {hash(tuple(words))} if words else set()
+    return {hash(tuple(words[i:i + size])) for i in range(len(words) - size + 1)}
+
+
+def similarity(a: Set[int], b: Set[int]) -> float:
+    """Overlap of two shingle sets, relative to the smaller one."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+class ContextAssembler:
+    def __init__(self, token_budget: int = DEFAULT_PROMPT_TOKEN_BUDGET,
+                 duplicate_similarity: float = DUPLICATE_SIMILARITY):
+        """Initialize the assembler with an overall prompt token budget."""
+        self.token_budget = token_budget
+        self.duplicate_similarity = duplicate_similarity
+
+    def format_passage(self, passage: Dict) -> str:
+        """Format a retrieved passage for the prompt."""
+        return f"=== {passage_title(passage['filename'], passage.get('headings'))} ===\n{passage['text'].strip()}"
+
+    def assemble(self, fixed_sections: Dict[str, str], passages: List[Dict]) -> Dict:
+        """Pack passages into the budget left after the fixed sections.
+
+        passages are retrieval results with 'filename', 'text' and 'score'.
+        Returns {'context': str, 'report': {...}} where the report gives the
+        tokens used by each fixed section and by the context, plus how many
+        passages were included or skipped.
+        """
+        section_tokens = {name: estimate_tokens(text) for name, text in fixed_sections.items()}
+        fixed_tokens = sum(section_tokens.values())
+        context_budget = max(0, self.token_budget - fixed_tokens)
+
+        selected = []
+        selected_shingles = []
+        context_tokens = 0
+        skipped_duplicates = 0
+        skipped_budget = 0
+
+        # Ties are broken by document and chunk so the same passages always
+        # come out in the same order, keeping prompts byte-identical
+        ranked = sorted(passages, key=lambda p: (-p.get('score', 0.0), p.get('doc_id', ''), p.get('chunk', 0)))
+        for passage in ranked:
+            formatted = self.format_passage(passage)
+            # Passages are joined by a blank line
+            tokens = estimate_tokens(formatted) + (1 if selected else 0)
+            if context_tokens + tokens > context_budget:
+                skipped_budget += 1
+                continue
+
+            passage_shingles = shingles(passage['text'])
+            if any(similarity(passage_shingles, seen) >= self.duplicate_similarity
+                   for seen in selected_shingles):
+                skipped_duplicates += 1
+                continue
+
+            selected.append(formatted)
+            selected_shingles.append(passage_shingles)
+            context_tokens += tokens
+
+        section_tokens['context'] = context_tokens
+        report = {
+            'token_budget': self.token_budget,
+            'context_budget': context_budget,
+            'sections': section_tokens,
+            'total_tokens': fixed_tokens + context_tokens,
+            'passages_used': len(selected),
+            'passages_skipped_duplicate': skipped_duplicates,
+            'passages_skipped_budget': skipped_budget
+        }
+        return {'context': "\n\n".join(selected), 'report': report}
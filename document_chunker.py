@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+document_chunker.py - Section and paragraph aware chunking of document text
+
+Documents are split into retrieval chunks at section headings and paragraph
+boundaries. Each chunk records the lineage of headings it falls under (e.g.
+"4.0 Evacuation > 4.2 Fire Evacuation"), so categorization and retrieval
+can work on the passage that actually describes a procedure rather than on
+a fixed-length prefix of the document.
+"""
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Chunks are cut at a paragraph break (a blank line, or a line ending a
+# sentence) once this many bytes have accumulated, or at any line break past
+# twice as many
+CHUNK_TARGET_BYTES = 1500
+
+# A heading only starts a new chunk if the current one already has this much
+# body text; shorter sections are kept together with the next one
+MIN_CHUNK_BYTES = 300
+
+# Extracted PDF text often has no blank lines; a line ending in one of these
+# is treated as the end of a paragraph
+PARAGRAPH_END = '.!?:'
+
+# Stored with chunk descriptors saved for reuse; bump it when a change here
+# splits documents differently
+CHUNKER_VERSION = 1
+
+MAX_HEADING_CHARS = 80
+MAX_HEADING_WORDS = 12
+
+MAX_TITLE_CASE_WORDS = 6
+MINOR_WORDS = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'in', 'of', 'on', 'or', 'the', 'to', '&', '-', '–'}
+TABLE_GAP = '   '
+
+MARKDOWN_HEADING = re.compile(r"^(#{1,6})\s+(.+)$")
+# "4.2 Fire Evacuation", "1.0 Introduction", "Section 3. Roles"
+NUMBERED_HEADING = re.compile(r"^(?:section\s+(\d+)|(\d+(?:\.\d+)+))\.?\s+\S", re.IGNORECASE)
+APPENDIX_HEADING = re.compile(r"^(?:appendix|annex|schedule)\s+[a-z0-9]+\b", re.IGNORECASE)
+# Table of contents entries end in a page number
+TOC_ENTRY = re.compile(r"(?:\.{3,}|\s{2,})\s*\d+$")
+
+
+def detect_heading(line: str, after_break: bool = True) -> Optional[Tuple[int, str]]:
+    """Return (level, title) if a line looks like a section heading.
+    
+    after_break tells whether the previous line ended a paragraph; short
+    Title Case lines are only taken as headings when it did, since otherwise
+    they are usually the wrapped end of a sentence.
+    """
+    title = line.strip()
+    if not title or len(title) > MAX_HEADING_CHARS or TOC_ENTRY.search(title):
+        return None
+
+    match = MARKDOWN_HEADING.match(title)
+    if match:
+        return len(match.group(1)), match.group(2).strip()
+
+    # Sentences, list lead-ins and "Label: value" lines are not headings
+    if title[-1] in '.,;:' or ':' in title or len(title.split()) > MAX_HEADING_WORDS:
+        return None
+
+    match = NUMBERED_HEADING.match(title)
+    if match:
+        title = ' '.join(title.split())
+        if match.group(1):
+            return 1, title
+        # "2.0 Purpose" is a top-level section, "4.1 Scope" a subsection
+        parts = match.group(2).split('.')
+        while len(parts) > 1 and int(parts[-1]) == 0:
+            parts.pop()
+        return len(parts), title
+
+    if APPENDIX_HEADING.match(title):
+        return 1, ' '.join(title.split())
+
+    # Wide gaps mean a table row, not a heading
+    if not title[0].isalpha() or TABLE_GAP in title:
+        return None
+
+    words = title.split()
+    letters = [c for c in title if c.isalpha()]
+    if (len(letters) >= 4 and all(c.isupper() for c in letters)
+            and len(letters) >= 2 * len(words)):
+        return 1, title
+
+    # Short unindented Title Case lines ("Emergency Notification Procedure")
+    if (after_break and not line[0].isspace() and len(words) <= MAX_TITLE_CASE_WORDS
+            and all(word[0].isupper() or word in MINOR_WORDS for word in words)):
+        return 2, title
+    return None
+
+
+def split_into_sections(content: str, target_bytes: int = CHUNK_TARGET_BYTES) -> List[Dict]:
+    """Split a document into chunks of its UTF-8 encoding.
+
+    Returns [{'start', 'end', 'headings'}] where start/end are byte offsets
+    and headings is the heading lineage the chunk belongs to, outermost
+    first. Cuts only fall at line boundaries, which never occur inside a
+    multi-byte character, so every range decodes on its own.
+    """
+    data = content.encode('utf-8')
+    chunks = []
+    # Open headings as (level, title), outermost first
+    heading_stack = []
+
+    start = 0
+    body_bytes = 0
+    chunk_headings = []
+    position = 0
+    after_break = True
+
+    def flush(end: int) -> None:
+        if data[start:end].strip():
+            chunks.append({'start': start, 'end': end, 'headings': chunk_headings})
+
+    while position < len(data):
+        newline = data.find(b'\n', position)
+        line_end = len(data) if newline == -1 else newline + 1
+        line = data[position:line_end].decode('utf-8')
+        heading = detect_heading(line, after_break)
+
+        if heading:
+            if body_bytes >= MIN_CHUNK_BYTES:
+                flush(position)
+                start = position
+                body_bytes = 0
+            level, title = heading
+            while heading_stack and heading_stack[-1][0] >= level:
+                heading_stack.pop()
+            heading_stack.append((level, title))
+            if not body_bytes:
+                chunk_headings = [title for _, title in heading_stack]
+            position = line_end
+            after_break = True
+            continue
+
+        stripped = line.strip()
+        is_blank = not stripped
+        if not is_blank:
+            if not body_bytes:
+                chunk_headings = [title for _, title in heading_stack]
+            body_bytes += line_end - position
+        position = line_end
+        ends_paragraph = is_blank or stripped[-1] in PARAGRAPH_END
+        after_break = ends_paragraph
+
+        size = position - start
+        if (size >= target_bytes and ends_paragraph) or size >= 2 * target_bytes:
+            flush(position)
+            start = position
+            body_bytes = 0
+
+    flush(len(data))
+    return chunks
+
+
+def passage_title(filename: str, headings: List[str] = None) -> str:
+    """Title shown above a passage in prompts: the file and its heading lineage."""
+    if headings:
+        return f"{filename} > {' > '.join(headings)}"
+    return filename
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+document_content_store.py - Memory-mapped storage for organized document bodies
+
+Document text is written once as a single concatenated UTF-8 blob. The
+organized document index keeps each document's byte offset and length, so
+readers can memory-map the blob and decode only the slice they need instead
+of loading every document into memory at start-up.
+"""
+
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+CONTENT_BLOB_FILENAME = "document_contents.bin"
+
+# Upper bound of UTF-8 bytes per character, used to size partial reads
+MAX_UTF8_BYTES_PER_CHAR = 4
+
+
+class DocumentContentStore:
+    def __init__(self, blob_path: str):
+        """Open a content blob written by DocumentContentStore.write for reading."""
+        self.blob_path = Path(blob_path)
+        self._file = open(self.blob_path, 'rb')
+        if self.blob_path.stat().st_size:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap cannot map an empty file
+            self._data = b''
+
+    @staticmethod
+    def write(output_dir: str, contents: Dict[str, str]) -> Dict[str, Tuple[int, int]]:
+        """Write document bodies to a blob in output_dir.
+
+        Returns {doc_id: (byte_offset, byte_length)} for the index.
+        """
+        blob_path = Path(output_dir) / CONTENT_BLOB_FILENAME
+        temp_path = blob_path.with_suffix('.tmp')
+        offsets = {}
+        position = 0
+
+        with open(temp_path, 'wb') as f:
+            for doc_id, content in contents.items():
+                data = content.encode('utf-8')
+                f.write(data)
+                offsets[doc_id] = (position, len(data))
+                position += len(data)
+
+        # Replace rather than truncate so open maps of the old blob stay valid
+        os.replace(temp_path, blob_path)
+        return offsets
+
+    def get_text(self, offset: int, length: int, max_chars: Optional[int] = None) -> str:
+        """Decode a document, or only its first max_chars characters."""
+        if max_chars is not None:
+            length = min(length, max_chars * MAX_UTF8_BYTES_PER_CHAR)
+            # A byte cut may split the last character; drop the partial bytes
+            return self._data[offset:offset + length].decode('utf-8', errors='ignore')[:max_chars]
+        return self._data[offset:offset + length].decode('utf-8')
+
+    def close(self) -> None:
+        """Release the memory map and file handle."""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
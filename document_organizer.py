@@ -11,301 +11,829 @@ This organization will improve the accuracy of plan outputs by providing
 more targeted context based on the specific needs of each organization.
 """
 
+import argparse
+import copy
+import hashlib
 import json
+import os
 import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Tuple
 from datetime import datetime
 
+from document_chunker import CHUNKER_VERSION, passage_title, split_into_sections
+from document_content_store import CONTENT_BLOB_FILENAME, DocumentContentStore
+from embedding_index import (DEFAULT_EMBED_TIMEOUT, EMBEDDING_BACKENDS, EmbeddingIndex, chunk_fingerprint,
+                             create_embedder)
+from query_cache import QueryCache
+from search_index import SEARCH_INDEX_FILENAME, BM25Index, load_search_index, save_search_index, tokenize
+
+# ============================================================================
+# KEYWORD TABLES
+# ============================================================================
+
+# Each category is matched if any of its terms appears anywhere in the
+# lowercased document text (plain substring semantics).
+
+HAZARD_TERMS = {
+    # Natural hazards
+    'earthquake': ['earthquake', 'seismic', 'tremor'],
+    'flood': ['flood', 'flooding', 'water damage'],
+    'fire': ['fire', 'wildfire', 'wildland fire'],
+    'severe_weather': ['storm', 'hurricane', 'tornado', 'severe weather'],
+    'power_outage': ['power outage', 'electrical failure', 'blackout'],
+    # Technological hazards
+    'chemical_spill': ['chemical spill', 'hazardous material', 'hazmat'],
+    'cyber_attack': ['cyber attack', 'digital threat', 'computer security'],
+    'equipment_failure': ['equipment failure', 'mechanical failure'],
+    # Human-caused hazards
+    'workplace_violence': ['workplace violence', 'active shooter', 'security threat'],
+    'medical_emergency': ['medical emergency', 'health emergency', 'injury'],
+    'transportation_accident': ['transportation accident', 'vehicle accident'],
+    'infectious_disease': ['infectious disease', 'pandemic', 'outbreak'],
+}
+
+ORGANIZATION_TYPE_TERMS = {
+    'educational': ['university', 'college', 'school', 'campus', 'student', 'faculty'],
+    'healthcare': ['hospital', 'healthcare', 'medical', 'patient', 'clinic'],
+    'government': ['government', 'municipal', 'city', 'provincial', 'federal'],
+    'corporate': ['corporate', 'business', 'office', 'company', 'workplace'],
+    'industrial': ['manufacturing', 'industrial', 'plant', 'factory', 'production'],
+    'retail': ['retail', 'store', 'commercial', 'shopping'],
+    'non_profit': ['non-profit', 'nonprofit', 'charity', 'volunteer'],
+}
+
+PROCEDURE_TERMS = {
+    'evacuation': ['evacuation', 'evacuate', 'exit', 'egress'],
+    'communication': ['communication', 'notification', 'alert', 'emergency contact'],
+    'medical_response': ['first aid', 'medical response', 'emergency medical'],
+    'security': ['security', 'lockdown', 'access control'],
+    'transportation': ['transportation', 'bussing', 'vehicle', 'transit'],
+    'working_alone': ['working alone', 'lone worker', 'solo work'],
+    'heat_interruption': ['heat interruption', 'heating', 'temperature'],
+    'hazardous_materials': ['hazardous material', 'chemical spill', 'hazmat'],
+    'infectious_disease': ['infectious disease', 'infection control', 'outbreak'],
+}
+
+COMPREHENSIVE_PLAN_TERMS = {
+    'comprehensive_plan': [
+        'emergency plan', 'emergency response plan', 'emergency preparedness',
+        'comprehensive emergency', 'emergency management plan',
+        'disaster response plan', 'crisis management plan'
+    ],
+}
+
+# Checked in order by get_plan_type; the first plan type with a hit wins
+PLAN_TYPE_TERMS = {
+    'educational': ['university', 'ubc', 'college'],
+    'healthcare': ['healthcare', 'medical', 'hospital'],
+    'government': ['government', 'city', 'municipal'],
+    'corporate': ['corporate', 'business', 'office'],
+    'industrial': ['manufacturing', 'industrial', 'plant'],
+}
+
+PLAN_FILENAME_INDICATORS = ['emergency plan', 'erp', 'emergency preparedness']
+
+
+class KeywordScanner:
+    """Multi-pattern keyword matcher that classifies a document in a single pass.
+    
+    All terms from every table are compiled into one trie-shaped regular
+    expression wrapped in a lookahead, so the text is traversed once and
+    overlapping matches (e.g. "fire" inside "wildfire") are still reported,
+    like an Aho-Corasick automaton. At each position only the longest term is
+    captured; the shorter terms that are prefixes of it are credited from a
+    precomputed table.
+    """
+    
+    def __init__(self, tables: Dict[str, Dict[str, List[str]]]):
+        self.tables = tables
+        
+        # term -> [(table, category), ...]
+        term_categories = {}
+        for table, categories in tables.items():
+            for category, terms in categories.items():
+                for term in terms:
+                    term_categories.setdefault(term, []).append((table, category))
+        
+        # matched term -> every (table, category) hit implied by it, including
+        # shorter terms that are prefixes of the matched one
+        self.term_hits = {}
+        for term in term_categories:
+            hits = []
+            for other, other_categories in term_categories.items():
+                if term.startswith(other):
+                    hits.extend(other_categories)
+            self.term_hits[term] = hits
+        
+        first_chars = ''.join(sorted({re.escape(term[0]) for term in term_categories}))
+        self.pattern = re.compile(
+            f"(?=[{first_chars}])(?=({self._build_trie_pattern(term_categories)}))"
+        )
+    
+    @staticmethod
+    def _build_trie_pattern(terms) -> str:
+        """Build a regex alternation shaped like a prefix trie of the given terms."""
+        trie = {}
+        for term in terms:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        
+        def build(node: Dict) -> str:
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            # Greedy optional keeps the longest term when a shorter one ends here
+            return f"(?:{pattern})?" if '' in node else pattern
+        
+        return build(trie)
+    
+    def scan(self, content_lower: str) -> Dict[str, Dict[str, int]]:
+        """Return {table: {category: match_count}} for every category with at least one hit.
+        
+        Categories are listed in table order so callers get the same ordering
+        as the keyword tables.
+        """
+        counts = {}
+        term_hits = self.term_hits
+        for match in self.pattern.finditer(content_lower):
+            for hit in term_hits[match.group(1)]:
+                counts[hit] = counts.get(hit, 0) + 1
+        
+        results = {}
+        for table, categories in self.tables.items():
+            results[table] = {
+                category: counts[(table, category)]
+                for category in categories
+                if (table, category) in counts
+            }
+        return results
+
+
+KEYWORD_SCANNER = KeywordScanner({
+    'comprehensive_plans': COMPREHENSIVE_PLAN_TERMS,
+    'plan_types': PLAN_TYPE_TERMS,
+    'hazards': HAZARD_TERMS,
+    'organization_types': ORGANIZATION_TYPE_TERMS,
+    'procedures': PROCEDURE_TERMS,
+})
+
+# Stored in the manifest; editing any keyword table invalidates cached categories
+CLASSIFIER_VERSION = hashlib.sha256(
+    json.dumps([KEYWORD_SCANNER.tables, PLAN_FILENAME_INDICATORS], sort_keys=True).encode('utf-8')
+).hexdigest()[:16]
+
+MANIFEST_FILENAME = "document_manifest.json"
+ORGANIZED_FILENAME = "organized_documents.json"
+
+# organized_documents.json layout version. Version 1 repeated the full
+# document under every category it matched, version 2 stored each body once
+# inline, version 3 keeps bodies in the memory-mapped content blob.
+ORGANIZED_FORMAT_VERSION = 3
+
+# Number of ranked chunks get_relevant_context returns by default
+DEFAULT_CONTEXT_TOP_K = 8
+
+# search() re-ranks this many BM25 candidates per requested result, boosting
+# chunks whose own categories match the requested hazards and procedures
+SEARCH_CANDIDATE_FACTOR = 4
+CHUNK_CATEGORY_BOOST = 0.25
+
+# With an embedder configured, keyword and semantic rankings are merged by
+# reciprocal rank fusion with this constant
+RANK_FUSION_K = 60
+
+# Categories assigned to individual chunks
+CHUNK_CATEGORIES = ('hazards', 'organization_types', 'procedures')
+
+# Retrieval results shared by every organizer in the process. Keys include
+# the organizer's store_version, so a changed store never gets stale results.
+QUERY_CACHE = QueryCache()
+
+
 class DocumentOrganizer:
-    def __init__(self, data_dir: str = None):
-        """Initialize the Document Organizer."""
+    def __init__(self, data_dir: str = None, workers: int = 1, output_dir: str = None, embedder=None):
+        """Initialize the Document Organizer.
+        
+        workers controls how many processes categorize_documents uses;
+        0 means one per CPU core. output_dir is where the organization and
+        its manifest are saved and where previous results are looked up.
+        embedder (see embedding_index.create_embedder) enables semantic
+        retrieval alongside keyword search.
+        """
         self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "training_materials/processed/all_text/raw_text"
+        self.output_dir = Path(output_dir) if output_dir else Path(__file__).parent / "training_materials" / "organized"
+        self.workers = workers
+        self.manifest = {}
+        # Category -> subcategory -> list of document ids (posting lists)
         self.organized_docs = {
             'hazards': {},
             'organization_types': {},
             'procedures': {},
             'comprehensive_plans': {}
         }
+        # Document id -> {'filename', 'content', 'metadata'}, stored once. When
+        # loaded from disk 'content' is replaced by an offset/length into
+        # self.content_store.
+        self.documents = {}
+        self.content_store = None
         self.document_metadata = {}
-        
-    def categorize_documents(self) -> Dict:
-        """Categorize all documents by type and content."""
+        # Document id -> UTF-8 bytes of an in-memory document, encoded once
+        # for slicing its chunks' byte ranges
+        self._content_bytes = {}
+        # Retrieval chunks ({'doc_id', 'start', 'end', 'headings', 'categories'},
+        # start/end being byte ranges), their index, and chunk posting lists
+        # by category like organized_docs
+        self.chunks = []
+        self.search_index = None
+        self.organized_chunks = {category: {} for category in CHUNK_CATEGORIES}
+        self.embedder = embedder
+        self.embedding_index = None
+        # Identifies the documents currently held, for cache keys. Stores
+        # loaded from disk are identified by their files' size and mtime so
+        # organizers loading the same store share cached results.
+        self.store_version = uuid.uuid4().hex
+        
+    def categorize_documents(self, workers: int = None, incremental: bool = True) -> Dict:
+        """Categorize all documents by type and content.
+        
+        With workers > 1 the files are read and analyzed in a process pool;
+        results are merged in filename order so the output is identical to a
+        serial run. Defaults to the worker count given at construction.
+        
+        When incremental, the manifest saved by a previous run is consulted and
+        only added or changed files are re-analyzed; deleted files are dropped.
+        """
         print("🔍 Analyzing and categorizing emergency management documents...")
         
         if not self.data_dir.exists():
             print(f"Error: Data directory not found: {self.data_dir}")
             return {}
             
-        txt_files = list(self.data_dir.glob("*.txt"))
+        txt_files = sorted(self.data_dir.glob("*.txt"))
         txt_files = [f for f in txt_files if not f.name.startswith("anonymization_")]
         
+        workers = workers if workers is not None else self.workers
+        if workers is not None and workers <= 0:
+            workers = os.cpu_count() or 1
+        
         print(f"Found {len(txt_files)} documents to categorize...")
         
+        previous_manifest = self.load_manifest() if incremental else {}
+        
+        # Reuse categories for files whose size/mtime or content hash is unchanged
+        results = {}
+        changed_files = []
         for file_path in txt_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Analyze and categorize the document
-                categories = self.analyze_document(file_path.name, content)
-                self.document_metadata[file_path.name] = categories
-                
-                # Store document in appropriate categories
-                for category, subcategory in categories.items():
-                    if category in self.organized_docs:
-                        if isinstance(subcategory, list):
-                            # Handle list of subcategories
-                            for sub in subcategory:
-                                if sub not in self.organized_docs[category]:
-                                    self.organized_docs[category][sub] = []
-                                self.organized_docs[category][sub].append({
-                                    'filename': file_path.name,
-                                    'content': content,
-                                    'metadata': categories
-                                })
-                        else:
-                            # Handle single subcategory
-                            if subcategory not in self.organized_docs[category]:
-                                self.organized_docs[category][subcategory] = []
-                            self.organized_docs[category][subcategory].append({
-                                'filename': file_path.name,
-                                'content': content,
-                                'metadata': categories
-                            })
-                
-            except Exception as e:
-                print(f"  ✗ Error processing {file_path.name}: {e}")
+            reused = self._reuse_manifest_entry(file_path, previous_manifest.get(file_path.name))
+            if reused:
+                results[file_path.name] = reused
+            else:
+                changed_files.append(file_path)
+        
+        if previous_manifest:
+            removed = set(previous_manifest) - {f.name for f in txt_files}
+            print(f"♻️  Reusing {len(results)} unchanged documents, analyzing {len(changed_files)}, "
+                  f"dropping {len(removed)} removed")
+        
+        if workers and workers > 1 and len(changed_files) > 1:
+            print(f"Using {workers} worker processes...")
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                analyzed = list(executor.map(_load_and_analyze, [str(f) for f in changed_files]))
+        else:
+            analyzed = [_load_and_analyze(str(f), self) for f in changed_files]
+        
+        for file_path, (filename, content, categories, error) in zip(changed_files, analyzed):
+            if error:
+                print(f"  ✗ Error processing {filename}: {error}")
+                continue
+            stat = file_path.stat()
+            results[filename] = (content, {
+                'path': str(file_path),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+                'categories': categories
+            })
+        
+        # Rebuild the organization from scratch in filename order
+        self.organized_docs = {category: {} for category in self.organized_docs}
+        self.documents = {}
+        self._content_bytes = {}
+        self.document_metadata = {}
+        self.manifest = {}
+        for file_path in txt_files:
+            if file_path.name not in results:
+                continue
+            content, entry = results[file_path.name]
+            self.manifest[file_path.name] = entry
+            self.document_metadata[file_path.name] = entry['categories']
+            self.add_document(file_path.name, content, entry['categories'])
+        
+        # Split changed documents into sections and categorize each one;
+        # unchanged ones keep the sections recorded in their manifest entry
+        self.build_search_index(reuse_chunks=True)
+        print(f"🧩 Split documents into {len(self.chunks)} sections")
         
         return self.organized_docs
     
+    def load_manifest(self) -> Dict:
+        """Load the manifest saved by a previous run, or {} if missing or stale."""
+        manifest_file = self.output_dir / MANIFEST_FILENAME
+        if not manifest_file.exists():
+            return {}
+        
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Error loading document manifest: {e}")
+            return {}
+        
+        if manifest.get('classifier_version') != CLASSIFIER_VERSION:
+            print("🔄 Keyword tables changed since the last run, re-analyzing all documents")
+            return {}
+        documents = manifest.get('documents', {})
+        if manifest.get('chunker_version') != CHUNKER_VERSION:
+            # Document categories still hold; their sections must be split again
+            documents = {name: {key: value for key, value in entry.items() if key != 'chunks'}
+                         for name, entry in documents.items()}
+        return documents
+    
+    def _reuse_manifest_entry(self, file_path: Path, entry: Optional[Dict]) -> Optional[Tuple[str, Dict]]:
+        """Return (content, entry) if the file is unchanged since entry was recorded."""
+        if not entry:
+            return None
+        
+        try:
+            stat = file_path.stat()
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception:
+            return None
+        
+        if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            return content, entry
+        
+        # Touched but possibly identical: compare content hashes
+        if hashlib.sha256(content.encode('utf-8')).hexdigest() == entry['sha256']:
+            return content, dict(entry, path=str(file_path), size=stat.st_size, mtime=stat.st_mtime)
+        return None
+    
+    def add_document(self, filename: str, content: str, categories: Dict) -> None:
+        """Store an analyzed document once and list its id under each of its categories."""
+        doc_id = filename
+        self.store_version = uuid.uuid4().hex
+        self._content_bytes.pop(doc_id, None)
+        self.documents[doc_id] = {
+            'filename': filename,
+            'content': content,
+            'metadata': categories
+        }
+        
+        for category, subcategory in categories.items():
+            if category in self.organized_docs:
+                # Single subcategories (comprehensive plan type) are stored like lists
+                subcategories = subcategory if isinstance(subcategory, list) else [subcategory]
+                for sub in subcategories:
+                    if sub not in self.organized_docs[category]:
+                        self.organized_docs[category][sub] = []
+                    self.organized_docs[category][sub].append(doc_id)
+    
+    def get_content(self, doc_id: str, max_chars: int = None) -> str:
+        """Get a document's text, reading only the first max_chars characters if given."""
+        doc = self.documents[doc_id]
+        if 'content' in doc:
+            return doc['content'] if max_chars is None else doc['content'][:max_chars]
+        return self.content_store.get_text(doc['offset'], doc['length'], max_chars)
+    
+    def get_documents(self, category: str, subcategory: str) -> List[Dict]:
+        """Get the documents filed under a category/subcategory."""
+        doc_ids = self.organized_docs.get(category, {}).get(subcategory, [])
+        return [self.documents[doc_id] for doc_id in doc_ids if doc_id in self.documents]
+    
+    def get_chunks(self, category: str, subcategory: str) -> List[Dict]:
+        """Get the chunks categorized under a category/subcategory, with their text."""
+        if self.search_index is None:
+            self.build_search_index()
+        return [dict(self.chunks[chunk_number], text=self.get_chunk_text(self.chunks[chunk_number]))
+                for chunk_number in self.organized_chunks.get(category, {}).get(subcategory, [])]
+    
+    def load_organization(self, input_dir: str = None) -> bool:
+        """Load organized documents saved by save_organization.
+        
+        Files in the original layout (full documents repeated per category)
+        are normalized on load. Returns False if there is nothing to load.
+        """
+        organized_file = (Path(input_dir) if input_dir else self.output_dir) / ORGANIZED_FILENAME
+        if not organized_file.exists():
+            return False
+        
+        with open(organized_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        self.organized_docs = {category: {} for category in self.organized_docs}
+        self.documents = {}
+        self._content_bytes = {}
+        if self.content_store:
+            self.content_store.close()
+            self.content_store = None
+        
+        format_version = data.get('format_version', 1)
+        if format_version >= 2:
+            self.documents = data['documents']
+            for category, subcategories in data['categories'].items():
+                self.organized_docs[category] = subcategories
+            if format_version >= 3:
+                self.content_store = DocumentContentStore(str(organized_file.parent / CONTENT_BLOB_FILENAME))
+        else:
+            for category, subcategories in data.items():
+                self.organized_docs[category] = {}
+                for subcategory, docs in subcategories.items():
+                    self.organized_docs[category][subcategory] = [doc['filename'] for doc in docs]
+                    for doc in docs:
+                        self.documents.setdefault(doc['filename'], doc)
+        
+        self.document_metadata = {
+            doc_id: doc.get('metadata', {}) for doc_id, doc in self.documents.items()
+        }
+        
+        # The search index is rebuilt on first use if it was not saved (or
+        # was saved in an older format)
+        self.chunks = []
+        self.search_index = None
+        self.organized_chunks = {category: {} for category in CHUNK_CATEGORIES}
+        self.embedding_index = None
+        if (organized_file.parent / SEARCH_INDEX_FILENAME).exists():
+            self.chunks, self.search_index = load_search_index(str(organized_file.parent))
+            self._index_chunk_categories()
+            if self.embedder is not None and self.search_index is not None:
+                self.embedding_index = EmbeddingIndex.load(str(organized_file.parent), self.embedder.model_name,
+                                                           chunk_fingerprint(self.chunks))
+        
+        self.store_version = self._store_stamp(organized_file.parent)
+        return True
+    
+    def _store_stamp(self, input_path: Path) -> str:
+        """Identify a saved store by its location and its files' size and mtime."""
+        parts = [str(input_path.resolve())]
+        for filename in (ORGANIZED_FILENAME, CONTENT_BLOB_FILENAME, SEARCH_INDEX_FILENAME):
+            path = input_path / filename
+            if path.exists():
+                stat = path.stat()
+                parts.append(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}")
+        return "|".join(parts)
+    
+    def build_search_index(self, reuse_chunks: bool = False) -> BM25Index:
+        """Split every document into sections, categorize them and index them with BM25.
+        
+        With reuse_chunks, documents whose manifest entry already records
+        their sections (byte ranges, headings, categories) keep them, and only
+        the BM25 postings are rebuilt from their text. Sections of the other
+        documents are recorded in their manifest entries.
+        """
+        self.chunks = []
+        chunk_tokens = []
+        for doc_id in self.documents:
+            content = self.get_content(doc_id)
+            data = content.encode('utf-8')
+            entry = self.manifest.get(doc_id)
+            sections = entry.get('chunks') if reuse_chunks and entry else None
+            if sections is None:
+                sections = []
+                for section in split_into_sections(content):
+                    text = self.get_chunk_search_text(section, data[section['start']:section['end']].decode('utf-8'))
+                    section['categories'] = self.analyze_chunk(text)
+                    sections.append(section)
+                if entry is not None:
+                    entry['chunks'] = sections
+            
+            for section in sections:
+                chunk = dict(section, doc_id=doc_id)
+                text = self.get_chunk_search_text(chunk, data[chunk['start']:chunk['end']].decode('utf-8'))
+                self.chunks.append(chunk)
+                chunk_tokens.append(tokenize(text))
+        
+        self.search_index = BM25Index.build(chunk_tokens)
+        self._index_chunk_categories()
+        self.embedding_index = None
+        return self.search_index
+    
+    def build_embedding_index(self) -> Optional[EmbeddingIndex]:
+        """Embed every chunk with the configured embedder.
+        
+        If embedding fails (NumPy missing, model not available) semantic
+        retrieval is switched off and None is returned.
+        """
+        if self.search_index is None:
+            self.build_search_index()
+        
+        print(f"🧠 Embedding {len(self.chunks)} sections with {self.embedder.model_name}...")
+        try:
+            self.embedding_index = EmbeddingIndex.build(
+                [self.get_chunk_search_text(chunk) for chunk in self.chunks],
+                self.embedder, chunk_fingerprint(self.chunks))
+        except Exception as e:
+            print(f"⚠️ Semantic search disabled, using keyword search only: {e}")
+            self.disable_semantic_search()
+        return self.embedding_index
+    
+    def disable_semantic_search(self) -> None:
+        """Drop the embedder and embedding index, leaving keyword search."""
+        self.embedder = None
+        self.embedding_index = None
+    
+    def _index_chunk_categories(self) -> None:
+        """Rebuild the chunk posting lists from the chunk descriptors."""
+        self.organized_chunks = {category: {} for category in CHUNK_CATEGORIES}
+        for chunk_number, chunk in enumerate(self.chunks):
+            for category, subcategories in chunk.get('categories', {}).items():
+                for sub in subcategories:
+                    self.organized_chunks[category].setdefault(sub, []).append(chunk_number)
+    
+    def get_chunk_search_text(self, chunk: Dict, text: str = None) -> str:
+        """Get the text a chunk is indexed by: its heading lineage and body."""
+        if text is None:
+            text = self.get_chunk_text(chunk)
+        # Headings are part of what a chunk is about
+        return "\n".join(chunk['headings'] + [text])
+    
+    def get_chunk_text(self, chunk: Dict) -> str:
+        """Get the text of a retrieval chunk."""
+        doc = self.documents[chunk['doc_id']]
+        if 'content' in doc:
+            data = self._content_bytes.get(chunk['doc_id'])
+            if data is None:
+                data = self._content_bytes[chunk['doc_id']] = doc['content'].encode('utf-8')
+            return data[chunk['start']:chunk['end']].decode('utf-8')
+        return self.content_store.get_text(doc['offset'] + chunk['start'], chunk['end'] - chunk['start'])
+    
+    def build_query(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                    free_text: str = None) -> List[str]:
+        """Turn retrieval criteria into query tokens.
+        
+        Known category keys expand to their keyword table terms; anything
+        else (and free_text) is tokenized as written.
+        """
+        query = []
+        criteria = [(ORGANIZATION_TYPE_TERMS, organization_type)]
+        criteria += [(HAZARD_TERMS, hazard) for hazard in hazards or []]
+        criteria += [(PROCEDURE_TERMS, procedure) for procedure in procedures or []]
+        
+        for table, key in criteria:
+            if not key:
+                continue
+            for term in table.get(key, [key]):
+                query.extend(tokenize(term.replace('_', ' ')))
+        
+        if free_text:
+            query.extend(tokenize(free_text))
+        return query
+    
+    def search(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+               free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> List[Dict]:
+        """Return the top_k chunks ranked by relevance to the criteria.
+        
+        Chunks are ranked by BM25, boosted for each requested hazard,
+        procedure or organization type the chunk itself is categorized under.
+        With an embedder configured, that ranking is fused with the chunks'
+        semantic similarity to the criteria, which catches synonyms the
+        keyword tables miss.
+        
+        Results are the caller's own copies; changing them does not change
+        the cached results or the index.
+        """
+        self._ensure_indexes()
+        hazards, procedures, free_text = normalize_criteria(hazards, procedures, free_text)
+        cache_key = self._cache_key('search', organization_type, hazards, procedures, free_text, top_k)
+        cached = QUERY_CACHE.get(cache_key)
+        if cached is not None:
+            return copy.deepcopy(list(cached))
+        
+        results = self._search(organization_type, hazards, procedures, free_text, top_k)
+        QUERY_CACHE.put(cache_key, tuple(copy.deepcopy(results)))
+        return results
+    
+    def _search(self, organization_type: str, hazards: List[str], procedures: List[str],
+                free_text: Optional[str], top_k: int) -> List[Dict]:
+        """Rank chunks for criteria normalized by normalize_criteria, without the cache."""
+        query = self.build_query(organization_type, hazards, procedures, free_text)
+        wanted = {
+            'hazards': set(hazards),
+            'organization_types': {organization_type} if organization_type else set(),
+            'procedures': set(procedures)
+        }
+        
+        ranked = []
+        for chunk_number, score in self.search_index.search(query, top_k * SEARCH_CANDIDATE_FACTOR):
+            categories = self.chunks[chunk_number].get('categories', {})
+            matches = sum(len(wanted[category] & set(categories.get(category, []))) for category in wanted)
+            ranked.append((chunk_number, score * (1 + CHUNK_CATEGORY_BOOST * matches)))
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        
+        # Local references: another thread may disable semantic search meanwhile
+        embedder, embedding_index = self.embedder, self.embedding_index
+        if embedder is not None and embedding_index is not None:
+            criteria = [organization_type] + hazards + procedures + [free_text]
+            query_text = " ".join(term.replace('_', ' ') for term in criteria if term)
+            try:
+                query_vector = embedder.embed([query_text])[0]
+            except Exception as e:
+                # The embedding server went away after the index was built
+                print(f"⚠️ Semantic search disabled, using keyword search only: {e}")
+                self.disable_semantic_search()
+            else:
+                semantic = embedding_index.search(query_vector, top_k * SEARCH_CANDIDATE_FACTOR)
+                ranked = fuse_rankings([ranked, semantic])
+        
+        results = []
+        for chunk_number, score in ranked[:top_k]:
+            chunk = self.chunks[chunk_number]
+            results.append({
+                'doc_id': chunk['doc_id'],
+                'filename': self.documents[chunk['doc_id']]['filename'],
+                'chunk': chunk_number,
+                'headings': list(chunk.get('headings', [])),
+                'categories': copy.deepcopy(chunk.get('categories', {})),
+                'score': score,
+                'text': self.get_chunk_text(chunk)
+            })
+        return results
+    
+    def _ensure_indexes(self) -> None:
+        """Build the search (and embedding) index if they were not loaded."""
+        if self.search_index is None:
+            self.build_search_index()
+        if self.embedder is not None and self.embedding_index is None:
+            self.build_embedding_index()
+    
+    def _cache_key(self, kind: str, organization_type: str, hazards: List[str], procedures: List[str],
+                   free_text: Optional[str], top_k: int) -> Tuple:
+        """Key for QUERY_CACHE, from criteria normalized by normalize_criteria."""
+        # Semantic search changes the ranking, so the embedding model is part of the key
+        embedding_model = self.embedder.model_name if self.embedding_index is not None else None
+        return (kind, self.store_version, embedding_model, organization_type,
+                tuple(hazards), tuple(procedures), free_text, top_k)
+    
+    def get_cache_stats(self) -> Dict:
+        """Hit/miss counters of the retrieval cache shared by all organizers."""
+        return QUERY_CACHE.stats()
+    
     def analyze_document(self, filename: str, content: str) -> Dict:
         """Analyze a document and determine its categories."""
         content_lower = content.lower()
         categories = {}
         
+        # Scan the document once for every keyword table
+        keyword_hits = self.scan_keywords(content_lower)
+        
         # Determine if it's a comprehensive plan
-        if self.is_comprehensive_plan(filename, content_lower):
-            categories['comprehensive_plans'] = self.get_plan_type(filename, content_lower)
+        if self.is_comprehensive_plan(filename, content_lower, keyword_hits):
+            categories['comprehensive_plans'] = self.get_plan_type(filename, content_lower, keyword_hits)
         
         # Identify hazards addressed
-        hazards = self.identify_hazards(content_lower)
+        hazards = self.identify_hazards(content_lower, keyword_hits)
         if hazards:
             categories['hazards'] = hazards
         
         # Identify organization types
-        org_types = self.identify_organization_types(filename, content_lower)
+        org_types = self.identify_organization_types(filename, content_lower, keyword_hits)
         if org_types:
             categories['organization_types'] = org_types
         
         # Identify procedures
-        procedures = self.identify_procedures(filename, content_lower)
+        procedures = self.identify_procedures(filename, content_lower, keyword_hits)
         if procedures:
             categories['procedures'] = procedures
         
         return categories
     
-    def is_comprehensive_plan(self, filename: str, content_lower: str) -> bool:
+    def analyze_chunk(self, text: str) -> Dict[str, List[str]]:
+        """Determine the hazards, organization types and procedures a chunk covers."""
+        keyword_hits = self.scan_keywords(text.lower())
+        return {category: list(keyword_hits[category]) for category in CHUNK_CATEGORIES
+                if keyword_hits[category]}
+    
+    def scan_keywords(self, content_lower: str) -> Dict[str, Dict[str, int]]:
+        """Classify a lowercased document in one pass, returning match counts per category."""
+        return KEYWORD_SCANNER.scan(content_lower)
+    
+    def is_comprehensive_plan(self, filename: str, content_lower: str, keyword_hits: Dict = None) -> bool:
         """Determine if document is a comprehensive emergency plan."""
-        comprehensive_indicators = [
-            'emergency plan', 'emergency response plan', 'emergency preparedness',
-            'comprehensive emergency', 'emergency management plan',
-            'disaster response plan', 'crisis management plan'
-        ]
-        
-        filename_indicators = ['emergency plan', 'erp', 'emergency preparedness']
-        
         # Check filename
-        for indicator in filename_indicators:
+        for indicator in PLAN_FILENAME_INDICATORS:
             if indicator in filename.lower():
                 return True
         
         # Check content
-        for indicator in comprehensive_indicators:
-            if indicator in content_lower:
-                return True
-        
-        return False
+        if keyword_hits is None:
+            keyword_hits = self.scan_keywords(content_lower)
+        return bool(keyword_hits['comprehensive_plans'])
     
-    def get_plan_type(self, filename: str, content_lower: str) -> str:
+    def get_plan_type(self, filename: str, content_lower: str, keyword_hits: Dict = None) -> str:
         """Determine the type of comprehensive plan."""
-        if 'university' in content_lower or 'ubc' in content_lower or 'college' in content_lower:
-            return 'educational'
-        elif 'healthcare' in content_lower or 'medical' in content_lower or 'hospital' in content_lower:
-            return 'healthcare'
-        elif 'government' in content_lower or 'city' in content_lower or 'municipal' in content_lower:
-            return 'government'
-        elif 'corporate' in content_lower or 'business' in content_lower or 'office' in content_lower:
-            return 'corporate'
-        elif 'manufacturing' in content_lower or 'industrial' in content_lower or 'plant' in content_lower:
-            return 'industrial'
-        else:
-            return 'general'
+        if keyword_hits is None:
+            keyword_hits = self.scan_keywords(content_lower)
+        
+        # Plan types are checked in priority order, first hit wins
+        for plan_type in PLAN_TYPE_TERMS:
+            if plan_type in keyword_hits['plan_types']:
+                return plan_type
+        return 'general'
     
-    def identify_hazards(self, content_lower: str) -> List[str]:
+    def identify_hazards(self, content_lower: str, keyword_hits: Dict = None) -> List[str]:
         """Identify hazards addressed in the document."""
-        hazards = []
-        
-        # Natural hazards
-        if any(term in content_lower for term in ['earthquake', 'seismic', 'tremor']):
-            hazards.append('earthquake')
-        if any(term in content_lower for term in ['flood', 'flooding', 'water damage']):
-            hazards.append('flood')
-        if any(term in content_lower for term in ['fire', 'wildfire', 'wildland fire']):
-            hazards.append('fire')
-        if any(term in content_lower for term in ['storm', 'hurricane', 'tornado', 'severe weather']):
-            hazards.append('severe_weather')
-        if any(term in content_lower for term in ['power outage', 'electrical failure', 'blackout']):
-            hazards.append('power_outage')
-        
-        # Technological hazards
-        if any(term in content_lower for term in ['chemical spill', 'hazardous material', 'hazmat']):
-            hazards.append('chemical_spill')
-        if any(term in content_lower for term in ['cyber attack', 'digital threat', 'computer security']):
-            hazards.append('cyber_attack')
-        if any(term in content_lower for term in ['equipment failure', 'mechanical failure']):
-            hazards.append('equipment_failure')
-        
-        # Human-caused hazards
-        if any(term in content_lower for term in ['workplace violence', 'active shooter', 'security threat']):
-            hazards.append('workplace_violence')
-        if any(term in content_lower for term in ['medical emergency', 'health emergency', 'injury']):
-            hazards.append('medical_emergency')
-        if any(term in content_lower for term in ['transportation accident', 'vehicle accident']):
-            hazards.append('transportation_accident')
-        if any(term in content_lower for term in ['infectious disease', 'pandemic', 'outbreak']):
-            hazards.append('infectious_disease')
-        
-        return hazards
-    
-    def identify_organization_types(self, filename: str, content_lower: str) -> List[str]:
+        if keyword_hits is None:
+            keyword_hits = self.scan_keywords(content_lower)
+        return list(keyword_hits['hazards'])
+    
+    def identify_organization_types(self, filename: str, content_lower: str, keyword_hits: Dict = None) -> List[str]:
         """Identify organization types addressed in the document."""
-        org_types = []
-        
-        # Educational institutions
-        if any(term in content_lower for term in ['university', 'college', 'school', 'campus', 'student', 'faculty']):
-            org_types.append('educational')
-        
-        # Healthcare facilities
-        if any(term in content_lower for term in ['hospital', 'healthcare', 'medical', 'patient', 'clinic']):
-            org_types.append('healthcare')
-        
-        # Government agencies
-        if any(term in content_lower for term in ['government', 'municipal', 'city', 'provincial', 'federal']):
-            org_types.append('government')
-        
-        # Corporate offices
-        if any(term in content_lower for term in ['corporate', 'business', 'office', 'company', 'workplace']):
-            org_types.append('corporate')
-        
-        # Manufacturing/Industrial
-        if any(term in content_lower for term in ['manufacturing', 'industrial', 'plant', 'factory', 'production']):
-            org_types.append('industrial')
-        
-        # Retail/Commercial
-        if any(term in content_lower for term in ['retail', 'store', 'commercial', 'shopping']):
-            org_types.append('retail')
-        
-        # Non-profit
-        if any(term in content_lower for term in ['non-profit', 'nonprofit', 'charity', 'volunteer']):
-            org_types.append('non_profit')
-        
-        return org_types
+        if keyword_hits is None:
+            keyword_hits = self.scan_keywords(content_lower)
+        return list(keyword_hits['organization_types'])
     
-    def identify_procedures(self, filename: str, content_lower: str) -> List[str]:
+    def identify_procedures(self, filename: str, content_lower: str, keyword_hits: Dict = None) -> List[str]:
         """Identify specific procedures addressed in the document."""
-        procedures = []
-        
-        # Evacuation procedures
-        if any(term in content_lower for term in ['evacuation', 'evacuate', 'exit', 'egress']):
-            procedures.append('evacuation')
-        
-        # Communication procedures
-        if any(term in content_lower for term in ['communication', 'notification', 'alert', 'emergency contact']):
-            procedures.append('communication')
-        
-        # Medical procedures
-        if any(term in content_lower for term in ['first aid', 'medical response', 'emergency medical']):
-            procedures.append('medical_response')
-        
-        # Security procedures
-        if any(term in content_lower for term in ['security', 'lockdown', 'access control']):
-            procedures.append('security')
-        
-        # Transportation procedures
-        if any(term in content_lower for term in ['transportation', 'bussing', 'vehicle', 'transit']):
-            procedures.append('transportation')
-        
-        # Working alone procedures
-        if any(term in content_lower for term in ['working alone', 'lone worker', 'solo work']):
-            procedures.append('working_alone')
-        
-        # Heat interruption procedures
-        if any(term in content_lower for term in ['heat interruption', 'heating', 'temperature']):
-            procedures.append('heat_interruption')
-        
-        # Hazardous materials procedures
-        if any(term in content_lower for term in ['hazardous material', 'chemical spill', 'hazmat']):
-            procedures.append('hazardous_materials')
-        
-        # Infectious disease procedures
-        if any(term in content_lower for term in ['infectious disease', 'infection control', 'outbreak']):
-            procedures.append('infectious_disease')
-        
-        return procedures
+        if keyword_hits is None:
+            keyword_hits = self.scan_keywords(content_lower)
+        return list(keyword_hits['procedures'])
     
-    def get_relevant_context(self, organization_type: str, hazards: List[str], procedures: List[str] = None) -> str:
-        """Get relevant context documents based on organization type and hazards."""
-        relevant_docs = []
-        
-        # Get comprehensive plans for the organization type
-        if organization_type in self.organized_docs['comprehensive_plans']:
-            relevant_docs.extend(self.organized_docs['comprehensive_plans'][organization_type])
-        
-        # Get hazard-specific documents
-        for hazard in hazards:
-            if hazard in self.organized_docs['hazards']:
-                relevant_docs.extend(self.organized_docs['hazards'][hazard])
-        
-        # Get procedure-specific documents
-        if procedures:
-            for procedure in procedures:
-                if procedure in self.organized_docs['procedures']:
-                    relevant_docs.extend(self.organized_docs['procedures'][procedure])
-        
-        # Remove duplicates based on filename
-        seen_filenames = set()
-        unique_docs = []
-        for doc in relevant_docs:
-            if doc['filename'] not in seen_filenames:
-                seen_filenames.add(doc['filename'])
-                unique_docs.append(doc)
-        
-        # Format context
-        context_parts = []
-        for doc in unique_docs:
-            context_parts.append(f"=== {doc['filename']} ===\n{doc['content'][:3000]}")
-        
-        return "\n\n".join(context_parts)
+    def get_relevant_context(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                             free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> str:
+        """Get the most relevant document passages for an organization type and hazards.
+        
+        The joined context is cached on its own. A miss ranks the chunks
+        without going through search()'s cache, so it counts as one lookup
+        in QUERY_CACHE.stats().
+        """
+        self._ensure_indexes()
+        hazards, procedures, free_text = normalize_criteria(hazards, procedures, free_text)
+        cache_key = self._cache_key('context', organization_type, hazards, procedures, free_text, top_k)
+        context = QUERY_CACHE.get(cache_key)
+        if context is None:
+            context_parts = []
+            for result in self._search(organization_type, hazards, procedures, free_text, top_k):
+                context_parts.append(f"=== {passage_title(result['filename'], result['headings'])} ===\n"
+                                     f"{result['text'].strip()}")
+            context = "\n\n".join(context_parts)
+            QUERY_CACHE.put(cache_key, context)
+        return context
     
     def save_organization(self, output_dir: str = None) -> str:
         """Save the organized documents to JSON files."""
-        if not output_dir:
-            output_dir = Path(__file__).parent / "training_materials" / "organized"
-        
-        output_path = Path(output_dir)
+        output_path = Path(output_dir) if output_dir else self.output_dir
         output_path.mkdir(parents=True, exist_ok=True)
         
-        # Save organized documents
-        organized_file = output_path / "organized_documents.json"
+        # Save document bodies to the content blob, then the index with
+        # categories as document id lists
+        offsets = DocumentContentStore.write(str(output_path), {
+            doc_id: self.get_content(doc_id) for doc_id in self.documents
+        })
+        documents_index = {}
+        for doc_id, doc in self.documents.items():
+            entry = {key: value for key, value in doc.items() if key not in ('content', 'offset', 'length')}
+            entry['offset'], entry['length'] = offsets[doc_id]
+            documents_index[doc_id] = entry
+        
+        organized_file = output_path / ORGANIZED_FILENAME
         with open(organized_file, 'w', encoding='utf-8') as f:
-            json.dump(self.organized_docs, f, indent=2, default=str)
+            json.dump({
+                'format_version': ORGANIZED_FORMAT_VERSION,
+                'documents': documents_index,
+                'categories': self.organized_docs
+            }, f, indent=2, default=str)
+        
+        # Save chunk descriptors and the BM25 index
+        if self.search_index is None:
+            self.build_search_index()
+        save_search_index(str(output_path), self.chunks, self.search_index)
+        
+        # Save chunk embeddings
+        if self.embedder is not None and self.embedding_index is None:
+            self.build_embedding_index()
+        if self.embedding_index is not None:
+            self.embedding_index.save(str(output_path))
         
         # Save document metadata
         metadata_file = output_path / "document_metadata.json"
         with open(metadata_file, 'w', encoding='utf-8') as f:
             json.dump(self.document_metadata, f, indent=2, default=str)
         
+        # Save manifest used for incremental re-categorization
+        manifest_file = output_path / MANIFEST_FILENAME
+        with open(manifest_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'classifier_version': CLASSIFIER_VERSION,
+                'chunker_version': CHUNKER_VERSION,
+                'documents': self.manifest
+            }, f, indent=2)
+        
         # Create summary report
         summary_file = output_path / "organization_summary.txt"
         with open(summary_file, 'w', encoding='utf-8') as f:
@@ -319,9 +847,13 @@ class DocumentOrganizer:
             for category, subcategories in self.organized_docs.items():
                 f.write(f"\n{category.upper()}:\n")
                 for subcategory, docs in subcategories.items():
-                    f.write(f"  {subcategory}: {len(docs)} documents\n")
-                    for doc in docs:
-                        f.write(f"    - {doc['filename']}\n")
+                    if category in CHUNK_CATEGORIES:
+                        chunk_count = len(self.organized_chunks[category].get(subcategory, []))
+                        f.write(f"  {subcategory}: {len(docs)} documents, {chunk_count} sections\n")
+                    else:
+                        f.write(f"  {subcategory}: {len(docs)} documents\n")
+                    for doc_id in docs:
+                        f.write(f"    - {self.documents[doc_id]['filename']}\n")
         
         print(f"✅ Organization saved to: {output_path}")
         return str(output_path)
@@ -335,16 +867,72 @@ class DocumentOrganizer:
             print(f"\n{category.upper()}:")
             for subcategory, docs in subcategories.items():
                 print(f"  {subcategory}: {len(docs)} documents")
-                for doc in docs:
-                    print(f"    - {doc['filename']}")
+                for doc_id in docs:
+                    print(f"    - {self.documents[doc_id]['filename']}")
+
+
+def normalize_criteria(hazards: List[str], procedures: List[str],
+                       free_text: Optional[str]) -> Tuple[List[str], List[str], Optional[str]]:
+    """Sort and dedupe hazards and procedures and collapse whitespace in free_text.
+    
+    Retrieval does not depend on criteria order, so equal requests share
+    cached results.
+    """
+    free_text = " ".join(free_text.split()) if free_text else None
+    return sorted(set(hazards or [])), sorted(set(procedures or [])), free_text
+
+
+def fuse_rankings(rankings: List[List[Tuple[int, float]]]) -> List[Tuple[int, float]]:
+    """Merge best-first (chunk number, score) rankings by reciprocal rank fusion."""
+    scores = {}
+    for ranking in rankings:
+        for rank, (chunk_number, _) in enumerate(ranking):
+            scores[chunk_number] = scores.get(chunk_number, 0.0) + 1.0 / (RANK_FUSION_K + rank + 1)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _load_and_analyze(file_path: str, organizer: "DocumentOrganizer" = None) -> Tuple[str, str, Dict, Optional[str]]:
+    """Read and analyze one document; returns (filename, content, categories, error).
+    
+    Module-level so it can be sent to worker processes.
+    """
+    path = Path(file_path)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        organizer = organizer or DocumentOrganizer(data_dir=str(path.parent))
+        return path.name, content, organizer.analyze_document(path.name, content), None
+    except Exception as e:
+        return path.name, '', {}, str(e)
 
 
 def main():
     """Main function to organize documents."""
-    organizer = DocumentOrganizer()
+    parser = argparse.ArgumentParser(description="Organize emergency management documents by type")
+    parser.add_argument("--data-dir", help="Directory containing the extracted document text")
+    parser.add_argument("--output-dir", help="Directory to save the organized documents to")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes for categorization (0 = one per CPU core)")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the saved manifest and re-analyze every document")
+    parser.add_argument("--embedding-backend", choices=EMBEDDING_BACKENDS,
+                        help="Also build a semantic search index with this embedding backend")
+    parser.add_argument("--embedding-model", help="Embedding model name (defaults depend on the backend)")
+    parser.add_argument("--embedding-url", help="Ollama server for embeddings (default: $OLLAMA_HOST or local)")
+    parser.add_argument("--embedding-timeout", type=float, default=DEFAULT_EMBED_TIMEOUT,
+                        help="Seconds to wait for the embedding server")
+    
+    args = parser.parse_args()
+    
+    embedder = None
+    if args.embedding_backend:
+        embedder = create_embedder(args.embedding_backend, args.embedding_model, args.embedding_url,
+                                   args.embedding_timeout)
+    organizer = DocumentOrganizer(data_dir=args.data_dir, workers=args.workers, output_dir=args.output_dir,
+                                  embedder=embedder)
     
     # Categorize documents
-    organized_docs = organizer.categorize_documents()
+    organized_docs = organizer.categorize_documents(incremental=not args.full)
     
     # Print summary
     organizer.print_summary()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+embedding_index.py - Optional semantic retrieval over document chunks
+
+Chunks are embedded with a local embedding model, either through Ollama or
+with a CPU sentence-transformers model, and stored as one L2-normalized
+float32 NumPy matrix. Cosine similarity against every chunk is then a single
+matrix-vector product, and the matrix is memory-mapped from disk on load.
+
+NumPy (and sentence-transformers for the CPU backend) are optional; keyword
+search keeps working without them.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EMBEDDINGS_FILENAME = "chunk_embeddings.npy"
+EMBEDDINGS_INFO_FILENAME = "chunk_embeddings.json"
+
+DEFAULT_OLLAMA_EMBEDDING_MODEL = "nomic-embed-text"
+DEFAULT_CPU_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_BACKENDS = ('ollama', 'sentence-transformers')
+
+# Number of chunks sent to the embedding model per request
+EMBED_BATCH_SIZE = 32
+# Seconds to wait for the embedding server
+DEFAULT_EMBED_TIMEOUT = 120.0
+
+
+class OllamaEmbedder:
+    def __init__(self, model_name: str = DEFAULT_OLLAMA_EMBEDDING_MODEL, base_url: str = None,
+                 timeout: float = DEFAULT_EMBED_TIMEOUT):
+        """Embed text with an embedding model served by Ollama.
+
+        base_url defaults to $OLLAMA_HOST, or the local server.
+        """
+        import ollama
+        self.client = ollama.Client(host=base_url, timeout=timeout)
+        self.model_name = model_name
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Return one embedding vector per text."""
+        response = self.client.embed(model=self.model_name, input=texts)
+        return response['embeddings']
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name: str = DEFAULT_CPU_EMBEDDING_MODEL):
+        """Embed text with a sentence-transformers model on the CPU."""
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("sentence-transformers is not installed. "
+                              "Install it with: pip install sentence-transformers")
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.model_name = model_name
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Return one embedding vector per text."""
+        return self.model.encode(texts, batch_size=EMBED_BATCH_SIZE).tolist()
+
+
+def create_embedder(backend: str, model_name: str = None, base_url: str = None,
+                    timeout: float = DEFAULT_EMBED_TIMEOUT):
+    """Create an embedder for one of EMBEDDING_BACKENDS; base_url and timeout apply to Ollama."""
+    if backend == 'ollama':
+        return OllamaEmbedder(model_name or DEFAULT_OLLAMA_EMBEDDING_MODEL, base_url, timeout)
+    if backend == 'sentence-transformers':
+        return SentenceTransformerEmbedder(model_name or DEFAULT_CPU_EMBEDDING_MODEL)
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+def chunk_fingerprint(chunks: List[Dict]) -> str:
+    """Identify a chunk list, so stale embeddings are not used for a new one."""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(f"{chunk['doc_id']}\0{chunk['start']}\0{chunk['end']}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingIndex:
+    def __init__(self, vectors, model_name: str, fingerprint: str):
+        """Wrap an (n_chunks, dimensions) matrix of L2-normalized vectors."""
+        self.vectors = vectors
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, texts: List[str], embedder, fingerprint: str) -> "EmbeddingIndex":
+        """Embed texts in batches, in order, and normalize the vectors."""
+        if np is None:
+            raise ImportError("numpy is not installed. Install it with: pip install numpy")
+
+        batches = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            batches.append(np.asarray(embedder.embed(texts[i:i + EMBED_BATCH_SIZE]), dtype=np.float32))
+        vectors = np.vstack(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+        return cls(normalize(vectors), embedder.model_name, fingerprint)
+
+    def search(self, query_vector: List[float], top_k: int = 10) -> List[Tuple[int, float]]:
+        """Return up to top_k (chunk number, cosine similarity) pairs, best first."""
+        if not len(self.vectors):
+            return []
+        query = normalize(np.asarray(query_vector, dtype=np.float32))
+        scores = self.vectors @ query
+
+        top_k = min(top_k, len(scores))
+        # Partial selection, then sort only the top_k
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        # Ties are broken by chunk order so results are deterministic
+        ranked = sorted(candidates.tolist(), key=lambda chunk_number: (-scores[chunk_number], chunk_number))
+        return [(chunk_number, float(scores[chunk_number])) for chunk_number in ranked]
+
+    def save(self, output_dir: str) -> str:
+        """Persist the matrix and what it was built from to output_dir."""
+        output_path = Path(output_dir)
+        matrix_file = output_path / EMBEDDINGS_FILENAME
+        # Write to a temporary file so open memory maps of the old matrix stay valid
+        temp_file = output_path / (EMBEDDINGS_FILENAME + '.tmp')
+        with open(temp_file, 'wb') as f:
+            np.save(f, self.vectors)
+        temp_file.replace(matrix_file)
+
+        with open(output_path / EMBEDDINGS_INFO_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump({
+                'model': self.model_name,
+                'fingerprint': self.fingerprint,
+                'shape': list(self.vectors.shape)
+            }, f, indent=2)
+        return str(matrix_file)
+
+    @classmethod
+    def load(cls, input_dir: str, model_name: str, fingerprint: str) -> Optional["EmbeddingIndex"]:
+        """Memory-map a saved index, or return None if it is missing or stale."""
+        input_path = Path(input_dir)
+        info_file = input_path / EMBEDDINGS_INFO_FILENAME
+        if np is None or not info_file.exists() or not (input_path / EMBEDDINGS_FILENAME).exists():
+            return None
+
+        with open(info_file, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get('model') != model_name or info.get('fingerprint') != fingerprint:
+            return None
+
+        vectors = np.load(input_path / EMBEDDINGS_FILENAME, mmap_mode='r')
+        return cls(vectors, model_name, fingerprint)
+
+
+def normalize(vectors):
+    """Scale vectors (or a single vector) to unit length."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
@@ -10,12 +10,16 @@ Usage:
 """
 
 import json
-import ollama
-from pathlib import Path
 from typing import Dict, List, Optional
 from datetime import datetime
 import argparse
 
+# Import the shared retrieval and generation core
+from llm_backends import add_backend_arguments, configure_backend
+from plan_generator_base import ANONYMIZED_DATA_DIR, DEFAULT_KEEP_ALIVE, PlanGeneratorBase, add_keep_alive_argument
+from plan_sections import plan_request
+from plan_telemetry import TELEMETRY, add_telemetry_arguments, configure_telemetry
+
 # ============================================================================
 # ENHANCED SYSTEM INSTRUCTIONS
 # ============================================================================
@@ -486,44 +490,30 @@ Regulatory Compliance:
 - Local, state, and federal compliance requirements"""
 }
 
+# ============================================================================
+# PLAN REQUEST INSTRUCTIONS
+# ============================================================================
+
+# The shared plan request; this generator's context is the template documents as a whole
+PLAN_REQUEST_INSTRUCTIONS = plan_request("template documents")
+
 # ============================================================================
 # EMERGENCY PLAN GENERATOR CLASS
 # ============================================================================
 
-class EmergencyPlanGenerator:
-    def __init__(self, model_name: str = "llama3.2:1b", data_dir: str = None):
-        """Initialize the Emergency Plan Generator."""
-        self.model_name = model_name
-        self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / "training_materials/processed/all_text/anonymized"
-        self.context_documents = []
-        self.user_inputs = {}
-        self.load_context()
+class EmergencyPlanGenerator(PlanGeneratorBase):
+    PLAN_FILE_PREFIX = "emergency_plan"
     
-    def load_context(self) -> None:
-        """Load the anonymized emergency management documents as templates."""
-        if not self.data_dir.exists():
-            print(f"Warning: Data directory not found: {self.data_dir}")
-            return
-            
-        txt_files = list(self.data_dir.glob("*.txt"))
-        txt_files = [f for f in txt_files if not f.name.startswith("anonymization_")]
-        
-        print(f"Loading {len(txt_files)} emergency management templates...")
-        
-        for file_path in txt_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    
-                self.context_documents.append({
-                    'filename': file_path.name,
-                    'content': content[:4000]  # Use more context for plan generation
-                })
-                
-            except Exception as e:
-                print(f"  ✗ Error loading {file_path.name}: {e}")
-        
-        print(f"Successfully loaded {len(self.context_documents)} template documents")
+    def __init__(self, model_name: str = "llama3.2:1b", organized_data_dir: str = None, engine=None,
+                 keep_alive: str = DEFAULT_KEEP_ALIVE, backend=None, data_dir: str = None):
+        """Initialize the Emergency Plan Generator.
+
+        Templates come from the anonymized documents unless data_dir names
+        another directory.
+        """
+        super().__init__(model_name, organized_data_dir, engine=engine, keep_alive=keep_alive, backend=backend,
+                         data_dir=data_dir or str(ANONYMIZED_DATA_DIR))
+        self.user_inputs = {}
     
     def gather_user_inputs(self) -> Dict:
         """Interactive questionnaire to gather user requirements."""
@@ -636,15 +626,8 @@ class EmergencyPlanGenerator:
             except ValueError:
                 print("Please enter valid numbers separated by commas.")
     
-    def create_emergency_plan_prompt(self, inputs: Dict) -> str:
-        """Create a comprehensive prompt for emergency plan generation."""
-        
-        # Prepare context from templates
-        context_text = "\n\n".join([
-            f"=== TEMPLATE: {doc['filename']} ===\n{doc['content']}"
-            for doc in self.context_documents
-        ])
-        
+    def prompt_components(self, inputs: Dict) -> Dict:
+        """Fixed prompt sections and retrieval criteria for questionnaire inputs."""
         # Get organization-specific instructions
         org_type = inputs.get('organization_type', 'Other')
         org_instructions = ORGANIZATION_TYPE_INSTRUCTIONS.get(org_type, ORGANIZATION_TYPE_INSTRUCTIONS['Other'])
@@ -671,43 +654,23 @@ PLAN REQUIREMENTS:
 - Scope: {inputs['plan_scope']}
 - Additional Requirements: {inputs.get('additional_requirements', 'None')}
 """
-
-        prompt = f"""{SYSTEM_INSTRUCTIONS}
-
-ORGANIZATION-SPECIFIC GUIDELINES:
-{org_instructions}
-
-EMERGENCY MANAGEMENT TEMPLATES AND BEST PRACTICES:
-{context_text}
-
-ORGANIZATION-SPECIFIC REQUIREMENTS:
-{inputs_text}
-
-Please create a detailed, practical emergency plan that includes:
-
-1. **EXECUTIVE SUMMARY** - Brief overview tailored to this organization
-2. **ORGANIZATION PROFILE** - Description of the organization and its emergency management context
-3. **HAZARD ANALYSIS** - Assessment of the identified primary hazards and risks
-4. **EMERGENCY RESPONSE PROCEDURES** - Step-by-step procedures for each identified hazard
-5. **ROLES AND RESPONSIBILITIES** - Clear assignment of emergency management roles
-6. **COMMUNICATION PLAN** - Emergency communication procedures using available methods
-7. **EVACUATION PROCEDURES** - Specific evacuation plans considering building and population
-8. **EMERGENCY RESOURCES** - Utilization of available emergency equipment and resources
-9. **TRAINING REQUIREMENTS** - Recommended training based on the hazards and organization type
-10. **PLAN MAINTENANCE** - Procedures for keeping the plan current and effective
-
-CRITICAL REQUIREMENTS:
-- Include a clear statement that professional review and validation is required before implementation
-- Emphasize that users assume full responsibility for the plan's effectiveness and compliance
-- State that this plan is a starting point and may require significant customization
-- Mention that local regulations and industry standards must be verified
-- Include a note about regular review and updates being necessary
-
-Make the plan specific to the organization's characteristics, hazards, and resources. Use professional emergency management terminology and follow established best practices from the template documents. The plan should be immediately actionable and practical for implementation.
-
-Format the plan with clear headings, bullet points, and actionable steps. Make it comprehensive but readable."""
-
-        return prompt
+        
+        additional_requirements = inputs.get('additional_requirements', '')
+        return {
+            'system_instructions': SYSTEM_INSTRUCTIONS,
+            'plan_instructions': PLAN_REQUEST_INSTRUCTIONS,
+            'guideline_sections': [
+                ('organization_guidelines', 'ORGANIZATION-SPECIFIC GUIDELINES', org_instructions)
+            ],
+            'organization_sections': [
+                ('organization_inputs', 'ORGANIZATION-SPECIFIC REQUIREMENTS', inputs_text)
+            ],
+            'criteria': {
+                'organization_type': inputs['organization_type'],
+                'hazards': inputs['primary_hazards'],
+                'free_text': additional_requirements if additional_requirements != 'None' else None
+            }
+        }
     
     def generate_plan(self, inputs: Dict) -> str:
         """Generate the emergency plan using the language model."""
@@ -715,39 +678,17 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
         print("This may take a few minutes for a comprehensive plan...")
         
         try:
-            prompt = self.create_emergency_plan_prompt(inputs)
-            
-            response = ollama.chat(
-                model=self.model_name,
-                messages=[
-                    {
-                        'role': 'user',
-                        'content': prompt
-                    }
-                ],
-                options={
-                    'temperature': 0.1,  # Low temperature for consistent, professional output
-                    'num_predict': 4000   # Allow longer responses
-                }
-            )
+            messages = self.build_messages(inputs)
+            self.print_prompt_report()
             
-            return response['message']['content']
+            return self.call_model(messages)
             
         except Exception as e:
             return f"Error generating plan: {str(e)}"
     
-    def save_plan(self, plan_content: str, inputs: Dict) -> str:
-        """Save the generated plan to a file."""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        org_name = inputs['organization_name'].replace(' ', '_').replace('/', '_')
-        filename = f"emergency_plan_{org_name}_{timestamp}.md"
-        filepath = Path(__file__).parent / "generated_plans" / filename
-        
-        # Create directory if it doesn't exist
-        filepath.parent.mkdir(exist_ok=True)
-        
-        # Create plan header with metadata and disclaimers
-        header = f"""{DISCLAIMER_HEADER}
+    def plan_header(self, inputs: Dict) -> str:
+        """Disclaimer and metadata written above the generated plan."""
+        return f"""{DISCLAIMER_HEADER}
 
 # Emergency Plan for {inputs['organization_name']}
 
@@ -759,13 +700,12 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
 ---
 
 """
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(header + plan_content + DISCLAIMER_FOOTER)
-        
-        return str(filepath)
     
-    def run_generator(self) -> None:
+    def plan_footer(self) -> str:
+        """Disclaimer written below the generated plan."""
+        return DISCLAIMER_FOOTER
+    
+    def run_generator(self, stream: bool = False, section_parallelism: int = None) -> None:
         """Main method to run the emergency plan generator."""
         try:
             # Gather inputs
@@ -784,11 +724,22 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
                 print("Plan generation cancelled.")
                 return
             
-            # Generate plan
-            plan_content = self.generate_plan(inputs)
-            
-            # Save plan
-            filepath = self.save_plan(plan_content, inputs)
+            if section_parallelism:
+                # Generate the sections concurrently and join them in order
+                plan_content = self.generate_plan_by_sections(inputs, parallelism=section_parallelism)
+                filepath = self.save_plan(plan_content, inputs)
+            elif stream:
+                # Print the plan as it is generated; the file is written as it arrives
+                print()
+                plan_content, filepath = self.generate_plan_streaming(
+                    inputs, on_token=lambda piece: print(piece, end='', flush=True))
+                print()
+            else:
+                # Generate plan
+                plan_content = self.generate_plan(inputs)
+                
+                # Save plan
+                filepath = self.save_plan(plan_content, inputs)
             
             print(f"\n✅ Emergency plan generated successfully!")
             print(f"📄 Saved to: {filepath}")
@@ -813,20 +764,33 @@ def main():
     parser = argparse.ArgumentParser(description="Generate customized emergency plans")
     parser.add_argument("--model", default="llama3.2:1b", help="Ollama model name to use")
     parser.add_argument("--data-dir", help="Directory containing emergency management templates")
+    parser.add_argument("--organized-data-dir", help="Directory containing organized emergency management documents")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print the plan while it is being generated")
+    parser.add_argument("--section-parallelism", type=int,
+                        help="Generate the plan section by section, this many sections at a time")
+    add_keep_alive_argument(parser)
+    
+    add_backend_arguments(parser)
+    add_telemetry_arguments(parser)
     
     args = parser.parse_args()
+    configure_telemetry(args)
     
-    # Check if Ollama is running
+    # Check that the model server is running
+    backend = configure_backend(args)
     try:
-        ollama.list()
+        backend.check_connection()
     except Exception as e:
-        print(f"Error: Cannot connect to Ollama. Is it running?")
-        print("Start it with: brew services start ollama")
+        print(f"Error: Cannot connect to the {backend.name} server. Is it running?")
+        print("Start Ollama with: brew services start ollama")
         return
     
     # Initialize and run generator
-    generator = EmergencyPlanGenerator(model_name=args.model, data_dir=args.data_dir)
-    generator.run_generator()
+    generator = EmergencyPlanGenerator(model_name=args.model, organized_data_dir=args.organized_data_dir,
+                                       keep_alive=args.keep_alive, data_dir=args.data_dir)
+    generator.run_generator(stream=args.stream, section_parallelism=args.section_parallelism)
+    TELEMETRY.print_summary()
 
 
 if __name__ == "__main__":
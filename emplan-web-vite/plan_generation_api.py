@@ -5,7 +5,7 @@ plan_generation_api.py - Flask API for emergency plan generation
 This API provides endpoints for generating emergency plans using the local model.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import sys
 import os
@@ -18,20 +18,22 @@ from email import encoders
 from datetime import datetime
 from pathlib import Path
 import subprocess
-import tempfile
-import markdown
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib.colors import HexColor
-from PyPDF2 import PdfWriter, PdfReader
 from io import BytesIO
 
 # Add the parent directory to the path so we can import the emergency_plan_generator
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from plan_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from plan_pdf import create_pdf_from_markdown
 from plan_queue_system import plan_queue
+from plan_task_store import LANES
+from plan_telemetry import configure_telemetry
+
+app = Flask(__name__)
+CORS(app)
+
+# JSON timing records, if EPOS_TELEMETRY_LOG names a destination
+configure_telemetry()
 
 # Initialize the queue system
 plan_queue.start_processing()
@@ -60,7 +62,8 @@ def generate_plan():
             'communication_methods': ['PA System', 'Email Alerts', 'Text/SMS'],  # Default
             'plan_scope': form_data.get('scope', 'Comprehensive (All Hazards)'),
             'additional_requirements': form_data.get('additional_requirements', ''),
-            'pdf_password': form_data.get('pdf_password', '')  # Get password from form
+            'pdf_password': form_data.get('pdf_password', ''),  # Get password from form
+            'force_regenerate': bool(form_data.get('force_regenerate', False))  # Skip the plan cache
         }
         
         # Validate required fields
@@ -89,6 +92,12 @@ def generate_plan():
         if not any(c in '!@#$%^&*()_+-=[]{}|;:,.<>?' for c in password):
             return jsonify({'error': 'Password must contain at least one special character'}), 400
         
+        # Plans submitted in bulk (many sites at once) go in the bulk lane,
+        # behind plans a user is waiting for
+        lane = form_data.get('priority', 'interactive')
+        if lane not in LANES:
+            return jsonify({'error': f'Priority must be one of: {", ".join(LANES)}'}), 400
+        
         # Get user email from form data or use a default
         user_email = form_data.get('primary_contact_email', 'user@example.com')
         
@@ -96,7 +105,8 @@ def generate_plan():
         task_id = plan_queue.add_task(
             user_email=user_email,
             organization_name=plan_inputs['organization_name'],
-            plan_inputs=plan_inputs
+            plan_inputs=plan_inputs,
+            lane=lane
         )
         
         # Return immediate response with task ID
@@ -131,6 +141,30 @@ def get_task_status(task_id):
         print(f"Error getting task status: {str(e)}")
         return jsonify({'error': f'Failed to get task status: {str(e)}'}), 500
 
+@app.route('/api/task-content/<task_id>', methods=['GET'])
+def get_task_content(task_id):
+    """Get the generated plan of a task, once its status reports has_content."""
+    try:
+        plan = plan_queue.get_plan_content(task_id)
+        if not plan:
+            return jsonify({'error': 'Plan not found'}), 404
+        
+        # The plan never changes, so its hash is the ETag and a client that
+        # has it already gets 304 Not Modified
+        response = jsonify({
+            'success': True,
+            'task_id': task_id,
+            'content_hash': plan['content_hash'],
+            'plan_content': plan['content']
+        })
+        response.set_etag(plan['content_hash'])
+        response.cache_control.private = True
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        print(f"Error getting task content: {str(e)}")
+        return jsonify({'error': f'Failed to get task content: {str(e)}'}), 500
+
 @app.route('/api/send-notification', methods=['POST'])
 def send_notification():
     """Send a notification email using AWS SES"""
@@ -170,9 +204,15 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'model': generator.model_name
+        'queue_processing': plan_queue.is_processing(),
+        'tasks': plan_queue.get_queue_depth()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Queue, pipeline stage, token and cache metrics for Prometheus."""
+    return Response(render_metrics(plan_queue), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/api/plans', methods=['GET'])
 def list_plans():
     """List all generated plans."""
@@ -234,154 +274,6 @@ def get_plan(filename):
         print(f"Error reading plan {filename}: {e}")
         return jsonify({'error': f'Failed to read plan: {str(e)}'}), 500
 
-def create_pdf_from_markdown(content, password, plan_title):
-    """Create a password-protected PDF from markdown content."""
-    try:
-        # Convert markdown to HTML first
-        html_content = markdown.markdown(content, extensions=['extra'])
-        
-        # Create a temporary PDF file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
-            pdf_temp_path = pdf_file.name
-        
-        # Create PDF using ReportLab
-        doc = SimpleDocTemplate(pdf_temp_path, pagesize=letter)
-        story = []
-        
-        # Get styles
-        styles = getSampleStyleSheet()
-        
-        # Create custom styles
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            spaceAfter=30,
-            textColor=HexColor('#2c3e50'),
-            alignment=1  # Center alignment
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=16,
-            spaceAfter=12,
-            spaceBefore=20,
-            textColor=HexColor('#34495e')
-        )
-        
-        subheading_style = ParagraphStyle(
-            'CustomSubHeading',
-            parent=styles['Heading3'],
-            fontSize=14,
-            spaceAfter=8,
-            spaceBefore=12,
-            textColor=HexColor('#7f8c8d')
-        )
-        
-        normal_style = ParagraphStyle(
-            'CustomNormal',
-            parent=styles['Normal'],
-            fontSize=11,
-            spaceAfter=6,
-            leading=14
-        )
-        
-        # Add header
-        header_text = f"""
-        <para align="center">
-        <font size="24" color="#2c3e50"><b>Emergency Plan</b></font><br/>
-        <font size="16" color="#34495e"><b>{plan_title}</b></font><br/>
-        <font size="12" color="#7f8c8d">Generated by EPOS (Emergency Plan Operating System)</font>
-        </para>
-        """
-        story.append(Paragraph(header_text, styles['Normal']))
-        story.append(Spacer(1, 20))
-        
-        # Process the HTML content and convert to PDF elements
-        lines = html_content.split('\n')
-        current_text = ""
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                if current_text:
-                    # Convert HTML tags to ReportLab format
-                    formatted_text = current_text.replace('<strong>', '<b>').replace('</strong>', '</b>')
-                    formatted_text = formatted_text.replace('<em>', '<i>').replace('</em>', '</i>')
-                    formatted_text = formatted_text.replace('<ul>', '').replace('</ul>', '')
-                    formatted_text = formatted_text.replace('<ol>', '').replace('</ol>', '')
-                    formatted_text = formatted_text.replace('<li>', '• ').replace('</li>', '<br/>')
-                    
-                    story.append(Paragraph(formatted_text, normal_style))
-                    current_text = ""
-                story.append(Spacer(1, 6))
-            elif line.startswith('<h1>'):
-                if current_text:
-                    story.append(Paragraph(current_text, normal_style))
-                    current_text = ""
-                title = line.replace('<h1>', '').replace('</h1>', '')
-                story.append(Paragraph(title, title_style))
-            elif line.startswith('<h2>'):
-                if current_text:
-                    story.append(Paragraph(current_text, normal_style))
-                    current_text = ""
-                heading = line.replace('<h2>', '').replace('</h2>', '')
-                story.append(Paragraph(heading, heading_style))
-            elif line.startswith('<h3>'):
-                if current_text:
-                    story.append(Paragraph(current_text, normal_style))
-                    current_text = ""
-                subheading = line.replace('<h3>', '').replace('</h3>', '')
-                story.append(Paragraph(subheading, subheading_style))
-            else:
-                if current_text:
-                    current_text += " " + line
-                else:
-                    current_text = line
-        
-        # Add any remaining text
-        if current_text:
-            formatted_text = current_text.replace('<strong>', '<b>').replace('</strong>', '</b>')
-            formatted_text = formatted_text.replace('<em>', '<i>').replace('</em>', '</i>')
-            story.append(Paragraph(formatted_text, normal_style))
-        
-        # Add footer
-        story.append(Spacer(1, 30))
-        footer_text = f"""
-        <para align="center">
-        <font size="10" color="#7f8c8d">
-        This document is password protected.<br/>
-        Generated on {datetime.now().strftime('%B %d, %Y at %I:%M %p')}
-        </font>
-        </para>
-        """
-        story.append(Paragraph(footer_text, styles['Normal']))
-        
-        # Build the PDF
-        doc.build(story)
-        
-        # Now add password protection using PyPDF2
-        reader = PdfReader(pdf_temp_path)
-        writer = PdfWriter()
-        
-        # Add all pages to the writer
-        for page in reader.pages:
-            writer.add_page(page)
-        
-        # Add password protection
-        writer.encrypt(password)
-        
-        # Write the encrypted PDF
-        with open(pdf_temp_path, 'wb') as output_file:
-            writer.write(output_file)
-        
-        return pdf_temp_path
-        
-    except Exception as e:
-        print(f"Error creating PDF: {e}")
-        return None
-
 def send_email_with_pdf(to_email, password, plan_title, pdf_path):
     """Send email with password-protected PDF attachment."""
     try:
@@ -602,8 +494,7 @@ def download_pdf():
 if __name__ == '__main__':
     print("🚨 EPOS Emergency Plan Generation API")
     print("=" * 50)
-    print(f"Model: {generator.model_name}")
-    print(f"Context documents loaded: {len(generator.context_documents)}")
+    print(f"Queued tasks: {plan_queue.get_queue_depth()}")
     print("Starting API server on http://localhost:5002")
     print("=" * 50)
     
@@ -0,0 +1,89 @@
+"""
+plan_metrics.py - Prometheus metrics of the plan API and queue
+
+Renders the queue's task counts, the pipeline's stage timings and token
+counters (plan_telemetry.TELEMETRY) and the cache statistics in the
+Prometheus text exposition format, for the API's /metrics endpoint.
+
+Stage durations are one histogram, epos_stage_duration_seconds, labelled by
+stage. Besides the generation stages (retrieval, prompt_assembly, model,
+model_prefill, model_eval, ...) the queue records:
+
+- queue_wait: from a task being queued to its processing starting
+- task: processing a task, from generation to the email being sent
+- pdf_render: rendering the plan's password protected PDF
+- email: sending the plan by email
+"""
+
+from typing import Dict, List
+
+from document_organizer import QUERY_CACHE
+from plan_telemetry import TELEMETRY
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(labels: Dict) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _metric(lines: List[str], name: str, metric_type: str, description: str, samples: List) -> None:
+    """Append a metric family; samples are (labels, value) pairs."""
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+
+def _stage_histograms(lines: List[str], stages: Dict) -> None:
+    name = "epos_stage_duration_seconds"
+    lines.append(f"# HELP {name} Duration of plan pipeline stages")
+    lines.append(f"# TYPE {name} histogram")
+    for stage, summary in sorted(stages.items()):
+        for bound, count in summary['buckets'].items():
+            lines.append(f"{name}_bucket{_labels({'stage': stage, 'le': bound})} {count}")
+        lines.append(f"{name}_bucket{_labels({'stage': stage, 'le': '+Inf'})} {summary['count']}")
+        lines.append(f"{name}_sum{_labels({'stage': stage})} {summary['total_seconds']}")
+        lines.append(f"{name}_count{_labels({'stage': stage})} {summary['count']}")
+    _metric(lines, "epos_stage_errors_total", "counter", "Plan pipeline stages that raised an error",
+            [({'stage': stage}, summary['errors']) for stage, summary in sorted(stages.items())])
+
+
+def render_metrics(queue) -> str:
+    """All metrics of a PlanQueueSystem's process, in the Prometheus text format."""
+    telemetry = TELEMETRY.stats()
+    stages = telemetry['stages']
+    counters = telemetry['counters']
+    lines = []
+
+    _metric(lines, "epos_queue_tasks", "gauge", "Plan generation tasks by status",
+            [({'status': status}, count) for status, count in sorted(queue.get_queue_depth().items())])
+    _stage_histograms(lines, stages)
+
+    _metric(lines, "epos_llm_prompt_tokens_total", "counter", "Prompt tokens sent to the language model",
+            [({}, counters.get('prompt_tokens', 0))])
+    _metric(lines, "epos_llm_completion_tokens_total", "counter", "Tokens generated by the language model",
+            [({}, counters.get('completion_tokens', 0))])
+    _metric(lines, "epos_llm_requests_total", "counter", "Requests to the language model",
+            [({}, counters.get('model_requests', 0))])
+    # Generation rate over the process lifetime; the server's own generation
+    # time when it reports one, otherwise the whole request time
+    model_time = stages.get('model_eval', stages.get('model', {})).get('total_seconds', 0)
+    _metric(lines, "epos_llm_tokens_per_second", "gauge", "Average language model generation rate",
+            [({}, counters.get('completion_tokens', 0) / model_time if model_time else 0)])
+
+    caches = {'retrieval': QUERY_CACHE.stats(), 'plan': queue.plan_cache.stats()}
+    _metric(lines, "epos_cache_hits_total", "counter", "Cache lookups answered from the cache",
+            [({'cache': cache}, stats['hits']) for cache, stats in caches.items()])
+    _metric(lines, "epos_cache_misses_total", "counter", "Cache lookups not found in the cache",
+            [({'cache': cache}, stats['misses']) for cache, stats in caches.items()])
+    _metric(lines, "epos_cache_hit_ratio", "gauge", "Fraction of cache lookups that hit",
+            [({'cache': cache}, stats['hit_rate']) for cache, stats in caches.items()])
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+plan_pdf.py - Password-protected PDF rendering of generated plans
+
+Used by the API and by the queue worker, which imports it without pulling in
+the Flask application.
+"""
+
+import tempfile
+from datetime import datetime
+
+import markdown
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.colors import HexColor
+from PyPDF2 import PdfWriter, PdfReader
+
+def create_pdf_from_markdown(content, password, plan_title):
+    """Create a password-protected PDF from markdown content."""
+    try:
+        # Convert markdown to HTML first
+        html_content = markdown.markdown(content, extensions=['extra'])
+        
+        # Create a temporary PDF file
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+            pdf_temp_path = pdf_file.name
+        
+        # Create PDF using ReportLab
+        doc = SimpleDocTemplate(pdf_temp_path, pagesize=letter)
+        story = []
+        
+        # Get styles
+        styles = getSampleStyleSheet()
+        
+        # Create custom styles
+        title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=24,
+            spaceAfter=30,
+            textColor=HexColor('#2c3e50'),
+            alignment=1  # Center alignment
+        )
+        
+        heading_style = ParagraphStyle(
+            'CustomHeading',
+            parent=styles['Heading2'],
+            fontSize=16,
+            spaceAfter=12,
+            spaceBefore=20,
+            textColor=HexColor('#34495e')
+        )
+        
+        subheading_style = ParagraphStyle(
+            'CustomSubHeading',
+            parent=styles['Heading3'],
+            fontSize=14,
+            spaceAfter=8,
+            spaceBefore=12,
+            textColor=HexColor('#7f8c8d')
+        )
+        
+        normal_style = ParagraphStyle(
+            'CustomNormal',
+            parent=styles['Normal'],
+            fontSize=11,
+            spaceAfter=6,
+            leading=14
+        )
+        
+        # Add header
+        header_text = f"""
+        <para align="center">
+        <font size="24" color="#2c3e50"><b>Emergency Plan</b></font><br/>
+        <font size="16" color="#34495e"><b>{plan_title}</b></font><br/>
+        <font size="12" color="#7f8c8d">Generated by EPOS (Emergency Plan Operating System)</font>
+        </para>
+        """
+        story.append(Paragraph(header_text, styles['Normal']))
+        story.append(Spacer(1, 20))
+        
+        # Process the HTML content and convert to PDF elements
+        lines = html_content.split('\n')
+        current_text = ""
+        
+        for line in lines:
+            line = line.strip()
+            if not line:
+                if current_text:
+                    # Convert HTML tags to ReportLab format
+                    formatted_text = current_text.replace('<strong>', '<b>').replace('</strong>', '</b>')
+                    formatted_text = formatted_text.replace('<em>', '<i>').replace('</em>', '</i>')
+                    formatted_text = formatted_text.replace('<ul>', '').replace('</ul>', '')
+                    formatted_text = formatted_text.replace('<ol>', '').replace('</ol>', '')
+                    formatted_text = formatted_text.replace('<li>', '• ').replace('</li>', '<br/>')
+                    
+                    story.append(Paragraph(formatted_text, normal_style))
+                    current_text = ""
+                story.append(Spacer(1, 6))
+            elif line.startswith('<h1>'):
+                if current_text:
+                    story.append(Paragraph(current_text, normal_style))
+                    current_text = ""
+                title = line.replace('<h1>', '').replace('</h1>', '')
+                story.append(Paragraph(title, title_style))
+            elif line.startswith('<h2>'):
+                if current_text:
+                    story.append(Paragraph(current_text, normal_style))
+                    current_text = ""
+                heading = line.replace('<h2>', '').replace('</h2>', '')
+                story.append(Paragraph(heading, heading_style))
+            elif line.startswith('<h3>'):
+                if current_text:
+                    story.append(Paragraph(current_text, normal_style))
+                    current_text = ""
+                subheading = line.replace('<h3>', '').replace('</h3>', '')
+                story.append(Paragraph(subheading, subheading_style))
+            else:
+                if current_text:
+                    current_text += " " + line
+                else:
+                    current_text = line
+        
+        # Add any remaining text
+        if current_text:
+            formatted_text = current_text.replace('<strong>', '<b>').replace('</strong>', '</b>')
+            formatted_text = formatted_text.replace('<em>', '<i>').replace('</em>', '</i>')
+            story.append(Paragraph(formatted_text, normal_style))
+        
+        # Add footer
+        story.append(Spacer(1, 30))
+        footer_text = f"""
+        <para align="center">
+        <font size="10" color="#7f8c8d">
+        This document is password protected.<br/>
+        Generated on {datetime.now().strftime('%B %d, %Y at %I:%M %p')}
+        </font>
+        </para>
+        """
+        story.append(Paragraph(footer_text, styles['Normal']))
+        
+        # Build the PDF
+        doc.build(story)
+        
+        # Now add password protection using PyPDF2
+        reader = PdfReader(pdf_temp_path)
+        writer = PdfWriter()
+        
+        # Add all pages to the writer
+        for page in reader.pages:
+            writer.add_page(page)
+        
+        # Add password protection
+        writer.encrypt(password)
+        
+        # Write the encrypted PDF
+        with open(pdf_temp_path, 'wb') as output_file:
+            writer.write(output_file)
+        
+        return pdf_temp_path
+        
+    except Exception as e:
+        print(f"Error creating PDF: {e}")
+        return None
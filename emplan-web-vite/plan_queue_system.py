@@ -1,9 +1,9 @@
 import os
-import json
 import uuid
 import time
+import socket
 import threading
-import sqlite3
+from contextlib import contextmanager
 import boto3
 from botocore.exceptions import ClientError
 from email.mime.text import MIMEText
@@ -12,20 +12,50 @@ from email.mime.base import MIMEBase
 from email import encoders
 from datetime import datetime
 from typing import Dict, List, Optional
-from enum import Enum
 
-class TaskStatus(Enum):
-    PENDING = "pending"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+from plan_cache import PlanCache
+from plan_telemetry import TELEMETRY
+from plan_task_store import DEFAULT_LANE, DEFAULT_LEASE_SECONDS, PlanTaskStore, TaskStatus
+
+# Worker threads per process; every API process (or host) sharing the
+# database adds its own workers
+DEFAULT_QUEUE_WORKERS = 2
+# Idle workers are woken as soon as a task is added in this process; tasks
+# added by other processes are found by polling this often
+DEFAULT_POLL_SECONDS = 5
+# Tasks are shared fairly between tenants, identified by this task field
+# ('user_email' or 'organization_name')
+DEFAULT_TENANT_KEY = 'user_email'
+TENANT_KEYS = ('user_email', 'organization_name')
+# Waiting interactive tasks a tenant can have; more are queued as bulk
+DEFAULT_INTERACTIVE_LIMIT = 3
 
 class PlanQueueSystem:
-    def __init__(self, db_path: str = "plan_queue.db"):
+    def __init__(self, db_path: str = "plan_queue.db", plan_cache: PlanCache = None, workers: int = None,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, poll_seconds: float = DEFAULT_POLL_SECONDS,
+                 tenant_key: str = None, interactive_limit: int = None):
         self.db_path = db_path
-        self.processing_thread = None
+        self.store = PlanTaskStore(db_path)
+        # Plans generated for identical inputs, served without calling the model
+        self.plan_cache = plan_cache or PlanCache()
+        self.worker_count = workers or int(os.environ.get('EPOS_QUEUE_WORKERS', DEFAULT_QUEUE_WORKERS))
+        # A worker renews its lease on a task every third of the lease
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        # Fair scheduling between tenants, and how many interactive tasks each may have waiting
+        self.tenant_key = tenant_key or os.environ.get('EPOS_QUEUE_TENANT_KEY', DEFAULT_TENANT_KEY)
+        if self.tenant_key not in TENANT_KEYS:
+            raise ValueError(f"Unknown tenant key {self.tenant_key!r}, expected one of {TENANT_KEYS}")
+        if interactive_limit is None:
+            interactive_limit = int(os.environ.get('EPOS_QUEUE_INTERACTIVE_LIMIT', DEFAULT_INTERACTIVE_LIMIT))
+        self.interactive_limit = interactive_limit
+        self.worker_threads = []
         self.should_stop = False
-        self._init_database()
+        # Set by add_task (and stop_processing) to wake idle workers
+        self._work_available = threading.Event()
+        # Generation progress of tasks being processed, by task id
+        self.task_progress = {}
+        self._progress_lock = threading.Lock()
         
         # Email configuration for AWS SES
         self.email_config = {
@@ -40,155 +70,70 @@ class PlanQueueSystem:
         # Verify SES configuration
         self._verify_ses_config()
         
-    def _init_database(self):
-        """Initialize the SQLite database for storing queue tasks"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS plan_tasks (
-                task_id TEXT PRIMARY KEY,
-                user_email TEXT NOT NULL,
-                organization_name TEXT NOT NULL,
-                plan_inputs TEXT NOT NULL,
-                status TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                started_at TEXT,
-                completed_at TEXT,
-                error_message TEXT,
-                plan_content TEXT,
-                pdf_path TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-    
-    def add_task(self, user_email: str, organization_name: str, plan_inputs: Dict) -> str:
-        """Add a new plan generation task to the queue"""
+    def add_task(self, user_email: str, organization_name: str, plan_inputs: Dict,
+                 lane: str = DEFAULT_LANE) -> str:
+        """Add a new plan generation task to the queue, in the interactive or bulk lane"""
         task_id = str(uuid.uuid4())
+        tenant = (user_email if self.tenant_key == 'user_email' else organization_name).strip().lower()
         
-        # Store in database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO plan_tasks 
-            (task_id, user_email, organization_name, plan_inputs, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            task_id,
-            user_email,
-            organization_name,
-            json.dumps(plan_inputs),
-            TaskStatus.PENDING.value,
-            datetime.now().isoformat()
-        ))
-        
-        conn.commit()
-        conn.close()
+        # Store in database, then wake an idle worker
+        lane = self.store.insert_task(task_id, user_email, organization_name, plan_inputs,
+                                      tenant=tenant, lane=lane, interactive_limit=self.interactive_limit)
+        self._work_available.set()
         
-        print(f"Task {task_id} added to queue for {organization_name}")
+        print(f"Task {task_id} added to the {lane} queue for {organization_name}")
         return task_id
     
     def get_task_status(self, task_id: str) -> Optional[Dict]:
-        """Get the status of a specific task"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Get the status of a specific task, without its inputs or plan
         
-        cursor.execute('''
-            SELECT * FROM plan_tasks WHERE task_id = ?
-        ''', (task_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return {
-                'task_id': row[0],
-                'user_email': row[1],
-                'organization_name': row[2],
-                'plan_inputs': json.loads(row[3]),
-                'status': row[4],
-                'created_at': row[5],
-                'started_at': row[6],
-                'completed_at': row[7],
-                'error_message': row[8],
-                'plan_content': row[9],
-                'pdf_path': row[10]
-            }
-        return None
+        Waiting and processing tasks include an estimate of when they will
+        be done (see PlanTaskStore.estimate_seconds), from the processing
+        time of recent tasks and the workers busy in every process.
+        """
+        task = self.store.get_task_status(task_id)
+        if task:
+            task['has_content'] = task['content_hash'] is not None
+            task['progress'] = self.get_task_progress(task_id)
+            task['queue_position'] = None
+            task['eta_seconds'] = None
+            
+            if task['status'] == TaskStatus.PENDING.value:
+                task['queue_position'] = self.store.get_queue_position(task_id)
+            if task['status'] in (TaskStatus.PENDING.value, TaskStatus.PROCESSING.value):
+                task['eta_seconds'] = self.store.estimate_seconds(task_id, self.worker_count)
+        return task
     
-    def get_pending_tasks(self) -> List[Dict]:
-        """Get all pending tasks ordered by creation time"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM plan_tasks 
-            WHERE status = ? 
-            ORDER BY created_at ASC
-        ''', (TaskStatus.PENDING.value,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        tasks = []
-        for row in rows:
-            tasks.append({
-                'task_id': row[0],
-                'user_email': row[1],
-                'organization_name': row[2],
-                'plan_inputs': json.loads(row[3]),
-                'status': row[4],
-                'created_at': row[5],
-                'started_at': row[6],
-                'completed_at': row[7],
-                'error_message': row[8],
-                'plan_content': row[9],
-                'pdf_path': row[10]
+    def get_plan_content(self, task_id: str) -> Optional[Dict]:
+        """Get the generated plan of a task as {'content_hash', 'content'}, or None"""
+        return self.store.get_plan_content(task_id)
+    
+    def get_task_progress(self, task_id: str) -> Optional[Dict]:
+        """Get generation progress of a task being processed, or None"""
+        with self._progress_lock:
+            progress = self.task_progress.get(task_id)
+            return dict(progress) if progress else None
+    
+    def _record_progress(self, task_id: str, piece: str):
+        """Count a piece of generated plan text towards a task's progress"""
+        with self._progress_lock:
+            progress = self.task_progress.setdefault(task_id, {
+                'characters_generated': 0,
+                'first_token_at': datetime.now().isoformat()
             })
-        
-        return tasks
+            progress['characters_generated'] += len(piece)
     
-    def update_task_status(self, task_id: str, status: TaskStatus, **kwargs):
-        """Update the status of a task"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        update_fields = ['status = ?']
-        values = [status.value]
-        
-        if 'started_at' in kwargs:
-            update_fields.append('started_at = ?')
-            values.append(kwargs['started_at'].isoformat())
-        
-        if 'completed_at' in kwargs:
-            update_fields.append('completed_at = ?')
-            values.append(kwargs['completed_at'].isoformat())
-        
-        if 'error_message' in kwargs:
-            update_fields.append('error_message = ?')
-            values.append(kwargs['error_message'])
-        
-        if 'plan_content' in kwargs:
-            update_fields.append('plan_content = ?')
-            values.append(kwargs['plan_content'])
-        
-        if 'pdf_path' in kwargs:
-            update_fields.append('pdf_path = ?')
-            values.append(kwargs['pdf_path'])
-        
-        values.append(task_id)
-        
-        cursor.execute(f'''
-            UPDATE plan_tasks 
-            SET {', '.join(update_fields)}
-            WHERE task_id = ?
-        ''', values)
-        
-        conn.commit()
-        conn.close()
+    def get_pending_tasks(self) -> List[Dict]:
+        """Get all pending tasks in the order they will be processed"""
+        return self.store.get_pending_tasks()
+    
+    def get_queue_depth(self) -> Dict[str, int]:
+        """Number of tasks in each status"""
+        return self.store.count_tasks_by_status()
+    
+    def update_task_status(self, task_id: str, status: TaskStatus, worker_id: str = None, **kwargs) -> bool:
+        """Update the status of a task; with worker_id, only while that worker holds it"""
+        return self.store.update_task_status(task_id, status, worker_id, **kwargs)
     
     def _verify_ses_config(self):
         """Verify AWS SES configuration and email verification status"""
@@ -314,92 +259,153 @@ EPOS Emergency Plan System
             return False
     
     def start_processing(self):
-        """Start the background processing thread"""
-        if self.processing_thread and self.processing_thread.is_alive():
-            print("Processing thread already running")
+        """Start the background worker threads"""
+        if self.is_processing():
+            print("Processing threads already running")
             return
         
         self.should_stop = False
-        self.processing_thread = threading.Thread(target=self._process_queue)
-        self.processing_thread.daemon = True
-        self.processing_thread.start()
-        print("Plan queue processing started")
+        self.worker_threads = []
+        for index in range(self.worker_count):
+            # Unique across threads, processes and hosts sharing the database
+            worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+            thread = threading.Thread(target=self._process_queue, args=(worker_id,), name=f"plan-worker-{index}")
+            thread.daemon = True
+            thread.start()
+            self.worker_threads.append(thread)
+        print(f"Plan queue processing started with {self.worker_count} workers")
     
     def stop_processing(self):
-        """Stop the background processing thread"""
+        """Stop the background worker threads"""
         self.should_stop = True
-        if self.processing_thread:
-            self.processing_thread.join(timeout=5)
+        self._work_available.set()
+        for thread in self.worker_threads:
+            thread.join(timeout=5)
         print("Plan queue processing stopped")
     
-    def _process_queue(self):
-        """Background thread that processes the queue"""
+    def is_processing(self) -> bool:
+        """Whether any worker thread is running"""
+        return any(thread.is_alive() for thread in self.worker_threads)
+    
+    def _process_queue(self, worker_id: str):
+        """Worker thread: claim the next available task and process it, until stopped"""
         while not self.should_stop:
             try:
-                # Get pending tasks
-                pending_tasks = self.get_pending_tasks()
+                # Cleared before claiming, so a task added after this claim finds the event set
+                self._work_available.clear()
+                task = self.store.claim_task(worker_id, self.lease_seconds)
                 
-                if pending_tasks:
-                    # Process the oldest task
-                    task = pending_tasks[0]
-                    print(f"Processing task {task['task_id']} for {task['organization_name']}")
-                    
-                    # Update status to processing
-                    self.update_task_status(task['task_id'], TaskStatus.PROCESSING, 
-                                          started_at=datetime.now())
-                    
-                    # Generate the plan
-                    try:
-                        from enhanced_emergency_plan_generator import EnhancedEmergencyPlanGenerator
-                        generator = EnhancedEmergencyPlanGenerator()
-                        
-                        # Generate plan content
-                        plan_content = generator.generate_plan(task['plan_inputs'])
-                        
-                        # Save plan and create PDF
-                        filepath = generator.save_plan(plan_content, task['plan_inputs'])
-                        
-                        # Create password-protected PDF
-                        from plan_generation_api import create_pdf_from_markdown
-                        pdf_path = create_pdf_from_markdown(
-                            plan_content, 
-                            task['plan_inputs']['pdf_password'], 
-                            task['plan_inputs']['organization_name']
-                        )
-                        
-                        # Update task as completed
-                        self.update_task_status(
-                            task['task_id'], 
-                            TaskStatus.COMPLETED,
-                            completed_at=datetime.now(),
-                            plan_content=plan_content,
-                            pdf_path=pdf_path
-                        )
-                        
-                        # Send email with the completed plan
-                        email_sent = self.send_plan_email(task, pdf_path)
-                        if email_sent:
-                            print(f"Email sent successfully for task {task['task_id']}")
-                        else:
-                            print(f"Failed to send email for task {task['task_id']}")
-                        
-                        print(f"Task {task['task_id']} completed successfully")
-                        
-                    except Exception as e:
-                        error_msg = str(e)
-                        print(f"Task {task['task_id']} failed: {error_msg}")
-                        self.update_task_status(
-                            task['task_id'], 
-                            TaskStatus.FAILED,
-                            error_message=error_msg
-                        )
+                if task:
+                    # Tag the task's timing records with its id, and keep its lease while working
+                    with TELEMETRY.trace(task['task_id']), self._lease_heartbeat(task['task_id'], worker_id):
+                        self._process_task(task, worker_id)
+                    # Look for the next task straight away
+                    continue
                 
-                # Wait before checking for new tasks
-                time.sleep(10)
+                # Wait for a task to be added, or poll for ones added by other processes
+                self._work_available.wait(self.poll_seconds)
                 
             except Exception as e:
-                print(f"Error in queue processing: {str(e)}")
+                print(f"Error in queue processing ({worker_id}): {str(e)}")
                 time.sleep(30)  # Wait longer on error
+    
+    @contextmanager
+    def _lease_heartbeat(self, task_id: str, worker_id: str):
+        """Renew a worker's lease on a task in the background while the block runs"""
+        done = threading.Event()
+        
+        def renew():
+            while not done.wait(self.lease_seconds / 3):
+                if not self.store.heartbeat(task_id, worker_id, self.lease_seconds):
+                    print(f"⚠️ Worker {worker_id} lost its lease on task {task_id}")
+                    return
+        
+        thread = threading.Thread(target=renew, name=f"lease-{task_id}")
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+    
+    def _process_task(self, task: Dict, worker_id: str):
+        """Generate, render and email the plan of a task claimed by a worker"""
+        print(f"Processing task {task['task_id']} for {task['organization_name']} "
+              f"(worker {worker_id}, attempt {task['attempts']})")
+        TELEMETRY.record('queue_wait', (datetime.fromisoformat(task['started_at']) -
+                                        datetime.fromisoformat(task['created_at'])).total_seconds())
+        
+        # Generate the plan
+        try:
+            with TELEMETRY.span('task') as span:
+                from enhanced_emergency_plan_generator import EnhancedEmergencyPlanGenerator
+                generator = EnhancedEmergencyPlanGenerator()
+                
+                # Identical inputs on the same model and corpus reuse the
+                # earlier plan, unless the user asked for a fresh one
+                cache_key = generator.plan_cache_key(task['plan_inputs'])
+                plan_content = None
+                if not task['plan_inputs'].get('force_regenerate'):
+                    plan_content = self.plan_cache.get(cache_key)
+                span['cache_hit'] = plan_content is not None
+                
+                if plan_content is not None:
+                    print(f"♻️ Task {task['task_id']} answered from the plan cache")
+                else:
+                    # Stream the plan to its file, tracking progress for status requests
+                    plan_content, filepath = generator.generate_plan_streaming(
+                        task['plan_inputs'],
+                        on_token=lambda piece: self._record_progress(task['task_id'], piece)
+                    )
+                    self.plan_cache.put(cache_key, plan_content)
+                
+                # Create password-protected PDF
+                from plan_pdf import create_pdf_from_markdown
+                with TELEMETRY.span('pdf_render', characters=len(plan_content)):
+                    pdf_path = create_pdf_from_markdown(
+                        plan_content, 
+                        task['plan_inputs']['pdf_password'], 
+                        task['plan_inputs']['organization_name']
+                    )
+                
+                # Update task as completed, unless its lease expired and another worker took it over
+                completed = self.update_task_status(
+                    task['task_id'], 
+                    TaskStatus.COMPLETED,
+                    worker_id=worker_id,
+                    completed_at=datetime.now(),
+                    plan_content=plan_content,
+                    pdf_path=pdf_path,
+                    cache_hit=span['cache_hit']
+                )
+                if not completed:
+                    print(f"⚠️ Task {task['task_id']} was reclaimed by another worker; not sending its email")
+                    return
+                
+                # Send email with the completed plan
+                with TELEMETRY.span('email') as email_span:
+                    email_sent = self.send_plan_email(task, pdf_path)
+                    email_span['sent'] = email_sent
+                if email_sent:
+                    print(f"Email sent successfully for task {task['task_id']}")
+                else:
+                    print(f"Failed to send email for task {task['task_id']}")
+                
+                print(f"Task {task['task_id']} completed successfully")
+            
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Task {task['task_id']} failed: {error_msg}")
+            self.update_task_status(
+                task['task_id'], 
+                TaskStatus.FAILED,
+                worker_id=worker_id,
+                error_message=error_msg
+            )
+        finally:
+            with self._progress_lock:
+                self.task_progress.pop(task['task_id'], None)
 
 # Global queue instance
 plan_queue = PlanQueueSystem()
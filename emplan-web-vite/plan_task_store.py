@@ -0,0 +1,591 @@
+import hashlib
+import json
+import math
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, List, Optional
+
+# Seconds a claimed task stays with its worker without a heartbeat; after
+# that it is considered abandoned (the worker died) and can be claimed again
+DEFAULT_LEASE_SECONDS = 120
+# Claims of one task before it is failed instead of being handed out again
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Connections kept open per store; a thread needing one while all are in
+# use waits for one to be returned
+DEFAULT_POOL_SIZE = 8
+# Seconds a statement waits for another connection's write lock
+BUSY_TIMEOUT_SECONDS = 30
+# Prepared statements cached per connection
+CACHED_STATEMENTS = 64
+
+# Scheduling lanes, highest priority first: a bulk task is only claimed
+# while no interactive task is waiting
+LANES = ['interactive', 'bulk']
+DEFAULT_LANE = 'interactive'
+
+TASK_COLUMNS = [
+    'task_id', 'user_email', 'organization_name', 'plan_inputs', 'status', 'created_at', 'started_at',
+    'completed_at', 'error_message', 'content_hash', 'pdf_path', 'claimed_by', 'lease_expires_at', 'attempts',
+    'tenant', 'lane', 'fair_tag', 'cache_hit'
+]
+TASK_SELECT = f"SELECT {', '.join(TASK_COLUMNS)} FROM plan_tasks"
+
+# What a client polling a task sees: no inputs (they hold the PDF password),
+# no email address and no plan, which is fetched once with get_plan_content()
+TASK_STATUS_COLUMNS = [
+    'task_id', 'organization_name', 'status', 'created_at', 'started_at', 'completed_at',
+    'error_message', 'content_hash', 'attempts', 'lane'
+]
+TASK_STATUS_SELECT = f"SELECT {', '.join(TASK_STATUS_COLUMNS)} FROM plan_tasks"
+
+
+class TaskStatus(Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+def _create_tasks_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plan_tasks (
+            task_id TEXT PRIMARY KEY,
+            user_email TEXT NOT NULL,
+            organization_name TEXT NOT NULL,
+            plan_inputs TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            completed_at TEXT,
+            error_message TEXT,
+            plan_content TEXT,
+            pdf_path TEXT
+        )
+    ''')
+
+
+def _add_lease_columns(cursor):
+    # Databases created before migrations were tracked may have them already
+    cursor.execute('PRAGMA table_info(plan_tasks)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    for column, definition in [('claimed_by', 'TEXT'), ('lease_expires_at', 'TEXT'),
+                               ('attempts', 'INTEGER NOT NULL DEFAULT 0')]:
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE plan_tasks ADD COLUMN {column} {definition}')
+
+
+def _create_status_index(cursor):
+    # Finding the oldest task in a status reads one index entry, however long the queue
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_plan_tasks_status_created
+        ON plan_tasks (status, created_at)
+    ''')
+
+
+def _move_plan_contents(cursor):
+    # Plans live in their own table, keyed by their hash, so reading a task
+    # row never reads its plan and identical plans (cache hits) are stored once
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plan_contents (
+            content_hash TEXT PRIMARY KEY,
+            content TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('ALTER TABLE plan_tasks ADD COLUMN content_hash TEXT')
+    cursor.execute('SELECT task_id, plan_content FROM plan_tasks WHERE plan_content IS NOT NULL')
+    for task_id, content in cursor.fetchall():
+        cursor.execute('UPDATE plan_tasks SET content_hash = ?, plan_content = NULL WHERE task_id = ?',
+                       (_store_content(cursor, content), task_id))
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _store_content(cursor, content: str) -> str:
+    """Store a plan in plan_contents unless it is there already; returns its hash"""
+    content_hash = _content_hash(content)
+    cursor.execute('INSERT OR IGNORE INTO plan_contents (content_hash, content) VALUES (?, ?)',
+                   (content_hash, content))
+    return content_hash
+
+
+def _add_scheduling_columns(cursor):
+    # Tasks queued before fair scheduling keep their order: all get tag 0,
+    # and equal tags are taken oldest first
+    cursor.execute('ALTER TABLE plan_tasks ADD COLUMN tenant TEXT')
+    cursor.execute(f"ALTER TABLE plan_tasks ADD COLUMN lane TEXT NOT NULL DEFAULT '{DEFAULT_LANE}'")
+    cursor.execute('ALTER TABLE plan_tasks ADD COLUMN fair_tag REAL NOT NULL DEFAULT 0')
+    # Plans answered from the plan cache take no generation time and are
+    # left out of time estimates
+    cursor.execute('ALTER TABLE plan_tasks ADD COLUMN cache_hit INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('UPDATE plan_tasks SET tenant = lower(user_email)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plan_lanes (
+            lane TEXT PRIMARY KEY,
+            virtual_time REAL NOT NULL
+        )
+    ''')
+    # The next task of a lane, and the tasks ahead of one, in a single index range
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_plan_tasks_schedule
+        ON plan_tasks (status, lane, fair_tag, created_at)
+    ''')
+    # A tenant's waiting tasks in a lane
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_plan_tasks_tenant
+        ON plan_tasks (status, lane, tenant, fair_tag)
+    ''')
+
+
+# Schema migrations in order; the database's PRAGMA user_version is the
+# number of migrations applied
+MIGRATIONS = [
+    _create_tasks_table,
+    _add_lease_columns,
+    _create_status_index,
+    _move_plan_contents,
+    _add_scheduling_columns
+]
+
+
+class PlanTaskStore:
+    """SQLite persistence of plan generation tasks, used by the queue
+
+    Any number of workers, in threads or in processes sharing the database,
+    take tasks with claim_task(). A claim is a lease: the worker renews it
+    with heartbeat() while it works, and a task whose lease ran out goes
+    back to the workers.
+
+    Connections are pooled and stay open, so each keeps its cache of
+    prepared statements. The database runs in WAL mode, where readers do
+    not block the writer or each other, with synchronous=NORMAL: a power
+    loss can lose the last transactions but never corrupts the database.
+    WAL needs every process on the same host; it does not work over a
+    network filesystem.
+
+    Tasks are scheduled fairly between tenants (start-time fair queuing).
+    Each lane has a virtual clock, the tag of the last task claimed from
+    it. A new task is tagged one after its tenant's last waiting task, or
+    with the clock if the tenant has none waiting, and workers claim the
+    lowest tag. A tenant queueing 200 plans thus takes every other claim
+    from a tenant queueing one, instead of all of them.
+    """
+
+    def __init__(self, db_path: str = "plan_queue.db", pool_size: int = DEFAULT_POOL_SIZE):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._connections_opened = 0
+        self._pool_lock = threading.Lock()
+        self._migrate()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection in autocommit mode; transactions are begun explicitly"""
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                               check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection, opening one if the pool is not full yet"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._connections_opened < self.pool_size
+                if can_open:
+                    self._connections_opened += 1
+            conn = self._connect() if can_open else self._pool.get()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self):
+        """A cursor inside a write transaction, committed if the block succeeds"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # IMMEDIATE takes the write lock now, so the block's reads see no concurrent write
+            cursor.execute('BEGIN IMMEDIATE')
+            yield cursor
+            cursor.execute('COMMIT')
+
+    def close(self):
+        """Close the pooled connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._pool_lock:
+            self._connections_opened = 0
+
+    def _migrate(self):
+        """Bring the database schema up to date, applying the migrations it has not had"""
+        with self._transaction() as cursor:
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+            for migration in MIGRATIONS[version:]:
+                migration(cursor)
+            if version < len(MIGRATIONS):
+                cursor.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+
+    def insert_task(self, task_id: str, user_email: str, organization_name: str, plan_inputs: Dict,
+                    tenant: str = None, lane: str = DEFAULT_LANE, interactive_limit: int = None) -> str:
+        """Store a new pending task and return the lane it was queued in
+
+        The tenant defaults to the user's email address. A tenant that
+        already has interactive_limit tasks waiting in the interactive lane
+        has further ones queued in the bulk lane.
+        """
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane!r}, expected one of {LANES}")
+        tenant = tenant or user_email.lower()
+
+        with self._transaction() as cursor:
+            if lane == 'interactive' and interactive_limit is not None:
+                cursor.execute('''
+                    SELECT COUNT(*) FROM plan_tasks WHERE status = ? AND lane = ? AND tenant = ?
+                ''', (TaskStatus.PENDING.value, lane, tenant))
+                if cursor.fetchone()[0] >= interactive_limit:
+                    lane = 'bulk'
+
+            cursor.execute('SELECT virtual_time FROM plan_lanes WHERE lane = ?', (lane,))
+            row = cursor.fetchone()
+            virtual_time = row[0] if row else 0.0
+            cursor.execute('''
+                SELECT MAX(fair_tag) FROM plan_tasks WHERE status = ? AND lane = ? AND tenant = ?
+            ''', (TaskStatus.PENDING.value, lane, tenant))
+            last_tag = cursor.fetchone()[0]
+            fair_tag = virtual_time if last_tag is None else max(virtual_time, last_tag + 1)
+
+            cursor.execute('''
+                INSERT INTO plan_tasks
+                (task_id, user_email, organization_name, plan_inputs, status, created_at, tenant, lane, fair_tag)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                task_id,
+                user_email,
+                organization_name,
+                json.dumps(plan_inputs),
+                TaskStatus.PENDING.value,
+                datetime.now().isoformat(),
+                tenant,
+                lane,
+                fair_tag
+            ))
+
+        return lane
+
+    def get_task(self, task_id: str) -> Optional[Dict]:
+        """Get a task by id, or None; its plan is referenced by content_hash"""
+        with self._connection() as conn:
+            row = conn.execute(f'''
+                {TASK_SELECT} WHERE task_id = ?
+            ''', (task_id,)).fetchone()
+
+        return self._row_to_task(row) if row else None
+
+    def get_task_status(self, task_id: str) -> Optional[Dict]:
+        """Get the client-facing status fields of a task (TASK_STATUS_COLUMNS), or None"""
+        with self._connection() as conn:
+            row = conn.execute(f'''
+                {TASK_STATUS_SELECT} WHERE task_id = ?
+            ''', (task_id,)).fetchone()
+
+        return dict(zip(TASK_STATUS_COLUMNS, row)) if row else None
+
+    def get_plan_content(self, task_id: str) -> Optional[Dict]:
+        """Get a task's plan as {'content_hash', 'content'}, or None if it has none"""
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT c.content_hash, c.content
+                FROM plan_tasks t JOIN plan_contents c ON c.content_hash = t.content_hash
+                WHERE t.task_id = ?
+            ''', (task_id,)).fetchone()
+
+        return {'content_hash': row[0], 'content': row[1]} if row else None
+
+    def get_pending_tasks(self) -> List[Dict]:
+        """Get all pending tasks in the order they will be claimed"""
+        tasks = []
+        with self._connection() as conn:
+            for lane in LANES:
+                rows = conn.execute(f'''
+                    {TASK_SELECT}
+                    WHERE status = ? AND lane = ?
+                    ORDER BY fair_tag ASC, created_at ASC
+                ''', (TaskStatus.PENDING.value, lane)).fetchall()
+                tasks.extend(self._row_to_task(row) for row in rows)
+
+        return tasks
+
+    def get_queue_position(self, task_id: str) -> Optional[int]:
+        """Number of waiting tasks that will be claimed before a pending task, or None if it is not pending
+
+        Tasks queued later by a tenant with fewer waiting tasks, or in a
+        higher priority lane, can still move ahead of it.
+        """
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT lane, fair_tag, created_at FROM plan_tasks WHERE task_id = ? AND status = ?
+            ''', (task_id, TaskStatus.PENDING.value)).fetchone()
+            if row is None:
+                return None
+            lane, fair_tag, created_at = row
+
+            position = conn.execute('''
+                SELECT COUNT(*) FROM plan_tasks
+                WHERE status = ? AND lane = ? AND (fair_tag < ? OR (fair_tag = ? AND created_at < ?))
+            ''', (TaskStatus.PENDING.value, lane, fair_tag, fair_tag, created_at)).fetchone()[0]
+            for higher_lane in LANES[:LANES.index(lane)]:
+                position += conn.execute('''
+                    SELECT COUNT(*) FROM plan_tasks WHERE status = ? AND lane = ?
+                ''', (TaskStatus.PENDING.value, higher_lane)).fetchone()[0]
+
+        return position
+
+    def mean_task_seconds(self, sample: int = 50) -> Optional[float]:
+        """Mean processing time of the most recently queued generated tasks, or None without any
+
+        Tasks answered from the plan cache are left out.
+        """
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT AVG((julianday(completed_at) - julianday(started_at)) * 86400) FROM (
+                    SELECT started_at, completed_at FROM plan_tasks
+                    WHERE status = ? AND cache_hit = 0 AND started_at IS NOT NULL AND completed_at IS NOT NULL
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                )
+            ''', (TaskStatus.COMPLETED.value, sample)).fetchone()
+
+        return row[0]
+
+    def count_active_workers(self) -> int:
+        """Number of workers, in any process, holding an unexpired lease on a task"""
+        with self._connection() as conn:
+            row = conn.execute('''
+                SELECT COUNT(DISTINCT claimed_by) FROM plan_tasks
+                WHERE status = ? AND lease_expires_at >= ?
+            ''', (TaskStatus.PROCESSING.value, datetime.now().isoformat())).fetchone()
+
+        return row[0]
+
+    def estimate_seconds(self, task_id: str, default_workers: int = 1) -> Optional[float]:
+        """Estimated seconds until a pending or processing task is done, or None
+
+        Every task is assumed to take mean_task_seconds(). A pending task
+        waits for the tasks ahead of it, worked on by the workers holding
+        leases: while tasks are waiting, every running worker is busy. With
+        none holding one, default_workers are assumed.
+        """
+        task = self.get_task_status(task_id)
+        if task is None or task['status'] not in (TaskStatus.PENDING.value, TaskStatus.PROCESSING.value):
+            return None
+        mean_seconds = self.mean_task_seconds()
+        if mean_seconds is None:
+            return None
+
+        if task['status'] == TaskStatus.PROCESSING.value:
+            elapsed = (datetime.now() - datetime.fromisoformat(task['started_at'])).total_seconds()
+            return round(max(mean_seconds - elapsed, 0.0), 1)
+
+        position = self.get_queue_position(task_id)
+        if position is None:
+            return None
+        workers = self.count_active_workers() or max(1, default_workers)
+        # The tasks ahead and this one, worked on workers at a time
+        return round(math.ceil((position + 1) / workers) * mean_seconds, 1)
+
+    def _next_available_task(self, cursor, now: datetime) -> Optional[tuple]:
+        """(task_id, lane, fair_tag) of the next task to claim, or None
+
+        Processing tasks whose lease expired were scheduled already and come
+        first, oldest first. Then the lowest tagged pending task of the
+        highest priority lane that has one.
+        """
+        cursor.execute('''
+            SELECT task_id, lane, fair_tag FROM plan_tasks
+            WHERE status = ? AND lease_expires_at < ?
+            ORDER BY created_at ASC
+            LIMIT 1
+        ''', (TaskStatus.PROCESSING.value, now.isoformat()))
+        row = cursor.fetchone()
+        if row is not None:
+            return row
+
+        # One index lookup per lane
+        for lane in LANES:
+            cursor.execute('''
+                SELECT task_id, lane, fair_tag FROM plan_tasks
+                WHERE status = ? AND lane = ?
+                ORDER BY fair_tag ASC, created_at ASC
+                LIMIT 1
+            ''', (TaskStatus.PENDING.value, lane))
+            row = cursor.fetchone()
+            if row is not None:
+                return row
+
+        return None
+
+    def claim_task(self, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                   max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> Optional[Dict]:
+        """Atomically claim the next available task for a worker, or return None
+
+        Available tasks are pending ones and processing ones whose lease
+        expired, in the order of _next_available_task(). A plain read checks for one first, so polling an idle queue
+        takes no lock. BEGIN IMMEDIATE then takes the database write lock
+        before the task is chosen, so two workers, even in different
+        processes, never claim the same task. Abandoned tasks that already
+        used max_attempts claims are failed instead.
+        """
+        now = datetime.now()
+        with self._connection() as conn:
+            if self._next_available_task(conn.cursor(), now) is None:
+                return None
+
+        with self._transaction() as cursor:
+            cursor.execute('''
+                UPDATE plan_tasks
+                SET status = ?, error_message = ?, claimed_by = NULL, lease_expires_at = NULL
+                WHERE status = ? AND lease_expires_at < ? AND attempts >= ?
+            ''', (
+                TaskStatus.FAILED.value,
+                f'Abandoned by its worker {max_attempts} times',
+                TaskStatus.PROCESSING.value,
+                now.isoformat(),
+                max_attempts
+            ))
+
+            # Chosen again under the lock, as another worker may have claimed it
+            next_task = self._next_available_task(cursor, now)
+            if next_task is None:
+                return None
+            task_id, lane, fair_tag = next_task
+
+            cursor.execute('''
+                UPDATE plan_tasks
+                SET status = ?, started_at = ?, claimed_by = ?, lease_expires_at = ?, attempts = attempts + 1
+                WHERE task_id = ?
+            ''', (
+                TaskStatus.PROCESSING.value,
+                now.isoformat(),
+                worker_id,
+                (now + timedelta(seconds=lease_seconds)).isoformat(),
+                task_id
+            ))
+
+            # Advance the lane's clock; tasks of tenants with none waiting are tagged from it
+            cursor.execute('''
+                INSERT INTO plan_lanes (lane, virtual_time) VALUES (?, ?)
+                ON CONFLICT (lane) DO UPDATE SET virtual_time = MAX(virtual_time, excluded.virtual_time)
+            ''', (lane, fair_tag))
+
+            cursor.execute(f'{TASK_SELECT} WHERE task_id = ?', (task_id,))
+            task = self._row_to_task(cursor.fetchone())
+
+        return task
+
+    def heartbeat(self, task_id: str, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Extend a worker's lease on a task; False if the worker no longer holds it"""
+        with self._connection() as conn:
+            cursor = conn.execute('''
+                UPDATE plan_tasks
+                SET lease_expires_at = ?
+                WHERE task_id = ? AND claimed_by = ? AND status = ?
+            ''', (
+                (datetime.now() + timedelta(seconds=lease_seconds)).isoformat(),
+                task_id,
+                worker_id,
+                TaskStatus.PROCESSING.value
+            ))
+
+        return cursor.rowcount > 0
+
+    def count_tasks_by_status(self) -> Dict[str, int]:
+        """Number of tasks in each status, including statuses with none"""
+        counts = {status.value: 0 for status in TaskStatus}
+        with self._connection() as conn:
+            # Counted from the (status, created_at) index, not the table rows
+            counts.update(dict(conn.execute('''
+                SELECT status, COUNT(*) FROM plan_tasks GROUP BY status
+            ''').fetchall()))
+
+        return counts
+
+    def update_task_status(self, task_id: str, status: TaskStatus, worker_id: str = None, **kwargs) -> bool:
+        """Update the status of a task
+
+        With worker_id, the task is only updated while that worker holds its
+        lease. Leaving the processing status releases the lease. A
+        plan_content is stored in plan_contents, referenced by its hash.
+        Returns whether the task was updated.
+        """
+        update_fields = ['status = ?']
+        values = [status.value]
+
+        if 'started_at' in kwargs:
+            update_fields.append('started_at = ?')
+            values.append(kwargs['started_at'].isoformat())
+
+        if 'completed_at' in kwargs:
+            update_fields.append('completed_at = ?')
+            values.append(kwargs['completed_at'].isoformat())
+
+        if 'error_message' in kwargs:
+            update_fields.append('error_message = ?')
+            values.append(kwargs['error_message'])
+
+        if 'pdf_path' in kwargs:
+            update_fields.append('pdf_path = ?')
+            values.append(kwargs['pdf_path'])
+
+        if 'cache_hit' in kwargs:
+            update_fields.append('cache_hit = ?')
+            values.append(int(kwargs['cache_hit']))
+
+        plan_content = kwargs.get('plan_content')
+        if plan_content is not None:
+            update_fields.append('content_hash = ?')
+            values.append(_content_hash(plan_content))
+
+        if status != TaskStatus.PROCESSING:
+            update_fields += ['claimed_by = NULL', 'lease_expires_at = NULL']
+
+        conditions = ['task_id = ?']
+        values.append(task_id)
+        if worker_id is not None:
+            conditions.append('claimed_by = ?')
+            values.append(worker_id)
+
+        # The plan is written in the same transaction as its reference, and
+        # only if the task was updated
+        with self._transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE plan_tasks
+                SET {', '.join(update_fields)}
+                WHERE {' AND '.join(conditions)}
+            ''', values)
+            updated = cursor.rowcount > 0
+            if updated and plan_content is not None:
+                _store_content(cursor, plan_content)
+
+        return updated
+
+    def _row_to_task(self, row) -> Dict:
+        task = dict(zip(TASK_COLUMNS, row))
+        task['plan_inputs'] = json.loads(task['plan_inputs'])
+        return task
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+test_plan_task_store.py - Tests of the plan queue's SQLite task store
+
+Leases, heartbeats and retries of abandoned tasks, fair scheduling between
+tenants and lanes, time estimates and schema migrations, run against a
+temporary database.
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from plan_task_store import MIGRATIONS, PlanTaskStore, TaskStatus
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = PlanTaskStore(str(tmp_path / "plan_queue.db"))
+    yield store
+    store.close()
+
+
+def add_tasks(store, count, user_email="user@example.com", prefix="task", **kwargs):
+    task_ids = [f"{prefix}-{index:03d}" for index in range(count)]
+    for task_id in task_ids:
+        store.insert_task(task_id, user_email, "Test Organization", {'organization_name': "Test Organization"},
+                          **kwargs)
+    return task_ids
+
+
+def claim_all(store):
+    claimed = []
+    while True:
+        task = store.claim_task("worker")
+        if task is None:
+            return claimed
+        claimed.append(task['task_id'])
+
+
+def test_concurrent_claims_are_exclusive(store):
+    task_ids = add_tasks(store, 60)
+    claims = []
+    claims_lock = threading.Lock()
+
+    def worker(worker_id):
+        while True:
+            task = store.claim_task(worker_id)
+            if task is None:
+                return
+            with claims_lock:
+                claims.append(task['task_id'])
+
+    threads = [threading.Thread(target=worker, args=(f"worker-{index}",)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(claims) == len(task_ids)
+    assert sorted(claims) == task_ids
+    assert store.count_tasks_by_status()[TaskStatus.PROCESSING.value] == len(task_ids)
+
+
+def test_claim_sets_lease(store):
+    [task_id] = add_tasks(store, 1)
+
+    task = store.claim_task("worker-1", lease_seconds=60)
+
+    assert task['task_id'] == task_id
+    assert task['status'] == TaskStatus.PROCESSING.value
+    assert task['claimed_by'] == "worker-1"
+    assert task['attempts'] == 1
+    assert datetime.fromisoformat(task['lease_expires_at']) > datetime.now()
+    # A held lease keeps the task from other workers
+    assert store.claim_task("worker-2") is None
+
+
+def test_expired_lease_is_reclaimed(store):
+    [task_id] = add_tasks(store, 1)
+    store.claim_task("worker-1", lease_seconds=-1)
+
+    task = store.claim_task("worker-2")
+
+    assert task['task_id'] == task_id
+    assert task['claimed_by'] == "worker-2"
+    assert task['attempts'] == 2
+
+
+def test_heartbeat_keeps_lease(store):
+    [task_id] = add_tasks(store, 1)
+    store.claim_task("worker-1", lease_seconds=-1)
+
+    assert store.heartbeat(task_id, "worker-1", lease_seconds=60)
+    assert store.claim_task("worker-2") is None
+    # Only the lease holder can renew it
+    assert not store.heartbeat(task_id, "worker-2")
+
+
+def test_task_fails_after_max_attempts(store):
+    [task_id] = add_tasks(store, 1)
+    for attempt in range(2):
+        assert store.claim_task(f"worker-{attempt}", lease_seconds=-1, max_attempts=2)['task_id'] == task_id
+
+    assert store.claim_task("worker-2", max_attempts=2) is None
+
+    task = store.get_task(task_id)
+    assert task['status'] == TaskStatus.FAILED.value
+    assert task['attempts'] == 2
+    assert task['claimed_by'] is None
+    assert "Abandoned" in task['error_message']
+
+
+def test_update_rejected_for_stale_worker(store):
+    [task_id] = add_tasks(store, 1)
+    store.claim_task("worker-1", lease_seconds=-1)
+    store.claim_task("worker-2")
+
+    assert not store.update_task_status(task_id, TaskStatus.COMPLETED, worker_id="worker-1",
+                                        completed_at=datetime.now(), plan_content="# Stale plan")
+    task = store.get_task(task_id)
+    assert task['status'] == TaskStatus.PROCESSING.value
+    assert task['content_hash'] is None
+    assert store.get_plan_content(task_id) is None
+
+    assert store.update_task_status(task_id, TaskStatus.COMPLETED, worker_id="worker-2",
+                                    completed_at=datetime.now(), plan_content="# Plan")
+    task = store.get_task(task_id)
+    assert task['status'] == TaskStatus.COMPLETED.value
+    assert task['claimed_by'] is None
+    assert store.get_plan_content(task_id)['content'] == "# Plan"
+
+
+def test_tenants_are_interleaved(store):
+    heavy = add_tasks(store, 6, user_email="heavy@example.com", prefix="heavy")
+    light = add_tasks(store, 2, user_email="light@example.com", prefix="light")
+
+    claimed = claim_all(store)
+
+    # The light tenant's tasks, queued last, do not wait for all the heavy tenant's
+    assert claimed == [heavy[0], light[0], heavy[1], light[1]] + heavy[2:]
+
+
+def test_tenant_joining_later_is_not_behind_the_backlog(store):
+    heavy = add_tasks(store, 6, user_email="heavy@example.com", prefix="heavy")
+    claimed = [store.claim_task("worker")['task_id'] for _ in range(2)]
+    [light] = add_tasks(store, 1, user_email="light@example.com", prefix="light")
+
+    claimed += claim_all(store)
+
+    assert claimed.index(light) <= 3
+    assert sorted(claimed) == sorted(heavy + [light])
+
+
+def test_bulk_yields_to_interactive(store):
+    bulk = add_tasks(store, 3, user_email="batch@example.com", prefix="bulk", lane='bulk')
+    store.claim_task("worker")
+    interactive = add_tasks(store, 2, prefix="interactive")
+
+    assert claim_all(store) == interactive + bulk[1:]
+
+
+def test_interactive_limit_moves_tasks_to_bulk(store):
+    lanes = [store.insert_task(f"task-{index}", "user@example.com", "Test Organization", {},
+                               interactive_limit=2) for index in range(4)]
+
+    assert lanes == ['interactive', 'interactive', 'bulk', 'bulk']
+    assert store.get_task_status("task-3")['lane'] == 'bulk'
+
+
+def test_unknown_lane_is_rejected(store):
+    with pytest.raises(ValueError):
+        store.insert_task("task", "user@example.com", "Test Organization", {}, lane='urgent')
+
+
+def test_queue_position_matches_claim_order(store):
+    add_tasks(store, 4, user_email="heavy@example.com", prefix="heavy")
+    add_tasks(store, 2, user_email="batch@example.com", prefix="bulk", lane='bulk')
+    add_tasks(store, 2, user_email="light@example.com", prefix="light")
+
+    pending = [task['task_id'] for task in store.get_pending_tasks()]
+    positions = {task_id: store.get_queue_position(task_id) for task_id in pending}
+
+    claimed = claim_all(store)
+    assert pending == claimed
+    assert [positions[task_id] for task_id in claimed] == list(range(len(claimed)))
+    assert store.get_queue_position(claimed[0]) is None
+
+
+def complete(store, task_id, seconds, cache_hit=False):
+    finished = datetime.now()
+    assert store.update_task_status(task_id, TaskStatus.COMPLETED, started_at=finished - timedelta(seconds=seconds),
+                                    completed_at=finished, cache_hit=cache_hit)
+
+
+def test_estimate_excludes_cache_hits(store):
+    [first] = add_tasks(store, 1, prefix="first")
+    # Nothing completed yet to estimate from
+    assert store.estimate_seconds(first) is None
+    store.update_task_status(first, TaskStatus.FAILED)
+
+    done = add_tasks(store, 3, prefix="done")
+    for task_id, seconds, cache_hit in zip(done, [10, 20, 0.01], [False, False, True]):
+        complete(store, task_id, seconds, cache_hit)
+    waiting = add_tasks(store, 3, prefix="waiting")
+
+    assert store.mean_task_seconds() == pytest.approx(15, abs=0.01)
+    # Without leased tasks the given worker count is assumed
+    assert [store.estimate_seconds(task_id, default_workers=2) for task_id in waiting] == [15, 15, 30]
+    assert store.estimate_seconds(done[0]) is None
+
+
+def test_estimate_counts_workers_of_every_process(store):
+    [done] = add_tasks(store, 1, prefix="done")
+    complete(store, done, 10)
+    waiting = add_tasks(store, 5, prefix="waiting")
+
+    # Workers of two other processes, and one whose lease expired
+    store.claim_task("host-a-worker")
+    store.claim_task("host-b-worker")
+    store.claim_task("host-c-worker", lease_seconds=-1)
+    assert store.count_active_workers() == 2
+
+    assert store.estimate_seconds(waiting[0]) == pytest.approx(10, abs=0.5)
+    assert [store.estimate_seconds(task_id, default_workers=1) for task_id in waiting[3:]] == [10, 10]
+
+
+@pytest.mark.parametrize("version", [0, 3, 4])
+def test_migrates_old_database(tmp_path, version):
+    db_path = str(tmp_path / "plan_queue.db")
+    conn = sqlite3.connect(db_path)
+    # Version 0 is a database created before migrations were tracked
+    for migration in MIGRATIONS[:max(version, 1)]:
+        migration(conn.cursor())
+    conn.execute(f'PRAGMA user_version = {version}')
+    for index, status in enumerate(['completed', 'pending', 'pending']):
+        conn.execute('''
+            INSERT INTO plan_tasks (task_id, user_email, organization_name, plan_inputs, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (f"old-{index}", "Old.User@Example.com", "Old Organization", '{"organization_name": "Old"}',
+              status, f"2024-01-0{index + 1}T00:00:00"))
+    # Plans were kept in the task row until version 4
+    if version < 4:
+        conn.execute("UPDATE plan_tasks SET plan_content = '# Old plan' WHERE task_id = 'old-0'")
+    else:
+        conn.execute("INSERT INTO plan_contents (content_hash, content) VALUES ('hash', '# Old plan')")
+        conn.execute("UPDATE plan_tasks SET content_hash = 'hash' WHERE task_id = 'old-0'")
+    conn.commit()
+    conn.close()
+
+    store = PlanTaskStore(db_path)
+    try:
+        with store._connection() as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+
+        task = store.get_task("old-1")
+        assert task['plan_inputs'] == {'organization_name': "Old"}
+        assert task['tenant'] == "old.user@example.com"
+        assert task['lane'] == 'interactive'
+        assert task['attempts'] == 0
+        assert store.get_plan_content("old-0")['content'] == "# Old plan"
+
+        # Queued tasks keep their order
+        assert claim_all(store) == ["old-1", "old-2"]
+    finally:
+        store.close()
+
+    # Opening a migrated database again changes nothing
+    PlanTaskStore(db_path).close()
@@ -7,16 +7,17 @@ mapping of user inputs to emergency plan elements for improved accuracy with
 the small language model.
 """
 
-import json
-import ollama
-from pathlib import Path
 from typing import Dict, List, Optional
 from datetime import datetime
 import argparse
 
 # Import the enhanced systems
-from document_organizer import DocumentOrganizer
+from context_assembler import DEFAULT_PROMPT_TOKEN_BUDGET
 from input_structuring_system import InputStructuringSystem
+from llm_backends import add_backend_arguments, configure_backend
+from plan_generator_base import DEFAULT_KEEP_ALIVE, PlanGeneratorBase, add_keep_alive_argument
+from plan_sections import plan_request
+from plan_telemetry import TELEMETRY, add_telemetry_arguments, configure_telemetry
 
 # ============================================================================
 # ENHANCED SYSTEM INSTRUCTIONS
@@ -220,162 +221,62 @@ By using this plan, you accept full responsibility for its implementation and ef
 
 """
 
+# ============================================================================
+# PLAN REQUEST INSTRUCTIONS
+# ============================================================================
+
+PLAN_REQUEST_INSTRUCTIONS = plan_request()
+
 # ============================================================================
 # ENHANCED EMERGENCY PLAN GENERATOR V2 CLASS
 # ============================================================================
 
-class EnhancedEmergencyPlanGeneratorV2:
-    def __init__(self, model_name: str = "llama3.2:1b", organized_data_dir: str = None):
+class EnhancedEmergencyPlanGeneratorV2(PlanGeneratorBase):
+    PLAN_FILE_PREFIX = "enhanced_v2_emergency_plan"
+    
+    def __init__(self, model_name: str = "llama3.2:1b", organized_data_dir: str = None,
+                 prompt_token_budget: int = DEFAULT_PROMPT_TOKEN_BUDGET, embedding_model: str = None,
+                 engine=None, keep_alive: str = DEFAULT_KEEP_ALIVE, backend=None):
         """Initialize the Enhanced Emergency Plan Generator V2."""
-        self.model_name = model_name
-        
-        # Initialize document organizer
-        if organized_data_dir:
-            self.organized_data_path = Path(organized_data_dir)
-        else:
-            self.organized_data_path = Path(__file__).parent / "training_materials" / "organized"
-        
-        self.document_organizer = DocumentOrganizer()
+        super().__init__(model_name, organized_data_dir, prompt_token_budget, embedding_model, engine,
+                         keep_alive, backend)
         self.input_structuring_system = InputStructuringSystem()
-        self.organized_docs = {}
-        self.load_organized_documents()
-    
-    def load_organized_documents(self) -> None:
-        """Load the organized emergency management documents."""
-        print("📚 Loading organized emergency management documents...")
-        
-        # Check if organized documents exist
-        organized_file = self.organized_data_path / "organized_documents.json"
-        if organized_file.exists():
-            try:
-                with open(organized_file, 'r', encoding='utf-8') as f:
-                    self.organized_docs = json.load(f)
-                print(f"✅ Loaded organized documents from: {organized_file}")
-            except Exception as e:
-                print(f"⚠️ Error loading organized documents: {e}")
-                print("🔄 Reorganizing documents...")
-                self.organized_docs = self.document_organizer.categorize_documents()
-        else:
-            print("🔄 Organized documents not found. Creating organization...")
-            self.organized_docs = self.document_organizer.categorize_documents()
-    
-    def get_relevant_context(self, organization_type: str, hazards: List[str], procedures: List[str] = None) -> str:
-        """Get relevant context documents based on organization type and hazards."""
-        relevant_docs = []
-        
-        # Map organization type to our categories
-        org_type_mapping = {
-            "Educational Institution": "educational",
-            "Healthcare Facility": "healthcare", 
-            "Corporate Office": "corporate",
-            "Manufacturing Plant": "industrial",
-            "Retail Store": "retail",
-            "Government Agency": "government",
-            "Non-Profit": "non_profit"
-        }
-        
-        mapped_org_type = org_type_mapping.get(organization_type, "corporate")
-        
-        # Get comprehensive plans for the organization type
-        if 'comprehensive_plans' in self.organized_docs and mapped_org_type in self.organized_docs['comprehensive_plans']:
-            relevant_docs.extend(self.organized_docs['comprehensive_plans'][mapped_org_type])
-        
-        # Get organization type specific documents
-        if 'organization_types' in self.organized_docs and mapped_org_type in self.organized_docs['organization_types']:
-            relevant_docs.extend(self.organized_docs['organization_types'][mapped_org_type])
-        
-        # Get hazard-specific documents
-        if 'hazards' in self.organized_docs:
-            for hazard in hazards:
-                # Map hazard names to our categories
-                hazard_mapping = {
-                    "Fire": "fire",
-                    "Earthquake": "earthquake", 
-                    "Flood": "flood",
-                    "Severe Weather": "severe_weather",
-                    "Power Outage": "power_outage",
-                    "Chemical Spill": "chemical_spill",
-                    "Medical Emergency": "medical_emergency",
-                    "Security Threat": "workplace_violence",
-                    "Workplace Violence": "workplace_violence",
-                    "Cyber Attack": "cyber_attack",
-                    "Transportation Accident": "transportation_accident"
-                }
-                
-                mapped_hazard = hazard_mapping.get(hazard, hazard.lower().replace(" ", "_"))
-                if mapped_hazard in self.organized_docs['hazards']:
-                    relevant_docs.extend(self.organized_docs['hazards'][mapped_hazard])
-        
-        # Get procedure-specific documents
-        if procedures and 'procedures' in self.organized_docs:
-            for procedure in procedures:
-                if procedure in self.organized_docs['procedures']:
-                    relevant_docs.extend(self.organized_docs['procedures'][procedure])
-        
-        # Remove duplicates based on filename
-        seen_filenames = set()
-        unique_docs = []
-        for doc in relevant_docs:
-            if doc['filename'] not in seen_filenames:
-                seen_filenames.add(doc['filename'])
-                unique_docs.append(doc)
-        
-        # Format context
-        context_parts = []
-        for doc in unique_docs:
-            context_parts.append(f"=== {doc['filename']} ===\n{doc['content'][:3000]}")
-        
-        return "\n\n".join(context_parts)
     
-    def create_enhanced_emergency_plan_prompt(self, structured_inputs: Dict) -> str:
-        """Create a comprehensive prompt for emergency plan generation using structured inputs."""
-        
-        # Get relevant context based on structured inputs
+    def structured_prompt_components(self, structured_inputs: Dict) -> Dict:
+        """Fixed prompt sections and retrieval criteria for structured inputs."""
         org_profile = structured_inputs["organization_profile"]
         hazard_assessment = structured_inputs["hazard_assessment"]
         
-        relevant_context = self.get_relevant_context(
-            org_profile["basic_info"]["name"],  # Use organization name for context
-            hazard_assessment["primary_hazards"],
-            structured_inputs["procedural_requirements"].get("required_procedures", [])
-        )
-        
         # Create structured prompt using the input structuring system
         structured_prompt = self.input_structuring_system.create_structured_prompt(structured_inputs)
         
-        prompt = f"""{SYSTEM_INSTRUCTIONS}
-
-STRUCTURED ORGANIZATION INPUTS:
-{structured_prompt}
-
-RELEVANT EMERGENCY MANAGEMENT TEMPLATES AND BEST PRACTICES:
-{relevant_context}
-
-Please create a detailed, practical emergency plan that includes:
-
-1. **EXECUTIVE SUMMARY** - Brief overview tailored to this organization
-2. **ORGANIZATION PROFILE** - Description of the organization and its emergency management context
-3. **HAZARD ANALYSIS** - Assessment of the identified primary hazards and risks
-4. **EMERGENCY RESPONSE PROCEDURES** - Step-by-step procedures for each identified hazard
-5. **ROLES AND RESPONSIBILITIES** - Clear assignment of emergency management roles
-6. **COMMUNICATION PLAN** - Emergency communication procedures using available methods
-7. **EVACUATION PROCEDURES** - Specific evacuation plans considering building and population
-8. **EMERGENCY RESOURCES** - Utilization of available emergency equipment and resources
-9. **TRAINING REQUIREMENTS** - Recommended training based on the hazards and organization type
-10. **PLAN MAINTENANCE** - Procedures for keeping the plan current and effective
-
-CRITICAL REQUIREMENTS:
-- Include a clear statement that professional review and validation is required before implementation
-- Emphasize that users assume full responsibility for the plan's effectiveness and compliance
-- State that this plan is a starting point and may require significant customization
-- Mention that local regulations and industry standards must be verified
-- Include a note about regular review and updates being necessary
-
-Make the plan specific to the organization's characteristics, hazards, and resources. Use professional emergency management terminology and follow established best practices from the relevant template documents. The plan should be immediately actionable and practical for implementation.
-
-Format the plan with clear headings, bullet points, and actionable steps. Make it comprehensive but readable."""
-
-        return prompt
+        return {
+            'system_instructions': SYSTEM_INSTRUCTIONS,
+            'plan_instructions': PLAN_REQUEST_INSTRUCTIONS,
+            'guideline_sections': [],
+            'organization_sections': [
+                ('organization_inputs', 'STRUCTURED ORGANIZATION INPUTS', structured_prompt)
+            ],
+            'criteria': {
+                'organization_type': org_profile["basic_info"]["name"],  # Use organization name for context
+                'hazards': hazard_assessment["primary_hazards"],
+                'procedures': structured_inputs["procedural_requirements"].get("required_procedures", [])
+            }
+        }
+    
+    def structure_inputs(self, inputs: Dict) -> Dict:
+        """Structure questionnaire inputs with the input structuring system."""
+        with TELEMETRY.span('input_structuring'):
+            return self.input_structuring_system.structure_user_inputs(inputs)
+    
+    def prompt_components(self, inputs: Dict) -> Dict:
+        """Structure questionnaire inputs and return their fixed prompt sections and retrieval criteria."""
+        structured_inputs = self.structure_inputs(inputs)
+        return self.structured_prompt_components(structured_inputs)
+    
+    def create_enhanced_emergency_plan_prompt(self, structured_inputs: Dict) -> List[Dict]:
+        """Create the chat messages for emergency plan generation using structured inputs."""
+        return self.build_messages_from_components(self.structured_prompt_components(structured_inputs))
     
     def generate_plan(self, inputs: Dict) -> str:
         """Generate the emergency plan using the enhanced language model with structured inputs."""
@@ -385,45 +286,23 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
         try:
             # Structure the inputs first
             print("🔧 Structuring user inputs...")
-            structured_inputs = self.input_structuring_system.structure_user_inputs(inputs)
+            structured_inputs = self.structure_inputs(inputs)
             
             # Create enhanced prompt
             print("📝 Creating enhanced prompt...")
-            prompt = self.create_enhanced_emergency_plan_prompt(structured_inputs)
+            messages = self.create_enhanced_emergency_plan_prompt(structured_inputs)
+            self.print_prompt_report()
             
             # Generate plan
             print("🚀 Generating plan with structured inputs...")
-            response = ollama.chat(
-                model=self.model_name,
-                messages=[
-                    {
-                        'role': 'user',
-                        'content': prompt
-                    }
-                ],
-                options={
-                    'temperature': 0.1,  # Low temperature for consistent, professional output
-                    'num_predict': 4000   # Allow longer responses
-                }
-            )
-            
-            return response['message']['content']
+            return self.call_model(messages)
             
         except Exception as e:
             return f"Error generating plan: {str(e)}"
     
-    def save_plan(self, plan_content: str, inputs: Dict) -> str:
-        """Save the generated plan to a file."""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        org_name = inputs['organization_name'].replace(' ', '_').replace('/', '_')
-        filename = f"enhanced_v2_emergency_plan_{org_name}_{timestamp}.md"
-        filepath = Path(__file__).parent / "generated_plans" / filename
-        
-        # Create directory if it doesn't exist
-        filepath.parent.mkdir(exist_ok=True)
-        
-        # Create plan header with metadata and disclaimers
-        header = f"""{DISCLAIMER_HEADER}
+    def plan_header(self, inputs: Dict) -> str:
+        """Disclaimer and metadata written above the generated plan."""
+        return f"""{DISCLAIMER_HEADER}
 
 # Enhanced V2 Emergency Plan for {inputs['organization_name']}
 
@@ -437,11 +316,10 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
 ---
 
 """
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(header + plan_content + DISCLAIMER_FOOTER)
-        
-        return str(filepath)
+    
+    def plan_footer(self) -> str:
+        """Disclaimer written below the generated plan."""
+        return DISCLAIMER_FOOTER
     
     def gather_user_inputs(self) -> Dict:
         """Interactive questionnaire to gather user requirements."""
@@ -559,14 +437,14 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
             except ValueError:
                 print("Please enter valid numbers separated by commas.")
     
-    def run_generator(self) -> None:
+    def run_generator(self, stream: bool = False, section_parallelism: int = None) -> None:
         """Main method to run the enhanced emergency plan generator v2."""
         try:
             # Gather inputs
             inputs = self.gather_user_inputs()
             
             # Structure inputs for preview
-            structured_inputs = self.input_structuring_system.structure_user_inputs(inputs)
+            structured_inputs = self.structure_inputs(inputs)
             
             # Confirm inputs
             print("\n📋 ENHANCED V2 PLAN GENERATION SUMMARY")
@@ -590,11 +468,22 @@ Format the plan with clear headings, bullet points, and actionable steps. Make i
                 print("Plan generation cancelled.")
                 return
             
-            # Generate plan
-            plan_content = self.generate_plan(inputs)
-            
-            # Save plan
-            filepath = self.save_plan(plan_content, inputs)
+            if section_parallelism:
+                # Generate the sections concurrently and join them in order
+                plan_content = self.generate_plan_by_sections(inputs, parallelism=section_parallelism)
+                filepath = self.save_plan(plan_content, inputs)
+            elif stream:
+                # Print the plan as it is generated; the file is written as it arrives
+                print()
+                plan_content, filepath = self.generate_plan_streaming(
+                    inputs, on_token=lambda piece: print(piece, end='', flush=True))
+                print()
+            else:
+                # Generate plan
+                plan_content = self.generate_plan(inputs)
+                
+                # Save plan
+                filepath = self.save_plan(plan_content, inputs)
             
             print(f"\n✅ Enhanced V2 emergency plan generated successfully!")
             print(f"📄 Saved to: {filepath}")
@@ -623,20 +512,37 @@ def main():
     parser = argparse.ArgumentParser(description="Generate enhanced v2 customized emergency plans")
     parser.add_argument("--model", default="llama3.2:1b", help="Ollama model name to use")
     parser.add_argument("--organized-data-dir", help="Directory containing organized emergency management documents")
+    parser.add_argument("--prompt-token-budget", type=int, default=DEFAULT_PROMPT_TOKEN_BUDGET,
+                        help="Approximate token budget for the whole prompt, including retrieved context")
+    parser.add_argument("--embedding-model",
+                        help="Ollama embedding model for semantic retrieval (e.g. nomic-embed-text)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print the plan while it is being generated")
+    parser.add_argument("--section-parallelism", type=int,
+                        help="Generate the plan section by section, this many sections at a time")
+    add_keep_alive_argument(parser)
+    
+    add_backend_arguments(parser)
+    add_telemetry_arguments(parser)
     
     args = parser.parse_args()
+    configure_telemetry(args)
     
-    # Check if Ollama is running
+    # Check that the model server is running
+    backend = configure_backend(args)
     try:
-        ollama.list()
+        backend.check_connection()
     except Exception as e:
-        print(f"Error: Cannot connect to Ollama. Is it running?")
-        print("Start it with: brew services start ollama")
+        print(f"Error: Cannot connect to the {backend.name} server. Is it running?")
+        print("Start Ollama with: brew services start ollama")
         return
     
     # Initialize and run enhanced generator v2
-    generator = EnhancedEmergencyPlanGeneratorV2(model_name=args.model, organized_data_dir=args.organized_data_dir)
-    generator.run_generator()
+    generator = EnhancedEmergencyPlanGeneratorV2(model_name=args.model, organized_data_dir=args.organized_data_dir,
+                                                 prompt_token_budget=args.prompt_token_budget,
+                                                 embedding_model=args.embedding_model, keep_alive=args.keep_alive)
+    generator.run_generator(stream=args.stream, section_parallelism=args.section_parallelism)
+    TELEMETRY.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+llm_backends.py - Language model backends for plan generation and chat
+
+The generators and the chat assistant talk to the language model through a
+backend rather than calling ollama.chat directly:
+
+- ollama: an Ollama server, through one persistent (connection pooled) client
+- llamacpp: a llama.cpp server, with prompt caching turned on
+- openai: any OpenAI-compatible chat completions server (vLLM, LM Studio, ...)
+- fake: a deterministic offline model, for tests and benchmarks
+
+Every backend applies the same request timeout, retries of transient
+failures and a limit on concurrent requests. The process-wide backend is
+configured from EPOS_LLM_* environment variables, or from the command line
+with add_backend_arguments(), so tuning throughput does not mean editing
+each generator.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+DEFAULT_BACKEND = "ollama"
+DEFAULT_BASE_URLS = {
+    'ollama': "http://127.0.0.1:11434",
+    'llamacpp': "http://127.0.0.1:8080/v1",
+    'openai': "http://127.0.0.1:8000/v1"
+}
+
+# Seconds to wait for a reply; CPU-only hosts can take minutes for a full plan
+DEFAULT_TIMEOUT = 600.0
+# Times a request failing with a transient error (connection refused, timeout,
+# server error) is attempted again, waiting RETRY_BACKOFF_SECONDS, doubled
+# after every attempt
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 1.0
+# Requests in flight at once; match the server's parallelism
+# (OLLAMA_NUM_PARALLEL, llama.cpp --parallel)
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Ollama generation options -> OpenAI chat completion parameters
+OPENAI_OPTION_NAMES = {
+    'temperature': 'temperature',
+    'top_p': 'top_p',
+    'num_predict': 'max_tokens',
+    'stop': 'stop',
+    'seed': 'seed'
+}
+
+# Fake model tokens: words with the whitespace that follows them
+FAKE_TOKEN_PATTERN = re.compile(r"\s*\S+\s*")
+
+
+def ollama_usage(response) -> Dict:
+    """Token counts and server timings (reported in nanoseconds) of an Ollama reply."""
+    def seconds(field):
+        value = response.get(field)
+        return value / 1e9 if value is not None else None
+
+    return {
+        'prompt_tokens': response.get('prompt_eval_count'),
+        'completion_tokens': response.get('eval_count'),
+        'prompt_eval_seconds': seconds('prompt_eval_duration'),
+        'eval_seconds': seconds('eval_duration'),
+        'load_seconds': seconds('load_duration')
+    }
+
+
+def openai_usage(data: Dict) -> Dict:
+    """Token counts of an OpenAI-style reply, with llama.cpp's timings (in milliseconds) if present."""
+    usage = data.get('usage') or {}
+    timings = data.get('timings') or {}
+
+    def seconds(field):
+        value = timings.get(field)
+        return value / 1000 if value is not None else None
+
+    return {
+        'prompt_tokens': usage.get('prompt_tokens', timings.get('prompt_n')),
+        'completion_tokens': usage.get('completion_tokens', timings.get('predicted_n')),
+        'prompt_eval_seconds': seconds('prompt_ms'),
+        'eval_seconds': seconds('predicted_ms'),
+        'load_seconds': None
+    }
+
+
+class LLMBackend:
+    name = None
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        """Set the timeout, retries and concurrency limit shared by every backend."""
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+
+    def chat(self, model: str, messages: List[Dict], options: Dict = None, keep_alive: str = None) -> Dict:
+        """Send chat messages and return the reply.
+
+        Returns {'content': str, 'usage': {...}}. usage holds prompt_tokens,
+        completion_tokens and, in seconds, the server's prompt_eval_seconds
+        (prefill), eval_seconds (generation) and load_seconds; a value the
+        server does not report is None.
+        options are Ollama-style generation options (temperature,
+        num_predict, ...); keep_alive only applies to Ollama.
+        """
+        return self._with_retries(lambda: self._chat(model, messages, options or {}, keep_alive))
+
+    def stream_chat(self, model: str, messages: List[Dict], options: Dict = None,
+                    keep_alive: str = None, on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        """Send chat messages and yield the reply as it is generated.
+
+        A failure before the first piece of text is retried like chat(); one
+        after it is raised, since the caller has already used the text.
+        on_usage, if given, is called with the reply's usage (as in chat())
+        when the server reports it at the end of the stream.
+        """
+        stream = self._with_retries(lambda: self._open_stream(model, messages, options or {}, keep_alive,
+                                                              on_usage), keep_slot=True)
+        try:
+            yield from stream
+        finally:
+            self._slots.release()
+
+    def check_connection(self) -> None:
+        """Raise an exception if the server cannot be reached."""
+        raise NotImplementedError
+
+    def list_models(self) -> Optional[List[str]]:
+        """Names of the models the server can serve, or None if it cannot say."""
+        return None
+
+    def _chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str) -> Dict:
+        raise NotImplementedError
+
+    def _stream_chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str,
+                     on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        raise NotImplementedError
+
+    def _is_transient(self, error: Exception) -> bool:
+        """Whether a failed request is worth attempting again."""
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+    def _open_stream(self, model: str, messages: List[Dict], options: Dict, keep_alive: str,
+                     on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        """Start a stream and wait for its first piece, so connection errors surface here."""
+        stream = self._stream_chat(model, messages, options, keep_alive, on_usage)
+        try:
+            first = next(stream)
+        except StopIteration:
+            return iter(())
+        return _prepend(first, stream)
+
+    def _with_retries(self, request: Callable, keep_slot: bool = False):
+        """Run request in a concurrency slot, attempting it again after transient failures.
+
+        The slot is given up while waiting to retry, so a backing-off request
+        does not keep others from the server. With keep_slot, the slot is
+        still held when request succeeds and the caller must release it.
+        """
+        delay = RETRY_BACKOFF_SECONDS
+        for attempt in range(self.retries + 1):
+            self._slots.acquire()
+            try:
+                result = request()
+            except Exception as e:
+                self._slots.release()
+                if attempt == self.retries or not self._is_transient(e):
+                    raise
+                print(f"⚠️ {self.name} request failed ({e}), retrying in {delay:.0f}s...")
+                time.sleep(delay)
+                delay *= 2
+                continue
+            if not keep_slot:
+                self._slots.release()
+            return result
+
+
+def _prepend(first: str, rest: Iterator[str]) -> Iterator[str]:
+    yield first
+    yield from rest
+
+
+class OllamaBackend(LLMBackend):
+    name = "ollama"
+
+    def __init__(self, base_url: str = None, **kwargs):
+        """Talk to an Ollama server through one persistent client.
+
+        The client keeps its HTTP connections open, so requests do not pay
+        for a new connection each time.
+        """
+        super().__init__(**kwargs)
+        import ollama
+        self._ollama = ollama
+        self.base_url = base_url or DEFAULT_BASE_URLS['ollama']
+        self.client = ollama.Client(host=self.base_url, timeout=self.timeout)
+
+    def check_connection(self) -> None:
+        """Raise an exception if the server cannot be reached."""
+        self.client.list()
+
+    def list_models(self) -> Optional[List[str]]:
+        """Names of the models pulled on the Ollama server."""
+        # Older clients return plain dicts with 'name', newer ones models with 'model'
+        return [model.get('model') or model.get('name') for model in self.client.list()['models']]
+
+    def _chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str) -> Dict:
+        response = self.client.chat(model=model, messages=messages, options=options, keep_alive=keep_alive)
+        return {
+            'content': response['message']['content'],
+            'usage': ollama_usage(response)
+        }
+
+    def _stream_chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str,
+                     on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        stream = self.client.chat(model=model, messages=messages, options=options, keep_alive=keep_alive,
+                                  stream=True)
+        for chunk in stream:
+            piece = chunk['message']['content']
+            if piece:
+                yield piece
+            # The last chunk carries the counts and timings of the whole reply
+            if chunk.get('done') and on_usage:
+                on_usage(ollama_usage(chunk))
+
+    def _is_transient(self, error: Exception) -> bool:
+        """Connection failures, timeouts and server errors are retried."""
+        import httpx
+        if isinstance(error, self._ollama.ResponseError):
+            return error.status_code >= 500
+        return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, base_url: str = None, api_key: str = None, **kwargs):
+        """Talk to a server implementing the OpenAI chat completions API."""
+        super().__init__(**kwargs)
+        # httpx is installed with the ollama package
+        import httpx
+        self._httpx = httpx
+        self.base_url = (base_url or DEFAULT_BASE_URLS[self.name]).rstrip('/')
+        headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+        # One pooled client, sized for the concurrency limit
+        self.client = httpx.Client(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_concurrency,
+                                max_keepalive_connections=self.max_concurrency)
+        )
+
+    def check_connection(self) -> None:
+        """Raise an exception if the server cannot be reached."""
+        self.client.get("/models").raise_for_status()
+
+    def list_models(self) -> Optional[List[str]]:
+        """Ids of the models the server lists at /models."""
+        response = self.client.get("/models")
+        response.raise_for_status()
+        return [model['id'] for model in response.json().get('data', [])]
+
+    def request_body(self, model: str, messages: List[Dict], options: Dict) -> Dict:
+        """Chat completion request body for Ollama-style options."""
+        body = {'model': model, 'messages': messages}
+        for option, parameter in OPENAI_OPTION_NAMES.items():
+            if option in options:
+                body[parameter] = options[option]
+        return body
+
+    def _chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str) -> Dict:
+        response = self.client.post("/chat/completions", json=self.request_body(model, messages, options))
+        response.raise_for_status()
+        data = response.json()
+        return {
+            'content': data['choices'][0]['message']['content'],
+            'usage': openai_usage(data)
+        }
+
+    def _stream_chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str,
+                     on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        # include_usage asks for a final event with the token counts
+        body = dict(self.request_body(model, messages, options), stream=True,
+                    stream_options={'include_usage': True})
+        with self.client.stream("POST", "/chat/completions", json=body) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                # Server-sent events: "data: {...}", ending with "data: [DONE]"
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                choices = event.get('choices') or [{}]
+                piece = (choices[0].get('delta') or {}).get('content')
+                if piece:
+                    yield piece
+                if (event.get('usage') or event.get('timings')) and on_usage:
+                    on_usage(openai_usage(event))
+
+    def _is_transient(self, error: Exception) -> bool:
+        """Connection failures, timeouts, rate limiting and server errors are retried."""
+        if isinstance(error, self._httpx.HTTPStatusError):
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        return isinstance(error, (self._httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class LlamaCppBackend(OpenAICompatibleBackend):
+    name = "llamacpp"
+
+    def request_body(self, model: str, messages: List[Dict], options: Dict) -> Dict:
+        """Chat completion request body, asking the server to reuse its cached prompt prefix."""
+        body = super().request_body(model, messages, options)
+        body['cache_prompt'] = True
+        return body
+
+
+class FakeBackend(LLMBackend):
+    name = "fake"
+
+    def __init__(self, reply: str = None, tokens_per_second: float = None, **kwargs):
+        """An offline model whose reply depends only on the prompt.
+
+        Without a fixed reply, it answers with a short markdown section
+        naming a digest of the prompt, so identical prompts get identical
+        replies. Each word is a token; with tokens_per_second the reply is
+        produced at that rate, like a real model, instead of instantly.
+        """
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.tokens_per_second = tokens_per_second
+
+    def check_connection(self) -> None:
+        """The fake model is always available."""
+
+    def reply_for(self, messages: List[Dict]) -> str:
+        """The deterministic reply to a list of chat messages."""
+        if self.reply is not None:
+            return self.reply
+        prompt = "\n".join(message['content'] for message in messages)
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:12]
+        return (f"## Generated Section\n\n"
+                f"- Placeholder text from the fake model for prompt {digest}.\n"
+                f"- Review with qualified emergency management professionals before use.\n")
+
+    def _chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str) -> Dict:
+        content = self.reply_for(messages)
+        tokens = FAKE_TOKEN_PATTERN.findall(content)
+        if self.tokens_per_second:
+            time.sleep(len(tokens) / self.tokens_per_second)
+        return {
+            'content': content,
+            'usage': self.usage_for(messages, tokens)
+        }
+
+    def _stream_chat(self, model: str, messages: List[Dict], options: Dict, keep_alive: str,
+                     on_usage: Callable[[Dict], None] = None) -> Iterator[str]:
+        tokens = FAKE_TOKEN_PATTERN.findall(self.reply_for(messages))
+        for token in tokens:
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield token
+        if on_usage:
+            on_usage(self.usage_for(messages, tokens))
+
+    def usage_for(self, messages: List[Dict], tokens: List[str]) -> Dict:
+        """Usage of a fake reply: about four characters per prompt token, and no prefill time."""
+        prompt_chars = sum(len(message['content']) for message in messages)
+        return {
+            'prompt_tokens': prompt_chars // 4,
+            'completion_tokens': len(tokens),
+            'prompt_eval_seconds': None,
+            'eval_seconds': len(tokens) / self.tokens_per_second if self.tokens_per_second else None,
+            'load_seconds': None
+        }
+
+
+LLM_BACKENDS = {
+    'ollama': OllamaBackend,
+    'llamacpp': LlamaCppBackend,
+    'openai': OpenAICompatibleBackend,
+    'fake': FakeBackend
+}
+
+
+def create_backend(name: str = DEFAULT_BACKEND, base_url: str = None, **kwargs) -> LLMBackend:
+    """Create one of LLM_BACKENDS; kwargs are timeout, retries, max_concurrency and backend specific ones."""
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {name} (choose from {', '.join(LLM_BACKENDS)})")
+    if name == 'fake':
+        return FakeBackend(**kwargs)
+    return LLM_BACKENDS[name](base_url=base_url, **kwargs)
+
+
+def environment_settings() -> Dict:
+    """Backend settings given by the EPOS_LLM_* environment variables."""
+    settings = {
+        'name': os.environ.get('EPOS_LLM_BACKEND', DEFAULT_BACKEND),
+        'base_url': os.environ.get('EPOS_LLM_URL'),
+        'api_key': os.environ.get('EPOS_LLM_API_KEY')
+    }
+    if os.environ.get('EPOS_LLM_TIMEOUT'):
+        settings['timeout'] = float(os.environ['EPOS_LLM_TIMEOUT'])
+    if os.environ.get('EPOS_LLM_RETRIES'):
+        settings['retries'] = int(os.environ['EPOS_LLM_RETRIES'])
+    if os.environ.get('EPOS_LLM_MAX_CONCURRENCY'):
+        settings['max_concurrency'] = int(os.environ['EPOS_LLM_MAX_CONCURRENCY'])
+    return settings
+
+
+def backend_from_settings(settings: Dict) -> LLMBackend:
+    """Create a backend from environment_settings()-style settings."""
+    settings = dict(settings)
+    name = settings.pop('name')
+    base_url = settings.pop('base_url', None)
+    api_key = settings.pop('api_key', None)
+    if api_key and name in ('openai', 'llamacpp'):
+        settings['api_key'] = api_key
+    return create_backend(name, base_url, **settings)
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def get_default_backend() -> LLMBackend:
+    """Return the process-wide backend, creating it from the environment on first use."""
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = backend_from_settings(environment_settings())
+        return _default_backend
+
+
+def set_default_backend(backend: LLMBackend) -> None:
+    """Make backend the process-wide backend."""
+    global _default_backend
+    with _default_backend_lock:
+        _default_backend = backend
+
+
+def add_backend_arguments(parser) -> None:
+    """Add the backend options to an argparse parser."""
+    parser.add_argument("--backend", choices=list(LLM_BACKENDS),
+                        help="Language model backend (default: $EPOS_LLM_BACKEND or ollama)")
+    parser.add_argument("--backend-url", help="Backend server URL (default: $EPOS_LLM_URL or the backend's default)")
+    parser.add_argument("--timeout", type=float, help="Seconds to wait for a model reply")
+    parser.add_argument("--retries", type=int, help="Times a request failing with a transient error is retried")
+    parser.add_argument("--max-concurrency", type=int, help="Maximum model requests in flight at once")
+
+
+def configure_backend(args) -> LLMBackend:
+    """Create the backend from parsed command line options, make it the default and return it.
+
+    Options that were not given fall back to the environment.
+    """
+    settings = environment_settings()
+    if args.backend and args.backend != settings['name']:
+        # The environment's URL belongs to the environment's backend
+        settings.update(name=args.backend, base_url=None)
+    if args.backend_url:
+        settings['base_url'] = args.backend_url
+    for option in ('timeout', 'retries', 'max_concurrency'):
+        if getattr(args, option) is not None:
+            settings[option] = getattr(args, option)
+
+    backend = backend_from_settings(settings)
+    set_default_backend(backend)
+    return backend
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+plan_cache.py - Disk cache of generated plans, keyed on their inputs
+
+Generation runs at a low temperature, so the same questionnaire answers, on
+the same model, backend, prompt and organized corpus, produce essentially
+the same plan. Plans are stored under a hash of those things, after removing
+answers that do not reach the prompt (the PDF password, contact emails) and
+putting the rest in a canonical form, so a repeated submission is answered
+from disk instead of by a full model run.
+
+Entries expire after a time to live, and the least recently used ones are
+evicted once the cache grows past its size limit. The cache keeps a running
+total of its size, counted from disk on first use, so it only scans the
+directory when a write takes it over the limit.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+DEFAULT_PLAN_CACHE_DIR = Path(__file__).parent / "generated_plans" / "cache"
+DEFAULT_PLAN_CACHE_TTL = 7 * 24 * 3600  # One week, in seconds
+DEFAULT_PLAN_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Plan inputs that do not affect the generated plan
+PLAN_CACHE_EXCLUDED_FIELDS = ('pdf_password', 'user_email', 'primary_contact_email', 'email', 'force_regenerate')
+
+PLAN_FILE_SUFFIX = ".md"
+
+
+def canonical_plan_inputs(plan_inputs: Dict) -> Dict:
+    """The inputs that shape a plan, in a canonical form.
+
+    Excluded fields are dropped, text is stripped, and multiple-choice
+    answers are sorted, since the order they were picked in means nothing.
+    """
+    def canonical(value):
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, dict):
+            return {key: canonical(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            items = [canonical(item) for item in value]
+            return sorted(items, key=lambda item: json.dumps(item, sort_keys=True))
+        return value
+
+    return {key: canonical(value) for key, value in plan_inputs.items()
+            if key not in PLAN_CACHE_EXCLUDED_FIELDS}
+
+
+def plan_cache_key(plan_inputs: Dict, model_name: str, corpus_version: str, generator: str = "",
+                   prompt_fingerprint: str = "", backend: str = "") -> str:
+    """Content address of a plan: a hash of its canonical inputs, model, corpus, generator, prompt and backend.
+
+    prompt_fingerprint identifies the prompt templates (see
+    PlanGeneratorBase.prompt_fingerprint), so editing the instructions
+    stops old plans from being served.
+    """
+    payload = json.dumps({
+        'inputs': canonical_plan_inputs(plan_inputs),
+        'model': model_name,
+        'corpus': corpus_version,
+        'generator': generator,
+        'prompt': prompt_fingerprint,
+        'backend': backend
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PlanCache:
+    def __init__(self, cache_dir: str = None, ttl_seconds: float = DEFAULT_PLAN_CACHE_TTL,
+                 max_bytes: int = DEFAULT_PLAN_CACHE_MAX_BYTES):
+        """Initialize a cache of plan markdown files in cache_dir."""
+        self.cache_dir = Path(cache_dir) if cache_dir else DEFAULT_PLAN_CACHE_DIR
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Plans and bytes on disk, counted on first use and kept up to date
+        # by this process; eviction recounts, picking up other processes' writes
+        self._plans = None
+        self._bytes = None
+        # Guards eviction and the counters; file writes are atomic renames
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / (key + PLAN_FILE_SUFFIX)
+
+    def _entries(self) -> list:
+        """(last used, modified, size, path) of every plan on disk."""
+        entries = []
+        for path in self.cache_dir.glob(f"*/*{PLAN_FILE_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _count(self) -> None:
+        """Count the plans on disk, if not yet counted. Call with the lock held."""
+        if self._bytes is None:
+            entries = self._entries()
+            self._plans = len(entries)
+            self._bytes = sum(size for _, _, size, _ in entries)
+
+    def _removed(self, size: int) -> None:
+        """Record a removed plan of size bytes. Call with the lock held."""
+        if self._bytes is not None:
+            self._plans = max(0, self._plans - 1)
+            self._bytes = max(0, self._bytes - size)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached plan for key, or None if it is missing or expired."""
+        path = self._path(key)
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.ttl_seconds:
+                path.unlink()
+                with self._lock:
+                    self._removed(stat.st_size)
+                content = None
+            else:
+                content = path.read_text(encoding='utf-8')
+                # Access time records the last use, for eviction; the
+                # modification time is kept so a hit does not extend the TTL
+                os.utime(path, (time.time(), path.stat().st_mtime))
+        except FileNotFoundError:
+            content = None
+
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return content
+
+    def put(self, key: str, plan_content: str) -> None:
+        """Store a plan, then evict the least recently used plans if that took the cache past max_bytes."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_text(plan_content, encoding='utf-8')
+        size = temp_path.stat().st_size
+
+        with self._lock:
+            self._count()
+            try:
+                replaced_size = path.stat().st_size
+            except FileNotFoundError:
+                replaced_size = None
+            temp_path.replace(path)
+            if replaced_size is not None:
+                self._removed(replaced_size)
+            self._plans += 1
+            self._bytes += size
+            over_limit = self._bytes > self.max_bytes
+
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove expired plans, then the least recently used ones until under max_bytes.
+
+        Returns the number of plans removed.
+        """
+        with self._lock:
+            now = time.time()
+            entries = self._entries()
+
+            removed = 0
+            total_bytes = 0
+            kept = []
+            for last_used, modified, size, path in entries:
+                if now - modified > self.ttl_seconds:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+                else:
+                    kept.append((last_used, size, path))
+                    total_bytes += size
+
+            for last_used, size, path in sorted(kept, key=lambda entry: entry[0]):
+                if total_bytes <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total_bytes -= size
+                removed += 1
+
+            self._plans = len(entries) - removed
+            self._bytes = total_bytes
+            return removed
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size on disk."""
+        with self._lock:
+            self._count()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'plans': self._plans,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
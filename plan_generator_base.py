@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+"""
+plan_generator_base.py - Shared retrieval and generation core for the plan generators
+
+EmergencyPlanGenerator, EnhancedEmergencyPlanGenerator and
+EnhancedEmergencyPlanGeneratorV2 differ only in how they build their
+prompts. Loading the organized documents, mapping questionnaire answers to
+document categories, retrieving context, calling the model and writing plan
+files live here.
+
+A RetrievalEngine holds one copy of the organized corpus and its indexes.
+get_shared_engine() returns the same engine for the same store, so a process
+serving all three generators keeps a single index in memory. A corpus other
+than the default raw text (EmergencyPlanGenerator uses the anonymized
+documents) is organized into its own store.
+
+Besides one completion for the whole plan, a plan can be generated section
+by section (see plan_sections.py): each section gets its own prompt and
+retrieved context, and the section prompts run concurrently against the
+model server (set OLLAMA_NUM_PARALLEL on the server to match).
+
+Prompts are sent as two chat messages. The system message holds everything
+that is the same for every organization of a type: the system instructions
+and the organization-type guidelines. The user message holds the retrieved
+context, in a deterministic order, then the organization's own inputs and the
+request: the ten-section plan structure for a whole plan, or a single
+section. Whole-plan and section prompts therefore share the system message,
+and requests share a long identical prefix, which Ollama keeps cached while
+the model stays loaded (see keep_alive) and does not prefill again.
+
+Retrieval, prompt assembly, model calls and saving are timed as telemetry
+spans (see plan_telemetry.py), along with the model's token usage.
+"""
+
+import contextvars
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from context_assembler import DEFAULT_PROMPT_TOKEN_BUDGET, ContextAssembler
+from document_organizer import DEFAULT_CONTEXT_TOP_K, DocumentOrganizer
+from embedding_index import OllamaEmbedder
+from llm_backends import LLMBackend, get_default_backend
+from plan_cache import plan_cache_key
+from plan_sections import (SECTION_REQUEST_TEMPLATE, SectionGenerationError, get_plan_sections, section_request,
+                           stitch_sections)
+from plan_telemetry import TELEMETRY
+
+DEFAULT_ORGANIZED_DATA_DIR = Path(__file__).parent / "training_materials" / "organized"
+# Documents with names, phone numbers and other personal details removed
+ANONYMIZED_DATA_DIR = Path(__file__).parent / "training_materials" / "processed" / "all_text" / "anonymized"
+GENERATED_PLANS_DIR = Path(__file__).parent / "generated_plans"
+
+# Questionnaire answers -> document organizer categories
+ORGANIZATION_TYPE_CATEGORIES = {
+    "Educational Institution": "educational",
+    "Healthcare Facility": "healthcare",
+    "Corporate Office": "corporate",
+    "Manufacturing Plant": "industrial",
+    "Retail Store": "retail",
+    "Government Agency": "government",
+    "Non-Profit": "non_profit"
+}
+
+HAZARD_CATEGORIES = {
+    "Fire": "fire",
+    "Earthquake": "earthquake",
+    "Flood": "flood",
+    "Severe Weather": "severe_weather",
+    "Power Outage": "power_outage",
+    "Chemical Spill": "chemical_spill",
+    "Medical Emergency": "medical_emergency",
+    "Security Threat": "workplace_violence",
+    "Workplace Violence": "workplace_violence",
+    "Cyber Attack": "cyber_attack",
+    "Transportation Accident": "transportation_accident"
+}
+
+# Number of ranked chunks retrieved as candidates for the prompt; the context
+# assembler keeps as many of the best ones as the token budget allows
+CONTEXT_CANDIDATES = 40
+
+# Generation options shared by every generator
+GENERATION_OPTIONS = {
+    'temperature': 0.1,  # Low temperature for consistent, professional output
+    'num_predict': 4000   # Allow longer responses
+}
+
+# How long Ollama keeps the model, and its cached prompt prefix, loaded after
+# a request (Ollama's own default is 5 minutes)
+DEFAULT_KEEP_ALIVE = "30m"
+
+# Section-by-section generation: each completion is one section of the plan,
+# and each prompt gets a smaller budget since ten of them are prefilled
+SECTION_GENERATION_OPTIONS = dict(GENERATION_OPTIONS, num_predict=1000)
+
+# Written in place of the footer when a streamed plan stops part way
+INCOMPLETE_PLAN_MARKER = ("\n\n---\n\n**⚠️ INCOMPLETE — generation failed.** This plan stopped before it "
+                          "was finished and must not be used. Generate it again.\n")
+DEFAULT_SECTION_TOKEN_BUDGET = 5000
+DEFAULT_SECTION_PARALLELISM = 4
+# Times a failed section is attempted again before giving up on it
+DEFAULT_SECTION_RETRIES = 1
+
+
+def organized_dir_for(data_dir: str = None) -> Path:
+    """Default organized store for a document directory.
+
+    The default corpus uses DEFAULT_ORGANIZED_DATA_DIR; any other gets a
+    directory of its own below it, so stores built from different documents
+    are never mixed.
+    """
+    if not data_dir:
+        return DEFAULT_ORGANIZED_DATA_DIR
+    path = Path(data_dir).resolve()
+    digest = hashlib.sha256(str(path).encode('utf-8')).hexdigest()[:8]
+    return DEFAULT_ORGANIZED_DATA_DIR / f"{path.name}_{digest}"
+
+
+class RetrievalEngine:
+    def __init__(self, organized_data_dir: str = None, embedding_model: str = None, data_dir: str = None):
+        """Load the organized documents (organizing them from data_dir first if needed)."""
+        self.organized_data_path = Path(organized_data_dir) if organized_data_dir else organized_dir_for(data_dir)
+
+        # Optional semantic retrieval with an Ollama embedding model
+        embedder = OllamaEmbedder(embedding_model) if embedding_model else None
+        self.document_organizer = DocumentOrganizer(data_dir=data_dir, output_dir=str(self.organized_data_path),
+                                                    embedder=embedder)
+        self.load_organized_documents()
+
+    def load_organized_documents(self) -> None:
+        """Load the organized emergency management documents."""
+        print("📚 Loading organized emergency management documents...")
+
+        organized_file = self.organized_data_path / "organized_documents.json"
+        try:
+            loaded = self.document_organizer.load_organization(str(self.organized_data_path))
+        except Exception as e:
+            print(f"⚠️ Error loading organized documents: {e}")
+            print("🔄 Reorganizing documents...")
+            self.document_organizer.categorize_documents()
+        else:
+            if loaded:
+                print(f"✅ Loaded organized documents from: {organized_file}")
+            else:
+                print("🔄 Organized documents not found. Creating organization...")
+                self.document_organizer.categorize_documents()
+
+    @property
+    def organized_docs(self) -> Dict:
+        """Category -> subcategory -> document ids; bodies live in the organizer."""
+        return self.document_organizer.organized_docs
+
+    def map_criteria(self, organization_type: str, hazards: List[str]) -> Tuple[str, List[str]]:
+        """Map questionnaire answers to the organizer's category names."""
+        mapped_org_type = ORGANIZATION_TYPE_CATEGORIES.get(organization_type, "corporate")
+        mapped_hazards = [HAZARD_CATEGORIES.get(hazard, hazard.lower().replace(" ", "_")) for hazard in hazards]
+        return mapped_org_type, mapped_hazards
+
+    def get_relevant_chunks(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                            free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> List[Dict]:
+        """Get the top ranked document chunks based on organization type and hazards."""
+        mapped_org_type, mapped_hazards = self.map_criteria(organization_type, hazards)
+        return self.document_organizer.search(mapped_org_type, mapped_hazards, procedures, free_text, top_k)
+
+    def get_relevant_context(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                             free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> str:
+        """Get the most relevant document passages based on organization type and hazards."""
+        mapped_org_type, mapped_hazards = self.map_criteria(organization_type, hazards)
+        return self.document_organizer.get_relevant_context(mapped_org_type, mapped_hazards, procedures,
+                                                            free_text, top_k)
+
+
+_shared_engines = {}
+_shared_engines_lock = threading.Lock()
+
+
+def get_shared_engine(organized_data_dir: str = None, embedding_model: str = None,
+                      data_dir: str = None) -> RetrievalEngine:
+    """Return the process-wide engine for a store, loading it on first use.
+
+    data_dir is the directory of source documents (the organizer's raw text
+    by default).
+    """
+    path = Path(organized_data_dir) if organized_data_dir else organized_dir_for(data_dir)
+    source = str(Path(data_dir).resolve()) if data_dir else None
+    key = (str(path.resolve()), embedding_model, source)
+    with _shared_engines_lock:
+        if key not in _shared_engines:
+            _shared_engines[key] = RetrievalEngine(str(path), embedding_model, data_dir)
+        return _shared_engines[key]
+
+
+def parse_keep_alive(value: str) -> Union[str, int, float]:
+    """Ollama keep_alive from a command line value.
+
+    Ollama reads a number as seconds (a negative one keeps the model loaded
+    until the server stops) and a string as a duration with a unit, such as
+    "30m"; the string "-1" is rejected, so numbers are passed as numbers.
+    """
+    for number in (int, float):
+        try:
+            return number(value)
+        except ValueError:
+            pass
+    return value
+
+
+def add_keep_alive_argument(parser) -> None:
+    """Add the --keep-alive option to an argparse parser."""
+    parser.add_argument("--keep-alive", type=parse_keep_alive, default=DEFAULT_KEEP_ALIVE,
+                        help="How long Ollama keeps the model and cached prompt prefix loaded "
+                             "(e.g. 30m, 24h, or seconds; -1 for always)")
+
+
+class PlanGeneratorBase:
+    # Plan files are saved as <prefix>_<organization>_<timestamp>.md
+    PLAN_FILE_PREFIX = "emergency_plan"
+    
+    def __init__(self, model_name: str = "llama3.2:1b", organized_data_dir: str = None,
+                 prompt_token_budget: int = DEFAULT_PROMPT_TOKEN_BUDGET, embedding_model: str = None,
+                 engine: RetrievalEngine = None, keep_alive: str = DEFAULT_KEEP_ALIVE,
+                 backend: LLMBackend = None, data_dir: str = None):
+        """Initialize a generator on the shared retrieval engine and model backend (or the ones given).
+
+        data_dir is the directory of source documents the engine is
+        organized from.
+        """
+        self.model_name = model_name
+        self.keep_alive = keep_alive
+        self.backend = backend or get_default_backend()
+        self.engine = engine or get_shared_engine(organized_data_dir, embedding_model, data_dir)
+        self.organized_data_path = self.engine.organized_data_path
+        self.document_organizer = self.engine.document_organizer
+        self.context_assembler = ContextAssembler(prompt_token_budget)
+        self.last_prompt_report = None
+        self.last_section_reports = {}
+        self.last_plan_path = None
+
+    @property
+    def organized_docs(self) -> Dict:
+        """Category -> subcategory -> document ids of the shared corpus."""
+        return self.engine.organized_docs
+
+    def get_relevant_chunks(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                            free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> List[Dict]:
+        """Get the top ranked document chunks based on organization type and hazards."""
+        return self.engine.get_relevant_chunks(organization_type, hazards, procedures, free_text, top_k)
+
+    def get_relevant_context(self, organization_type: str, hazards: List[str], procedures: List[str] = None,
+                             free_text: str = None, top_k: int = DEFAULT_CONTEXT_TOP_K) -> str:
+        """Get the most relevant document passages based on organization type and hazards."""
+        return self.engine.get_relevant_context(organization_type, hazards, procedures, free_text, top_k)
+
+    def print_prompt_report(self) -> None:
+        """Print the size of the last assembled prompt."""
+        report = self.last_prompt_report
+        print(f"📏 Prompt size: ~{report['total_tokens']} tokens "
+              f"(context {report['sections']['context']}/{report['context_budget']} tokens, "
+              f"{report['passages_used']} passages)")
+
+    def call_model(self, messages: List[Dict], options: Dict = None) -> str:
+        """Send chat messages to the language model and return its reply."""
+        with TELEMETRY.span('model', model=self.model_name, backend=self.backend.name) as span:
+            response = self.backend.chat(self.model_name, messages, options or GENERATION_OPTIONS, self.keep_alive)
+            usage = response['usage']
+            span.update(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+        TELEMETRY.record_usage(usage, model=self.model_name)
+        return response['content']
+
+    def stream_model(self, messages: List[Dict]) -> Iterator[str]:
+        """Send chat messages to the language model and yield its reply as it is generated."""
+        def on_usage(usage):
+            span.update(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+            TELEMETRY.record_usage(usage, model=self.model_name)
+
+        with TELEMETRY.span('model', model=self.model_name, backend=self.backend.name, stream=True) as span:
+            started = time.perf_counter()
+            for piece in self.backend.stream_chat(self.model_name, messages, GENERATION_OPTIONS, self.keep_alive,
+                                                  on_usage):
+                if 'first_token_seconds' not in span:
+                    span['first_token_seconds'] = round(time.perf_counter() - started, 3)
+                yield piece
+
+    def prompt_components(self, inputs: Dict) -> Dict:
+        """The parts of the prompt that do not depend on retrieval.
+
+        Returns {'system_instructions': str, 'plan_instructions': str,
+        'guideline_sections': [(name, heading, text)],
+        'organization_sections': [(name, heading, text)], 'criteria': {...}}.
+        plan_instructions is the whole-plan request. Guideline sections may
+        depend on the organization type but nothing else, as they go in the
+        system message; organization sections hold the inputs of one
+        request. criteria are the get_relevant_chunks arguments
+        (organization_type, hazards, procedures, free_text).
+        """
+        raise NotImplementedError
+
+    def system_prompt(self, components: Dict) -> str:
+        """The system message: instructions shared by every request for an organization type.
+
+        It leaves out the plan structure, which goes in the whole-plan
+        request, so a section prompt is not also asked for the whole plan.
+        """
+        parts = [components['system_instructions']]
+        parts += [f"{heading}:\n{text}" for _, heading, text in components['guideline_sections']]
+        return "\n\n".join(parts)
+
+    def retrieve_chunks(self, components: Dict, procedures: List[str] = None,
+                        free_text: str = None) -> List[Dict]:
+        """Candidate context chunks for the components' criteria, plus extra procedures and free text."""
+        criteria = components['criteria']
+        all_procedures = list(criteria.get('procedures') or [])
+        all_procedures += [procedure for procedure in procedures or [] if procedure not in all_procedures]
+        all_free_text = ' '.join(filter(None, [criteria.get('free_text'), free_text])) or None
+        with TELEMETRY.span('retrieval', organization_type=criteria['organization_type']) as span:
+            chunks = self.get_relevant_chunks(criteria['organization_type'], criteria['hazards'], all_procedures,
+                                              free_text=all_free_text, top_k=CONTEXT_CANDIDATES)
+            span['chunks'] = len(chunks)
+        return chunks
+
+    def messages_for_chunks(self, components: Dict, request: str, chunks: List[Dict],
+                            context_assembler: ContextAssembler = None) -> Tuple[List[Dict], Dict]:
+        """Build the chat messages from retrieved chunks.
+
+        The context comes first in the user message: it depends only on the
+        criteria, so requests with the same criteria share it as part of
+        their prefix. Returns (messages, report) where report is the context
+        assembler's size report.
+        """
+        fixed_sections = {'system_instructions': components['system_instructions']}
+        for name, _, text in components['guideline_sections'] + components['organization_sections']:
+            fixed_sections[name] = text
+        fixed_sections['request'] = request
+        with TELEMETRY.span('prompt_assembly') as span:
+            # Pack the best chunks into the token budget left by the fixed sections
+            assembled = (context_assembler or self.context_assembler).assemble(fixed_sections, chunks)
+
+            parts = [f"RELEVANT EMERGENCY MANAGEMENT TEMPLATES AND BEST PRACTICES:\n{assembled['context']}"]
+            parts += [f"{heading}:\n{text}" for _, heading, text in components['organization_sections']]
+            parts.append(request)
+            messages = [
+                {
+                    'role': 'system',
+                    'content': self.system_prompt(components)
+                },
+                {
+                    'role': 'user',
+                    'content': "\n\n".join(parts)
+                }
+            ]
+            span.update(prompt_tokens=assembled['report']['total_tokens'],
+                        passages=assembled['report']['passages_used'])
+        return messages, assembled['report']
+
+    def compose_messages(self, components: Dict, request: str, procedures: List[str] = None,
+                         free_text: str = None,
+                         context_assembler: ContextAssembler = None) -> Tuple[List[Dict], Dict]:
+        """Retrieve context for the components' criteria and build the chat messages.
+
+        procedures and free_text are added to the criteria. Returns
+        (messages, report).
+        """
+        chunks = self.retrieve_chunks(components, procedures, free_text)
+        return self.messages_for_chunks(components, request, chunks, context_assembler)
+
+    def build_messages_from_components(self, components: Dict) -> List[Dict]:
+        """Build the chat messages asking for a whole plan."""
+        messages, self.last_prompt_report = self.compose_messages(components, components['plan_instructions'])
+        return messages
+
+    def build_messages(self, inputs: Dict) -> List[Dict]:
+        """Build the chat messages asking for a whole plan for questionnaire inputs."""
+        return self.build_messages_from_components(self.prompt_components(inputs))
+
+    def prompt_fingerprint(self, components: Dict) -> str:
+        """Hash of the prompt templates a plan is generated from.
+
+        Covers the system prompt (instructions and guidelines), the
+        whole-plan and section requests and the generation options;
+        changing any of them changes the plans a generator produces.
+        """
+        payload = json.dumps([self.system_prompt(components), components['plan_instructions'],
+                              SECTION_REQUEST_TEMPLATE, GENERATION_OPTIONS, SECTION_GENERATION_OPTIONS],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def plan_cache_key(self, inputs: Dict, components: Dict = None) -> str:
+        """Key of this generator's plan for questionnaire inputs in a PlanCache.
+
+        It covers the canonical inputs, the model and backend, the generator,
+        its prompt templates and the version of the organized corpus, so a
+        new model, an edited prompt or a rebuilt corpus never returns an old
+        plan. components are prompt_components(inputs), if already built.
+        """
+        if components is None:
+            components = self.prompt_components(inputs)
+        return plan_cache_key(inputs, self.model_name, self.document_organizer.store_version,
+                              self.PLAN_FILE_PREFIX, self.prompt_fingerprint(components), self.backend.name)
+
+    def plan_header(self, inputs: Dict) -> str:
+        """Disclaimer and metadata written above the generated plan."""
+        raise NotImplementedError
+
+    def plan_footer(self) -> str:
+        """Disclaimer written below the generated plan."""
+        raise NotImplementedError
+
+    def plan_filepath(self, inputs: Dict) -> Path:
+        """Path of a new plan file for an organization."""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        org_name = inputs['organization_name'].replace(' ', '_').replace('/', '_')
+        # Queue workers can start plans for one organization in the same second
+        unique = uuid.uuid4().hex[:8]
+        filepath = GENERATED_PLANS_DIR / f"{self.PLAN_FILE_PREFIX}_{org_name}_{timestamp}_{unique}.md"
+
+        # Create directory if it doesn't exist
+        filepath.parent.mkdir(exist_ok=True)
+        return filepath
+
+    def save_plan(self, plan_content: str, inputs: Dict) -> str:
+        """Save the generated plan to a file."""
+        filepath = self.plan_filepath(inputs)
+        with TELEMETRY.span('save', characters=len(plan_content)):
+            with open(filepath, 'w', encoding='utf-8') as f:
+                f.write(self.plan_header(inputs) + plan_content + self.plan_footer())
+
+        self.last_plan_path = str(filepath)
+        return str(filepath)
+
+    def stream_plan(self, inputs: Dict, on_token: Callable[[str], None] = None) -> Iterator[str]:
+        """Generate a plan, yielding each piece of text as the model produces it.
+
+        The plan file is created before generation starts (its path is in
+        last_plan_path) and every piece is appended and flushed as it
+        arrives, so a plan in progress can be followed on disk. on_token, if
+        given, is called with each piece. Errors are raised, not returned;
+        if generation stops part way the file ends with
+        INCOMPLETE_PLAN_MARKER instead of the footer.
+        """
+        messages = self.build_messages(inputs)
+        self.print_prompt_report()
+
+        filepath = self.plan_filepath(inputs)
+        self.last_plan_path = str(filepath)
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(self.plan_header(inputs))
+            f.flush()
+            completed = False
+            try:
+                for piece in self.stream_model(messages):
+                    f.write(piece)
+                    f.flush()
+                    if on_token:
+                        on_token(piece)
+                    yield piece
+                completed = True
+            finally:
+                f.write(self.plan_footer() if completed else INCOMPLETE_PLAN_MARKER)
+
+    def generate_plan_streaming(self, inputs: Dict, on_token: Callable[[str], None] = None) -> Tuple[str, str]:
+        """Stream a plan to its file, calling on_token with each piece.
+
+        Returns (plan_content, filepath).
+        """
+        plan_content = "".join(self.stream_plan(inputs, on_token))
+        return plan_content, self.last_plan_path
+
+    def build_section_messages(self, components: Dict, section: Dict,
+                               context_assembler: ContextAssembler) -> Tuple[List[Dict], Dict]:
+        """Build the chat messages for one plan section, with context retrieved for that section.
+
+        The system message is the same as for a whole plan, so every section
+        shares its cached prefix. Returns (messages, report).
+        """
+        return self.compose_messages(components, section_request(section), section['procedures'],
+                                     section['query'], context_assembler)
+
+    def generate_section(self, section: Dict, messages: List[Dict], retries: int = DEFAULT_SECTION_RETRIES) -> str:
+        """Generate one plan section, trying again up to retries times if it fails."""
+        for attempt in range(retries + 1):
+            try:
+                return self.call_model(messages, SECTION_GENERATION_OPTIONS)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"⚠️ Section {section['number']}. {section['title']} failed ({e}), retrying...")
+
+    def generate_sections(self, inputs: Dict, sections: List[int] = None,
+                          parallelism: int = DEFAULT_SECTION_PARALLELISM,
+                          retries: int = DEFAULT_SECTION_RETRIES,
+                          section_token_budget: int = DEFAULT_SECTION_TOKEN_BUDGET,
+                          on_section: Callable[[int, str], None] = None) -> Dict[int, str]:
+        """Generate plan sections concurrently, parallelism at a time.
+
+        sections are section numbers (all ten by default), so sections that
+        failed can be generated again on their own. Returns section number ->
+        text. on_section, if given, is called with each section as it
+        completes. Raises SectionGenerationError, holding the completed
+        sections, if any section still fails after its retries.
+        """
+        plan_sections = get_plan_sections(sections)
+        components = self.prompt_components(inputs)
+        context_assembler = ContextAssembler(section_token_budget, self.context_assembler.duplicate_similarity)
+
+        # Retrieval takes milliseconds; only the model calls run concurrently
+        section_messages = {}
+        self.last_section_reports = {}
+        for section in plan_sections:
+            messages, report = self.build_section_messages(components, section, context_assembler)
+            section_messages[section['number']] = messages
+            self.last_section_reports[section['number']] = report
+        total_tokens = sum(report['total_tokens'] for report in self.last_section_reports.values())
+        print(f"📏 {len(plan_sections)} section prompts, ~{total_tokens} tokens in total")
+
+        completed = {}
+        failed = {}
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            # Each section runs in a copy of this context, so its spans keep the caller's trace id
+            futures = {
+                executor.submit(contextvars.copy_context().run, self.generate_section, section,
+                                section_messages[section['number']], retries): section
+                for section in plan_sections
+            }
+            for future in as_completed(futures):
+                section = futures[future]
+                try:
+                    completed[section['number']] = future.result()
+                except Exception as e:
+                    failed[section['number']] = str(e)
+                    print(f"❌ Section {section['number']}. {section['title']} failed: {e}")
+                    continue
+                print(f"✍️ Section {section['number']}. {section['title']} done "
+                      f"({time.time() - started:.1f}s)")
+                if on_section:
+                    on_section(section['number'], completed[section['number']])
+
+        if failed:
+            raise SectionGenerationError(failed, completed)
+        return completed
+
+    def generate_plan_by_sections(self, inputs: Dict, parallelism: int = DEFAULT_SECTION_PARALLELISM,
+                                  retries: int = DEFAULT_SECTION_RETRIES) -> str:
+        """Generate every plan section concurrently and join them in order."""
+        return stitch_sections(self.generate_sections(inputs, parallelism=parallelism, retries=retries))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+plan_sections.py - The ten sections of a generated emergency plan
+
+Every generator asks for the same ten sections. Listing them here, with the
+procedures and search terms that find reference material for each one, lets
+a plan be generated one section at a time: each section gets its own prompt
+and its own retrieved context, sections can run concurrently against the
+model server, and a section that fails can be generated again on its own.
+"""
+
+from typing import Dict, List
+
+# procedures are DocumentOrganizer procedure categories; query is free text
+# added to the organization's criteria when retrieving context for the section
+PLAN_SECTIONS = [
+    {
+        'number': 1,
+        'title': 'EXECUTIVE SUMMARY',
+        'description': 'Brief overview tailored to this organization',
+        'procedures': [],
+        'query': 'emergency plan purpose scope overview'
+    },
+    {
+        'number': 2,
+        'title': 'ORGANIZATION PROFILE',
+        'description': 'Description of the organization and its emergency management context',
+        'procedures': [],
+        'query': 'organization facility occupants population profile'
+    },
+    {
+        'number': 3,
+        'title': 'HAZARD ANALYSIS',
+        'description': 'Assessment of the identified primary hazards and risks',
+        'procedures': [],
+        'query': 'hazard identification risk assessment vulnerability'
+    },
+    {
+        'number': 4,
+        'title': 'EMERGENCY RESPONSE PROCEDURES',
+        'description': 'Step-by-step procedures for each identified hazard',
+        'procedures': ['medical_response', 'security', 'hazardous_materials'],
+        'query': 'emergency response procedures actions'
+    },
+    {
+        'number': 5,
+        'title': 'ROLES AND RESPONSIBILITIES',
+        'description': 'Clear assignment of emergency management roles',
+        'procedures': [],
+        'query': 'roles responsibilities emergency coordinator wardens'
+    },
+    {
+        'number': 6,
+        'title': 'COMMUNICATION PLAN',
+        'description': 'Emergency communication procedures using available methods',
+        'procedures': ['communication'],
+        'query': 'emergency communication notification contacts'
+    },
+    {
+        'number': 7,
+        'title': 'EVACUATION PROCEDURES',
+        'description': 'Specific evacuation plans considering building and population',
+        'procedures': ['evacuation', 'transportation'],
+        'query': 'evacuation routes assembly area shelter in place'
+    },
+    {
+        'number': 8,
+        'title': 'EMERGENCY RESOURCES',
+        'description': 'Utilization of available emergency equipment and resources',
+        'procedures': [],
+        'query': 'emergency equipment supplies resources'
+    },
+    {
+        'number': 9,
+        'title': 'TRAINING REQUIREMENTS',
+        'description': 'Recommended training based on the hazards and organization type',
+        'procedures': [],
+        'query': 'training drills exercises'
+    },
+    {
+        'number': 10,
+        'title': 'PLAN MAINTENANCE',
+        'description': 'Procedures for keeping the plan current and effective',
+        'procedures': [],
+        'query': 'plan review revision maintenance testing'
+    }
+]
+
+# Statements every plan must carry; a sectioned plan requests them in the
+# executive summary
+PLAN_CRITICAL_REQUIREMENTS = """CRITICAL REQUIREMENTS:
+- Include a clear statement that professional review and validation is required before implementation
+- Emphasize that users assume full responsibility for the plan's effectiveness and compliance
+- State that this plan is a starting point and may require significant customization
+- Mention that local regulations and industry standards must be verified
+- Include a note about regular review and updates being necessary"""
+
+# Request for a whole plan, shared by every generator so their prompts (and
+# the model server's cached prefix) stay the same
+PLAN_REQUEST_TEMPLATE = """Please create a detailed, practical emergency plan that includes:
+
+{sections}
+
+{requirements}
+
+Make the plan specific to the organization's characteristics, hazards, and resources. Use professional emergency management terminology and follow established best practices from the {reference_documents}. The plan should be immediately actionable and practical for implementation.
+
+Format the plan with clear headings, bullet points, and actionable steps. Make it comprehensive but readable."""
+
+SECTION_REQUEST_TEMPLATE = """You are writing one section of a larger emergency plan. The other sections are written separately, so do not write an introduction to the whole plan or any other section.
+
+Write section {number} of the plan: **{title}** - {description}
+
+Start with the heading "## {number}. {title}".
+{requirements}
+Make the section specific to the organization's characteristics, hazards, and resources. Use professional emergency management terminology and follow established best practices from the relevant template documents.
+
+Format the section with clear headings, bullet points, and actionable steps."""
+
+
+def get_plan_sections(numbers: List[int] = None) -> List[Dict]:
+    """The plan sections with the given numbers (all of them by default), in order."""
+    if numbers is None:
+        return list(PLAN_SECTIONS)
+    unknown = set(numbers) - {section['number'] for section in PLAN_SECTIONS}
+    if unknown:
+        raise ValueError(f"Unknown plan section(s): {', '.join(str(n) for n in sorted(unknown))}")
+    return [section for section in PLAN_SECTIONS if section['number'] in numbers]
+
+
+def plan_request(reference_documents: str = "relevant template documents") -> str:
+    """Instructions asking the model for a whole plan with every section."""
+    sections = "\n".join(f"{section['number']}. **{section['title']}** - {section['description']}"
+                         for section in PLAN_SECTIONS)
+    return PLAN_REQUEST_TEMPLATE.format(sections=sections, requirements=PLAN_CRITICAL_REQUIREMENTS,
+                                        reference_documents=reference_documents)
+
+
+def section_request(section: Dict) -> str:
+    """Instructions asking the model for a single plan section."""
+    requirements = f"\n{PLAN_CRITICAL_REQUIREMENTS}\n" if section['number'] == 1 else ""
+    return SECTION_REQUEST_TEMPLATE.format(requirements=requirements, **section)
+
+
+def stitch_sections(section_texts: Dict[int, str]) -> str:
+    """Join generated sections (section number -> text) in plan order."""
+    return "\n\n".join(section_texts[number].strip() for number in sorted(section_texts))
+
+
+class SectionGenerationError(Exception):
+    def __init__(self, failed: Dict[int, str], completed: Dict[int, str]):
+        """Raised when sections still fail after their retries.
+
+        failed maps section numbers to error messages and completed holds the
+        sections that were generated, so only the failed ones need to be
+        generated again.
+        """
+        self.failed = failed
+        self.completed = completed
+        numbers = ', '.join(str(number) for number in sorted(failed))
+        super().__init__(f"Plan section(s) {numbers} failed to generate")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+plan_telemetry.py - Timing spans and token usage of the plan pipeline
+
+Each stage of generating a plan (input structuring, retrieval, prompt
+assembly, the model call, saving, PDF rendering) runs inside a span:
+
+    with TELEMETRY.span('retrieval', organization_type=org_type):
+        ...
+
+A finished span is added to per-stage aggregates (count, errors, total and
+maximum duration, a latency histogram) and, when JSON logging is enabled, is
+written as one JSON record per line. Spans opened inside TELEMETRY.trace()
+carry its trace id, so the records of one plan can be grouped.
+
+Model replies add their token usage to counters, and the model server's own
+timings, when it reports them (Ollama's prompt_eval_duration and
+eval_duration, llama.cpp's timings), are recorded as the model_prefill and
+model_eval stages.
+
+JSON logging is enabled with --telemetry-log on the command line tools or
+the EPOS_TELEMETRY_LOG environment variable ('-' for stderr, or a file).
+"""
+
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator
+
+TELEMETRY_LOG_ENV = "EPOS_TELEMETRY_LOG"
+
+# Upper bounds, in seconds, of the latency histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+# Token usage fields of a backend reply, summed into counters
+USAGE_COUNTERS = ('prompt_tokens', 'completion_tokens')
+
+TELEMETRY_LOGGER = logging.getLogger("epos.telemetry")
+
+_current_trace = contextvars.ContextVar('epos_trace_id', default=None)
+
+
+class StageStats:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        """Aggregated durations of one stage."""
+        self.buckets = buckets
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * len(buckets)
+
+    def add(self, seconds: float, error: bool = False) -> None:
+        self.count += 1
+        self.errors += int(error)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def as_dict(self) -> Dict:
+        # Cumulative counts, as histogram buckets are usually reported
+        cumulative = []
+        running = 0
+        for count in self.bucket_counts:
+            running += count
+            cumulative.append(running)
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count else 0.0,
+            'max_seconds': self.max_seconds,
+            'buckets': dict(zip(self.buckets, cumulative))
+        }
+
+
+class Telemetry:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        """Initialize empty stage aggregates and counters."""
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget every recorded span and counter."""
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    @contextmanager
+    def trace(self, trace_id: str = None) -> Iterator[str]:
+        """Tag the spans opened inside with a trace id (a new one by default)."""
+        trace_id = trace_id or uuid.uuid4().hex
+        token = _current_trace.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            _current_trace.reset(token)
+
+    @contextmanager
+    def span(self, stage: str, **attributes) -> Iterator[Dict]:
+        """Time the enclosed block as a stage.
+
+        Yields the span's attributes, which the block can add to (token
+        counts, sizes, ...) before the span is recorded.
+        """
+        started = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if error is not None:
+                attributes['error'] = f"{type(error).__name__}: {error}"
+            self.record(stage, time.perf_counter() - started, error is not None, **attributes)
+
+    def record(self, stage: str, seconds: float, error: bool = False, **attributes) -> None:
+        """Record a stage measured elsewhere, e.g. by the model server."""
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.buckets)
+            self.stages[stage].add(seconds, error)
+
+        if TELEMETRY_LOGGER.isEnabledFor(logging.INFO):
+            record = {
+                'timestamp': datetime.now().isoformat(),
+                'event': 'span',
+                'stage': stage,
+                'duration_ms': round(seconds * 1000, 3),
+                'status': 'error' if error else 'ok',
+                'trace_id': _current_trace.get()
+            }
+            record.update(attributes)
+            TELEMETRY_LOGGER.info(json.dumps(record, default=str))
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_usage(self, usage: Dict, **attributes) -> None:
+        """Count a model reply's tokens and record the server's prefill and generation timings."""
+        for name in USAGE_COUNTERS:
+            if usage.get(name) is not None:
+                self.count(name, usage[name])
+        self.count('model_requests')
+        if usage.get('prompt_eval_seconds') is not None:
+            self.record('model_prefill', usage['prompt_eval_seconds'],
+                        tokens=usage.get('prompt_tokens'), **attributes)
+        if usage.get('eval_seconds') is not None:
+            self.record('model_eval', usage['eval_seconds'],
+                        tokens=usage.get('completion_tokens'), **attributes)
+
+    def stats(self) -> Dict:
+        """Aggregates of every stage and the counters."""
+        with self._lock:
+            return {
+                'stages': {stage: stats.as_dict() for stage, stats in self.stages.items()},
+                'counters': dict(self.counters)
+            }
+
+    def print_summary(self) -> None:
+        """Print each stage's timings and the token counters."""
+        stats = self.stats()
+        if not stats['stages']:
+            return
+        print("\n⏱️ Stage timings")
+        for stage, summary in stats['stages'].items():
+            errors = f", {summary['errors']} failed" if summary['errors'] else ""
+            print(f"  {stage:<20} {summary['count']:>4}x  mean {summary['mean_seconds'] * 1000:9.1f} ms  "
+                  f"max {summary['max_seconds'] * 1000:9.1f} ms{errors}")
+        counters = stats['counters']
+        if counters.get('model_requests'):
+            print(f"  tokens: {counters.get('prompt_tokens', 0):.0f} prompt, "
+                  f"{counters.get('completion_tokens', 0):.0f} completion "
+                  f"in {counters['model_requests']:.0f} model requests")
+
+
+# Process-wide telemetry, shared by every generator
+TELEMETRY = Telemetry()
+
+
+def enable_json_logging(destination: str) -> None:
+    """Write span records as JSON lines to a file, or to stderr for '-'."""
+    if destination == '-':
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(destination, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    TELEMETRY_LOGGER.addHandler(handler)
+    TELEMETRY_LOGGER.setLevel(logging.INFO)
+    TELEMETRY_LOGGER.propagate = False
+
+
+def add_telemetry_arguments(parser) -> None:
+    """Add the telemetry options to an argparse parser."""
+    parser.add_argument("--telemetry-log",
+                        help="Write JSON timing records to this file, or '-' for stderr "
+                             "(default: $EPOS_TELEMETRY_LOG)")
+
+
+def configure_telemetry(args=None) -> None:
+    """Enable JSON logging from parsed command line options or the environment."""
+    destination = getattr(args, 'telemetry_log', None) or os.environ.get(TELEMETRY_LOG_ENV)
+    if destination and not TELEMETRY_LOGGER.handlers:
+        enable_json_logging(destination)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+query_cache.py - Bounded LRU cache for retrieval results
+
+Plan requests repeat a small number of organization type / hazard
+combinations, so retrieval results are cached in memory, shared by every
+DocumentOrganizer in the process. Callers put a version of the organized
+store in their keys, so entries for a store that has since changed are
+never returned and age out of the cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+DEFAULT_CACHE_SIZE = 256
+
+
+class QueryCache:
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        """Initialize an empty cache holding at most maxsize entries."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # The queue worker and the API server share the cache
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, marking it recently used."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop every entry; the hit/miss counters are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+search_index.py - BM25 inverted index for ranking document chunks
+
+The index maps each term to a posting list of (chunk number, term frequency)
+pairs and scores chunks against a bag-of-words query with Okapi BM25, so
+context retrieval can return the few most relevant passages instead of every
+document that matched a category.
+"""
+
+import json
+import math
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SEARCH_INDEX_FILENAME = "search_index.json"
+
+# search_index.json layout version. Version 1 chunks were plain byte ranges,
+# version 2 chunks also carry their heading lineage and categories.
+SEARCH_INDEX_FORMAT_VERSION = 2
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have',
+    'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'their', 'this', 'to',
+    'was', 'were', 'will', 'with'
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase text and split it into alphanumeric tokens, dropping stopwords."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """Initialize an empty index with the given BM25 parameters."""
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.chunk_lengths = []
+        self.average_length = 0.0
+
+    @classmethod
+    def build(cls, chunk_tokens: Iterable[List[str]], **params) -> "BM25Index":
+        """Build an index from the token list of each chunk, in chunk order."""
+        index = cls(**params)
+        for chunk_number, tokens in enumerate(chunk_tokens):
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, frequency in frequencies.items():
+                index.postings.setdefault(token, []).append((chunk_number, frequency))
+            index.chunk_lengths.append(len(tokens))
+
+        if index.chunk_lengths:
+            index.average_length = sum(index.chunk_lengths) / len(index.chunk_lengths)
+        return index
+
+    def idf(self, term: str) -> float:
+        """Inverse document frequency of a term (BM25+ style, never negative)."""
+        document_frequency = len(self.postings.get(term, ()))
+        chunk_count = len(self.chunk_lengths)
+        return math.log(1 + (chunk_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def search(self, query_terms: Iterable[str], top_k: int = 10) -> List[Tuple[int, float]]:
+        """Return up to top_k (chunk number, score) pairs, best first."""
+        scores = {}
+        average_length = self.average_length or 1.0
+
+        for term in set(query_terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for chunk_number, frequency in postings:
+                length_norm = 1 - self.b + self.b * self.chunk_lengths[chunk_number] / average_length
+                score = idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                scores[chunk_number] = scores.get(chunk_number, 0.0) + score
+
+        # Ties are broken by chunk order so results are deterministic
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:top_k]
+
+    def to_dict(self) -> Dict:
+        """Serialize the index to a JSON-compatible dict."""
+        return {
+            'k1': self.k1,
+            'b': self.b,
+            'postings': self.postings,
+            'chunk_lengths': self.chunk_lengths,
+            'average_length': self.average_length
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BM25Index":
+        """Restore an index serialized with to_dict."""
+        index = cls(k1=data['k1'], b=data['b'])
+        index.postings = {term: [tuple(posting) for posting in postings]
+                          for term, postings in data['postings'].items()}
+        index.chunk_lengths = data['chunk_lengths']
+        index.average_length = data['average_length']
+        return index
+
+
+def save_search_index(output_dir: str, chunks: List[Dict], index: BM25Index) -> str:
+    """Persist chunk descriptors and their BM25 index to output_dir."""
+    index_file = Path(output_dir) / SEARCH_INDEX_FILENAME
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'format_version': SEARCH_INDEX_FORMAT_VERSION,
+            'chunks': chunks,
+            'index': index.to_dict()
+        }, f)
+    return str(index_file)
+
+
+def load_search_index(input_dir: str) -> Tuple[List[Dict], Optional[BM25Index]]:
+    """Load chunk descriptors and index saved by save_search_index.
+    
+    Returns ([], None) for an index saved in an older format, so the caller
+    rebuilds it.
+    """
+    index_file = Path(input_dir) / SEARCH_INDEX_FILENAME
+    with open(index_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('format_version', 1) != SEARCH_INDEX_FORMAT_VERSION:
+        return [], None
+    return data['chunks'], BM25Index.from_dict(data['index'])
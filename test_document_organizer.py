@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+test_document_organizer.py - Tests of document classification
+
+The single-pass KeywordScanner must classify exactly like the original
+rules: a category matches when any of its terms is a substring of the
+lowercased document text. Retrieval results must not be shared with the
+cache.
+"""
+
+import random
+from pathlib import Path
+
+import pytest
+
+from document_organizer import (COMPREHENSIVE_PLAN_TERMS, HAZARD_TERMS, ORGANIZATION_TYPE_TERMS,
+                                PLAN_FILENAME_INDICATORS, PLAN_TYPE_TERMS, PROCEDURE_TERMS, QUERY_CACHE,
+                                DocumentOrganizer)
+
+CORPUS_DIR = Path(__file__).parent / "training_materials" / "processed" / "all_text" / "raw_text"
+
+
+def substring_categories(filename: str, content: str) -> dict:
+    """Categories by the original rules: one substring search per term."""
+    content_lower = content.lower()
+
+    def matching(table):
+        return [category for category, terms in table.items() if any(term in content_lower for term in terms)]
+
+    categories = {}
+    if (any(indicator in filename.lower() for indicator in PLAN_FILENAME_INDICATORS)
+            or matching(COMPREHENSIVE_PLAN_TERMS)):
+        plan_types = matching(PLAN_TYPE_TERMS)
+        categories['comprehensive_plans'] = plan_types[0] if plan_types else 'general'
+    for name, table in [('hazards', HAZARD_TERMS), ('organization_types', ORGANIZATION_TYPE_TERMS),
+                        ('procedures', PROCEDURE_TERMS)]:
+        if matching(table):
+            categories[name] = matching(table)
+    return categories
+
+
+@pytest.fixture(scope="module")
+def organizer():
+    return DocumentOrganizer()
+
+
+def corpus_files():
+    if not CORPUS_DIR.exists():
+        return []
+    return [path for path in sorted(CORPUS_DIR.glob("*.txt")) if not path.name.startswith("anonymization_")]
+
+
+@pytest.mark.skipif(not corpus_files(), reason="training corpus not available")
+def test_corpus_classification_matches_substring_rules(organizer):
+    for path in corpus_files():
+        content = path.read_text(encoding='utf-8')
+        assert organizer.analyze_document(path.name, content) == substring_categories(path.name, content), path.name
+
+
+@pytest.mark.parametrize("text", [
+    # A term inside a longer word or term
+    "The wildfire season",
+    "wildland fire crews",
+    "fire",
+    "Flooding in the basement",
+    "evacuate, then complete the evacuation",
+    # Terms sharing a prefix
+    "planning for the plant",
+    "emergency planning committee",
+    "emergency preparedness and the emergency plan",
+    "hazardous materials storage",
+    "HAZMAT team",
+    # Terms inside unrelated words
+    "restore capacity and electricity",
+    "exiting the building",
+    "the patient's outpatient clinic",
+    "heating, ventilation and air temperature",
+    # Overlapping matches and repeats
+    "medical emergencymedical response",
+    "first aidfirst aid",
+    "non-profit nonprofit",
+    "",
+    "no keywords at all here",
+])
+def test_overlap_cases_match_substring_rules(organizer, text):
+    assert organizer.analyze_document("notes.txt", text) == substring_categories("notes.txt", text)
+
+
+@pytest.mark.parametrize("filename", ["Campus ERP 2023.txt", "emergency plan.txt", "Emergency Preparedness.txt"])
+def test_filename_indicators(organizer, filename):
+    text = "university campus flood"
+    assert organizer.analyze_document(filename, text) == substring_categories(filename, text)
+    assert organizer.analyze_document(filename, text)['comprehensive_plans'] == 'educational'
+
+
+def test_chunk_categories_match_substring_rules(organizer):
+    text = "Wildfire evacuation of the hospital; hazmat spill at the plant"
+    expected = {name: categories for name, categories in substring_categories("notes.txt", text).items()
+                if name != 'comprehensive_plans'}
+    assert organizer.analyze_chunk(text) == expected
+
+
+def test_random_term_mixtures_match_substring_rules(organizer):
+    # Terms and fragments of terms glued together, so matches overlap and nest
+    terms = [term for table in (COMPREHENSIVE_PLAN_TERMS, PLAN_TYPE_TERMS, HAZARD_TERMS,
+                                ORGANIZATION_TYPE_TERMS, PROCEDURE_TERMS)
+             for category_terms in table.values() for term in category_terms]
+    pieces = terms + [term[:len(term) // 2] for term in terms] + [term[len(term) // 2:] for term in terms]
+    pieces += [" ", "-", "wild", "re", "s"]
+
+    generator = random.Random(0)
+    for _ in range(500):
+        text = "".join(generator.choice(pieces) for _ in range(generator.randint(1, 12)))
+        if generator.random() < 0.5:
+            text = text.upper()
+        assert organizer.analyze_document("notes.txt", text) == substring_categories("notes.txt", text), text
+
+
+@pytest.fixture
+def small_store(tmp_path):
+    organizer = DocumentOrganizer(data_dir=str(tmp_path), output_dir=str(tmp_path))
+    documents = {
+        "school_fire.txt": "1.0 Fire Evacuation\nStudents evacuate the school when the fire alarm sounds.",
+        "hospital_flood.txt": "1.0 Flood Response\nPatients are moved above the flood line at the hospital.",
+    }
+    for filename, content in documents.items():
+        organizer.add_document(filename, content, organizer.analyze_document(filename, content))
+    organizer.build_search_index()
+    return organizer
+
+
+def test_search_results_are_not_shared_with_the_cache(small_store):
+    first = small_store.search("educational", ["fire"])
+    assert first
+    expected = [dict(result, headings=list(result['headings'])) for result in first]
+
+    first[0]['text'] = "changed"
+    first[0]['headings'].append("changed")
+    first[0]['categories'].setdefault('hazards', []).append("changed")
+
+    again = small_store.search("educational", ["fire"])
+    assert again[0]['text'] == expected[0]['text']
+    assert again[0]['headings'] == expected[0]['headings']
+    assert "changed" not in again[0]['categories'].get('hazards', [])
+    assert all("changed" not in chunk['headings'] for chunk in small_store.chunks)
+
+
+def test_context_miss_counts_one_lookup(small_store):
+    before = QUERY_CACHE.stats()
+    small_store.get_relevant_context("healthcare", ["flood"])
+    small_store.get_relevant_context("healthcare", ["flood"])
+    after = QUERY_CACHE.stats()
+
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 1
@@ -30,10 +30,10 @@ def test_document_organization():
     
     for category, subcategories in organized_docs.items():
         print(f"\n{category.upper()}:")
-        for subcategory, docs in subcategories.items():
-            print(f"  {subcategory}: {len(docs)} documents")
-            for doc in docs:
-                print(f"    - {doc['filename']}")
+        for subcategory, doc_ids in subcategories.items():
+            print(f"  {subcategory}: {len(doc_ids)} documents")
+            for doc_id in doc_ids:
+                print(f"    - {organizer.documents[doc_id]['filename']}")
     
     return organized_docs
 
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+test_plan_generator_base.py - Tests of the shared plan generator options
+
+--keep-alive values must reach Ollama in a form it accepts: a duration
+with a unit as a string, and a number of seconds as a number.
+"""
+
+import argparse
+
+import pytest
+
+from plan_generator_base import DEFAULT_KEEP_ALIVE, add_keep_alive_argument, parse_keep_alive
+
+
+def parse_args(*argv):
+    parser = argparse.ArgumentParser()
+    add_keep_alive_argument(parser)
+    return parser.parse_args(argv)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("-1", -1),
+    ("0", 0),
+    ("3600", 3600),
+    ("1.5", 1.5),
+    ("30m", "30m"),
+    ("24h", "24h"),
+    ("-1m", "-1m"),
+])
+def test_keep_alive_argument(value, expected):
+    keep_alive = parse_args(f"--keep-alive={value}").keep_alive
+    assert keep_alive == expected
+    assert type(keep_alive) is type(expected)
+
+
+def test_keep_alive_default():
+    assert parse_args().keep_alive == DEFAULT_KEEP_ALIVE
+    assert parse_keep_alive(DEFAULT_KEEP_ALIVE) == DEFAULT_KEEP_ALIVE